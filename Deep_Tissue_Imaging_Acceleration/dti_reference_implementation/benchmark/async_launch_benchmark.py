@@ -0,0 +1,83 @@
+"""
+Benchmark of asynchronous kernel launches against the simulated diffraction IP.
+
+Propagates several independent fields through the simulated overlay with a
+configurable kernel latency, first one after the other with blocking launches
+and then interleaved on one event loop, and compares the wall time, the
+results and the number of control register polls of each completion mode.
+
+Run from dti_reference_implementation:
+    python -m benchmark.async_launch_benchmark --latency 0.01 --fields 3
+"""
+
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+from deep_tissue_imaging.hardware.diffraction_backend import load_overlay_diffraction
+import deep_tissue_imaging.propagators.propagation as prop
+
+
+def run_benchmark(latency=0.01, n_fields=3, N=32, Nz=10):
+    """
+    Compare blocking and interleaved propagation on the simulated IP.
+
+    Parameters:
+        latency (float): Minimum kernel duration of the simulated IP in seconds
+        n_fields (int): Number of independent fields to propagate
+        N (int): Grid size (Nx = Ny = N)
+        Nz (int): Number of z-steps
+
+    Returns:
+        dict: Wall times in seconds, polls per mode and max deviation between modes
+    """
+    d = build_domain(45e-6, 45e-6, Nz * 1e-6, N, N, Nz, laser, tejido)
+    # Off-centre beams so that every field is different
+    phis = [campo_tem00(d.X - i * 2e-6, d.Y, laser.w0, laser.I_peak) for i in range(n_fields)]
+
+    results = {}
+
+    hw, _ = load_overlay_diffraction('diffraction_ovr.bit', d, mock=True, latency=latency, use_interrupt=False)
+    t0 = time.perf_counter()
+    blocking = [prop.full_propagation_within_tissue(phi, tejido, d, diffraction=hw)[-1] for phi in phis]
+    results['blocking_s'] = time.perf_counter() - t0
+    results['blocking_polls'] = hw.launcher.polls
+
+    for use_interrupt in (False, True):
+        hw, _ = load_overlay_diffraction('diffraction_ovr.bit', d, mock=True, latency=latency,
+                                         use_interrupt=use_interrupt)
+
+        async def interleaved():
+            histories = await asyncio.gather(
+                *[prop.full_propagation_within_tissue_async(phi, tejido, d, hw) for phi in phis])
+            await hw.queue.close()
+            return [history[-1] for history in histories]
+
+        t0 = time.perf_counter()
+        fields = asyncio.run(interleaved())
+        mode = 'interrupt' if use_interrupt else 'polling'
+        results[f'{mode}_s'] = time.perf_counter() - t0
+        results[f'{mode}_polls'] = hw.launcher.polls
+        results[f'{mode}_max_error'] = max(float(np.max(np.abs(a - b))) for a, b in zip(fields, blocking))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--fields', type=int, default=3)
+    parser.add_argument('--N', type=int, default=32)
+    parser.add_argument('--Nz', type=int, default=10)
+    args = parser.parse_args()
+
+    r = run_benchmark(args.latency, args.fields, args.N, args.Nz)
+    print(f"Blocking launches:    {r['blocking_s']*1e3:8.1f} ms  ({r['blocking_polls']} polls)")
+    for mode in ('polling', 'interrupt'):
+        print(f"Interleaved ({mode:9s}): {r[f'{mode}_s']*1e3:8.1f} ms  ({r[f'{mode}_polls']} polls, "
+              f"max deviation {r[f'{mode}_max_error']:.2e})")
@@ -0,0 +1,87 @@
+"""
+Import time of the numerical core, and a guard against heavy imports.
+
+Imports the simulation core in a fresh interpreter, reports the wall time,
+and checks that no plotting or SciPy module was loaded on the way:
+sweep workers and hardware validation scripts import the core without ever
+plotting, and matplotlib alone costs hundreds of milliseconds. The modules
+that need them (plotting, the mask generators, medir_psf_params) import
+them where they are used. Exits with status 1 if a forbidden module is
+loaded.
+
+Run from dti_reference_implementation:
+    python -m benchmark.import_time_benchmark --repeat 5
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+CORE = (
+    'deep_tissue_imaging.elementos.domain',
+    'deep_tissue_imaging.elementos.tejidos',
+    'deep_tissue_imaging.elementos.lasers',
+    'deep_tissue_imaging.elementos.history_store',
+    'deep_tissue_imaging.elementos.precision',
+    'deep_tissue_imaging.propagators.step_operators',
+    'deep_tissue_imaging.propagators.partitioned_solver',
+    'deep_tissue_imaging.propagators.propagation',
+    'deep_tissue_imaging.propagators.layered_plan',
+    'deep_tissue_imaging.propagators.roi_propagation',
+    'deep_tissue_imaging.propagators.field_cache',
+    'deep_tissue_imaging.propagators.adjoint',
+    'deep_tissue_imaging.propagators.transmission_matrix',
+    'deep_tissue_imaging.propagators.observers',
+    'deep_tissue_imaging.hardware.diffraction_backend',
+    'benchmark.phase_mask_manager',
+)
+
+FORBIDDEN = ('matplotlib', 'mpl_toolkits', 'scipy', 'PIL')
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import numpy
+t1 = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+t2 = time.perf_counter()
+print(json.dumps({{'numpy_s': t1 - t0, 'core_s': t2 - t1,
+                  'loaded': sorted({{m.split('.')[0] for m in sys.modules}} & set({forbidden!r}))}}))
+"""
+
+
+def measure(modules=CORE, repeat=5):
+    """
+    Import the modules in `repeat` fresh interpreters.
+
+    Parameters:
+        modules (tuple): Module names imported after numpy
+        repeat (int): Number of interpreters
+
+    Returns:
+        dict: Best numpy and core import times in seconds, and the forbidden
+            top-level packages found in sys.modules afterwards
+    """
+    probe = _PROBE.format(modules=tuple(modules), forbidden=FORBIDDEN)
+    runs = [json.loads(subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True,
+                                      check=True).stdout) for _ in range(repeat)]
+    return {
+        'numpy_s': min(r['numpy_s'] for r in runs),
+        'core_s': min(r['core_s'] for r in runs),
+        'loaded': sorted(set().union(*(r['loaded'] for r in runs))),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of the simulation core.")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    r = measure(repeat=args.repeat)
+    print(f"numpy {r['numpy_s']*1e3:.0f} ms, core ({len(CORE)} modules) {r['core_s']*1e3:.0f} ms")
+    if r['loaded']:
+        print(f"FAIL: the core loaded {', '.join(r['loaded'])}")
+        sys.exit(1)
+    print("no plotting or SciPy modules loaded")
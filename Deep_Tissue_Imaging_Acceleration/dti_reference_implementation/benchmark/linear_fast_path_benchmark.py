@@ -0,0 +1,83 @@
+"""
+Validation of the linear-regime fast path of full_propagation_within_tissue.
+
+Propagates a TEM00 beam at several peak intensities with and without
+`fast_linear` and compares the histories, the number of steps that ran
+linear and the wall times. The host-side operator time is what the fast
+path saves, so the diffraction step runs on the partitioned solver.
+
+Run from dti_reference_implementation:
+    python -m benchmark.linear_fast_path_benchmark --N 128 --Nz 110
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+import deep_tissue_imaging.propagators.propagation as prop
+
+
+def run_benchmark(N=128, Nz=110, peaks=(1e10, 3e10, 1e13)):
+    """
+    Compare the propagation with and without the linear fast path.
+
+    Parameters:
+        N (int): Grid size (Nx = Ny = N)
+        Nz (int): Number of z-steps of 1 µm
+        peaks (tuple): Input peak intensities in W/m²
+
+    Returns:
+        list: One dict per peak with the wall times, the max relative deviation,
+            the linear steps and the steps where the regime changed
+    """
+    # With the default eps=1e-12 the transparent boundary ratios of the faint
+    # tail at the grid edge amplify rounding noise within ~100 steps, and after
+    # the first mask (z = l_s) the scattered light does so even with eps=1e-2:
+    # both paths then diverge, so keep Nz below l_s/dz for a comparison
+    d = build_domain(45e-6, 45e-6, Nz * 1e-6, N, N, Nz, laser, tejido, eps=1e-2)
+    backend = SoftwareDiffraction(block_size=64 if N % 64 == 0 else None)
+    results = []
+    for peak in peaks:
+        phi0 = campo_tem00(d.X, d.Y, laser.w0, peak)
+        np.random.seed(0)
+        t0 = time.perf_counter()
+        full = prop.full_propagation_within_tissue(phi0, tejido, d, diffraction=backend, fast_linear=False)
+        t_full = time.perf_counter() - t0
+
+        np.random.seed(0)
+        linear = []
+        t0 = time.perf_counter()
+        fast = prop.full_propagation_within_tissue(phi0, tejido, d, diffraction=backend, fast_linear=True,
+                                                   observers=[lambda z, phi, stats: linear.append(stats['linear'])])
+        t_fast = time.perf_counter() - t0
+        linear = linear[1:]
+
+        results.append({
+            'peak': peak,
+            'full_s': t_full,
+            'fast_s': t_fast,
+            'linear': linear,
+            'linear_steps': int(np.sum(linear)),
+            'max_rel_dev': float(np.max(np.abs(fast - full)) / np.max(np.abs(full))),
+            'switches': [k for k in range(Nz) if linear[k] != (k > 0 and linear[k - 1])],
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Linear fast path against the full step operators.")
+    parser.add_argument('--N', type=int, default=128)
+    parser.add_argument('--Nz', type=int, default=110)
+    args = parser.parse_args()
+
+    for r in run_benchmark(args.N, args.Nz):
+        print(f"peak {r['peak']:.0e} W/m²: {r['linear_steps']}/{args.Nz} linear steps, "
+              f"full {r['full_s']:.2f} s, fast path {r['fast_s']:.2f} s, "
+              f"max relative deviation {r['max_rel_dev']:.1e}")
+        for k in r['switches']:
+            print(f"    {'linear' if r['linear'][k] else 'nonlinear'} from z = {k}")
@@ -6,8 +6,6 @@ including FWHM lateral, FWHM axial, encircled energy, and sidelobes.
 """
 
 import numpy as np
-from scipy.interpolate import interp1d
-import matplotlib.pyplot as plt
 
 def calcular_fwhm_lateral(psf, X, Y):
     """
@@ -37,6 +35,7 @@ def calcular_fwhm_lateral(psf, X, Y):
     half_max = max_value / 2.0
 
     # Interpolate to find more precise crossing points
+    from scipy.interpolate import interp1d
     x_interp = interp1d(x_profile, horizontal_profile - half_max, kind='cubic')
     x_range = np.linspace(x_profile.min(), x_profile.max(), 1000)
     y_interp = x_interp(x_range)
@@ -95,6 +94,7 @@ def calcular_fwhm_axial(psf_history, z_positions):
 
     # Interpolate to find more precise crossing points
     try:
+        from scipy.interpolate import interp1d
         z_interp = interp1d(z_positions, max_intensities - half_max, kind='cubic')
         z_range = np.linspace(z_positions.min(), z_positions.max(), 1000)
         z_interp_values = z_interp(z_range)
@@ -262,6 +262,12 @@ def calcular_sidelobes(psf, X, Y):
         'vertical_sidelobes': v_sidelobe_levels
     }
 
+def _intensity_planes(psf_history):
+    """The planes of a history as intensities, converted one at a time if complex."""
+    for psf_z in psf_history:
+        yield np.abs(psf_z)**2 if np.iscomplexobj(psf_z) else psf_z
+
+
 def medir_psf_params(psf, X, Y, psf_history=None, z_positions=None, plot=False):
     """
     Measure various parameters of a Point Spread Function (PSF).
@@ -286,10 +292,7 @@ def medir_psf_params(psf, X, Y, psf_history=None, z_positions=None, plot=False):
     # Calculate axial FWHM if history is provided
     fwhm_axial = None
     if psf_history is not None and z_positions is not None:
-        # Convert to intensity if complex
-        if np.iscomplexobj(psf_history):
-            psf_history = np.abs(psf_history)**2
-        fwhm_axial = calcular_fwhm_axial(psf_history, z_positions)
+        fwhm_axial = calcular_fwhm_axial(_intensity_planes(psf_history), z_positions)
 
 
     # Calculate encircled energy at different radii
@@ -325,6 +328,8 @@ def medir_psf_params(psf, X, Y, psf_history=None, z_positions=None, plot=False):
 
     # Plot if requested
     if plot:
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 10))
 
         # Plot the PSF
@@ -359,7 +364,7 @@ def medir_psf_params(psf, X, Y, psf_history=None, z_positions=None, plot=False):
         # Plot axial profile if available
         if psf_history is not None and z_positions is not None:
             plt.subplot(2, 2, 4)
-            max_intensities = np.array([np.max(np.abs(psf_z)**2) for psf_z in psf_history])
+            max_intensities = np.array([np.max(np.abs(psf_z)**2) for psf_z in _intensity_planes(psf_history)])
             plt.plot(z_positions*1e6, max_intensities / np.max(max_intensities))
             plt.axhline(0.5, color='r', linestyle='--', label='Half Maximum')
             plt.title('Axial Profile')
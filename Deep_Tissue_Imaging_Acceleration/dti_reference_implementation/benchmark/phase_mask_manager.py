@@ -7,9 +7,10 @@ consistently generated and applied across different simulations.
 
 import os
 import numpy as np
-from scipy.ndimage import gaussian_filter
 import pickle
 
+from deep_tissue_imaging.elementos.precision import field_types
+
 class PhaseMaskManager:
     """
     Manages phase masks for deep tissue imaging simulations.
@@ -51,13 +52,17 @@ class PhaseMaskManager:
         with open(self.metadata_file, 'wb') as f:
             pickle.dump(self.metadata, f)
     
-    def get_mask_filename(self, mask_index):
-        """Get the filename for a specific mask index."""
-        return os.path.join(self.save_dir, f"phase_mask_{mask_index}.npy")
+    def get_mask_filename(self, mask_index, dtype=np.float32):
+        """Get the filename for a specific mask index (float32 masks keep the unsuffixed name)."""
+        suffix = "" if np.dtype(dtype) == np.float32 else f"_{np.dtype(dtype).name}"
+        return os.path.join(self.save_dir, f"phase_mask_{mask_index}{suffix}.npy")
     
     def generate_mask(self, shape, X, Y, desviacion_fase, correlacion_m, mask_index):
         """
-        Generate a new phase mask with the given parameters.
+        Generate a new phase mask with the given parameters, in the precision of the grids.
+        
+        A float64 mask filters the same noise as the float32 one, so both
+        precisions see the same tissue up to rounding.
         
         Parameters:
             shape (tuple): Shape of the mask (Ny, Nx)
@@ -72,22 +77,25 @@ class PhaseMaskManager:
         # Set a seed based on the mask index for reproducibility
         np.random.seed(42 + mask_index)  # Use a fixed base seed + mask index
         
+        real = field_types(X)[0]
+        
         # Calculate dx and dy from the meshgrids (in meters)
-        dx = np.float32(np.abs(X[0, 1] - X[0, 0]))  # meters
-        dy = np.float32(np.abs(Y[1, 0] - Y[0, 0]))  # meters
+        dx = real(np.abs(X[0, 1] - X[0, 0]))  # meters
+        dy = real(np.abs(Y[1, 0] - Y[0, 0]))  # meters
         
         # Correlation length in pixels
-        sigma_x = np.float32(correlacion_m / dx)
-        sigma_y = np.float32(correlacion_m / dy)
+        sigma_x = real(correlacion_m / dx)
+        sigma_y = real(correlacion_m / dy)
         
         # Generate Gaussian noise with desired standard deviation
-        ruido = np.random.normal(loc=0.0, scale=desviacion_fase, size=shape).astype(np.float32)
+        ruido = np.random.normal(loc=0.0, scale=desviacion_fase, size=shape).astype(real)
         
         # Smooth to mimic structural fluctuation
+        from scipy.ndimage import gaussian_filter
         theta = gaussian_filter(ruido, sigma=(sigma_y, sigma_x), mode='reflect')
         
         # Save the mask
-        mask_file = self.get_mask_filename(mask_index)
+        mask_file = self.get_mask_filename(mask_index, real)
         np.save(mask_file, theta)
         
         # Update metadata
@@ -113,14 +121,16 @@ class PhaseMaskManager:
             mask_index (int): Index of the mask (1, 2, or 3)
             
         Returns:
-            ndarray: The phase mask (theta, not the complex exponential)
+            ndarray: The phase mask (theta, not the complex exponential), in the precision of the grids
         """
+        real = field_types(X)[0]
+        
         # Check if mask is in memory
-        if mask_index in self.masks:
+        if mask_index in self.masks and self.masks[mask_index].dtype == real:
             return self.masks[mask_index]
         
         # Check if mask exists on disk
-        mask_file = self.get_mask_filename(mask_index)
+        mask_file = self.get_mask_filename(mask_index, real)
         if os.path.exists(mask_file):
             try:
                 theta = np.load(mask_file)
@@ -158,13 +168,14 @@ class PhaseMaskManager:
             masks[i] = self.get_mask(shape, X, Y, desviacion_fase, correlacion_m, i)
         return masks
     
-    def apply_mask(self, phi, mask_index):
+    def apply_mask(self, phi, mask_index, region=None):
         """
         Apply a pre-initialized phase mask to the complex field phi.
         
         Parameters:
             phi (ndarray): Complex field to which the mask will be applied
             mask_index (int): Index of the mask (1, 2, or 3)
+            region (tuple of slices, optional): Window of the full grid that phi covers
             
         Returns:
             ndarray: The field with the phase mask applied
@@ -172,11 +183,14 @@ class PhaseMaskManager:
         if mask_index not in self.masks:
             raise ValueError(f"Mask with index {mask_index} not initialized. Call initialize_masks first.")
         
-        # Get the phase mask (theta)
-        theta = self.masks[mask_index]
+        # Get the phase mask (theta), in the precision of the field
+        real, cplx = field_types(phi)
+        theta = self.masks[mask_index].astype(real, copy=False)
+        if region is not None:
+            theta = theta[region]
         
         # Apply the phase mask as a complex exponential
-        mf = np.exp(np.complex64(1j * theta))
+        mf = np.exp(cplx(1j) * theta)
         
         # Apply the mask to the field
         return phi * mf
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+Accuracy and speed of the single and double precision policies.
+
+Propagates the reference TEM00 case on a 'double' domain (complex128, the
+reference answer) and on a 'single' one (complex64, production), with the
+reference adi_x/adi_y operators and with the partitioned solver, and
+compares the wall times, the deviation of the single precision history and
+the drift of its PSF metrics at the last plane. A short run of each policy
+under PrecisionSentinel checks that nothing in the loop is promoted past it.
+
+Both runs apply every operator (the linear fast path is off). The
+reference operators loop over rows in Python, so their time hardly depends
+on the precision; the partitioned solver is vectorized and pays for the
+wider dtype.
+
+Run from dti_reference_implementation:
+    python -m benchmark.precision_benchmark --N 128 --Nz 110
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmark.resolution_autotuner import _metrics, drift
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+from deep_tissue_imaging.elementos.precision import PrecisionSentinel
+from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+import deep_tissue_imaging.propagators.propagation as prop
+
+
+def run_benchmark(N=128, Nz=110, sentinel_steps=3):
+    """
+    Compare the single and double precision policies.
+
+    Parameters:
+        N (int): Grid size (Nx = Ny = N)
+        Nz (int): Number of z-steps of 1 µm
+        sentinel_steps (int): Steps of the runs under PrecisionSentinel
+
+    Returns:
+        list: One dict per diffraction backend with the wall time of each policy,
+            the max relative deviation of the single history, the drift of its PSF
+            metrics and the violations found by the sentinel per policy
+    """
+    # eps=1e-2 and Nz below l_s/dz: with smaller thresholds, or after the first
+    # mask, the transparent boundary amplifies rounding noise, and the two
+    # policies would diverge by the instability instead of the rounding
+    backends = (('reference', None), ('partitioned', SoftwareDiffraction(block_size=64 if N % 64 == 0 else None)))
+    domains = {p: build_domain(45e-6, 45e-6, Nz * 1e-6, N, N, Nz, laser, tejido, eps=1e-2, precision=p)
+               for p in ('double', 'single')}
+    results = []
+    for name, backend in backends:
+        result = {'backend': name}
+        histories = {}
+        for precision, d in domains.items():
+            phi0 = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+            t0 = time.perf_counter()
+            histories[precision] = prop.full_propagation_within_tissue(phi0, tejido, d, diffraction=backend)
+            result[f'{precision}_s'] = time.perf_counter() - t0
+
+            short = build_domain(45e-6, 45e-6, sentinel_steps * 1e-6, N, N, sentinel_steps, laser, tejido,
+                                 eps=1e-2, precision=precision)
+            with PrecisionSentinel(precision) as sentinel:
+                prop.full_propagation_within_tissue(phi0, tejido, short, diffraction=backend)
+            result[f'{precision}_violations'] = len(sentinel.violations)
+
+        single, double = histories['single'], histories['double']
+        result['max_rel_dev'] = float(np.max(np.abs(single - double)) / np.max(np.abs(double)))
+        result['metrics'] = _metrics(single, domains['single'])
+        result['drift'] = drift(result['metrics'], _metrics(double, domains['double']))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single against double precision propagation.")
+    parser.add_argument('--N', type=int, default=128)
+    parser.add_argument('--Nz', type=int, default=110)
+    args = parser.parse_args()
+
+    for r in run_benchmark(args.N, args.Nz):
+        worst = max(r['drift'], key=r['drift'].get)
+        print(f"{r['backend']}: single {r['single_s']:.2f} s, double {r['double_s']:.2f} s "
+              f"({r['double_s'] / r['single_s']:.2f}x), max relative deviation {r['max_rel_dev']:.1e}, "
+              f"worst PSF drift {worst} {r['drift'][worst]:.1e}, "
+              f"sentinel violations single {r['single_violations']}, double {r['double_violations']}")
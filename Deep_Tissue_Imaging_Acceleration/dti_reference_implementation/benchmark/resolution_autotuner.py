@@ -0,0 +1,269 @@
+"""
+Accuracy-versus-cost autotuner for the grid and step resolution.
+
+Propagates a representative case once at a fine reference resolution and
+then at candidate (Nx, Ny, dz) from the cheapest up, measuring the
+medir_psf_params metrics of each trial at its focal plane (the plane of
+maximum intensity) and its wall time. The recommendation is the cheapest
+candidate whose metrics all stay within tolerance of the reference.
+
+Every trial sees the same tissue realization: the reference phase masks
+are resampled onto each trial grid (they are smooth on the 5 µm correlation
+length), and dz must divide l_s so the masks stay at the same depths.
+
+Results are recorded in a JSON file keyed by a hash of the case (domain
+size, laser and tissue constants, the input field sampled on the reference
+grid, candidates, tolerances, exhaustive and the code version, which
+covers benchmark/ as well: the metrics and this module live there), and a
+recorded case is returned without running anything.
+
+Run from dti_reference_implementation:
+    python -m benchmark.resolution_autotuner --Lz 100e-6 --record resolution_tuning.json
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmark.medir_psf_params import medir_psf_params
+from benchmark.phase_mask_manager import PhaseMaskManager
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.history_store import _class_constants
+from deep_tissue_imaging.elementos.lasers import campo_tem00
+from deep_tissue_imaging.elementos.results_db import code_version
+import deep_tissue_imaging.propagators.propagation as prop
+
+# Relative drift allowed per metric; max_sidelobe_ratio is already a fraction
+# of the peak, so its tolerance is absolute
+TOLERANCES = {
+    'fwhm_lateral': 0.03,
+    'fwhm_axial': 0.05,
+    'radio_80': 0.03,
+    'energia_1fwhm': 0.02,
+    'max_sidelobe_ratio': 0.02,
+}
+
+# The propagation only loses power; a gain above rounding marks the transparent
+# boundary instability, and the trial fails whatever its metrics
+MAX_POWER_GAIN = 1e-3
+
+
+def _resample(theta, x_src, y_src, x_dst, y_dst):
+    """Bilinear resampling of a mask between two tensor-product grids."""
+    rows = np.stack([np.interp(x_dst, x_src, row) for row in theta])
+    return np.stack([np.interp(y_dst, y_src, col) for col in rows.T], axis=1).astype(theta.dtype)
+
+
+def _metrics(history, d):
+    """PSF metrics at the plane of maximum intensity of a history, and its largest power gain."""
+    I = history.real**2 + history.imag**2
+    power = I.sum(axis=(1, 2))
+    focus = int(np.argmax(I.max(axis=(1, 2))))
+    z_positions = np.arange(d.Nz + 1) * d.dz
+    with contextlib.redirect_stdout(io.StringIO()):
+        params = medir_psf_params(I[focus], d.X, d.Y, I, z_positions)
+    return {
+        'fwhm_lateral': float(params['fwhm_lateral']),
+        'fwhm_axial': None if params['fwhm_axial'] is None else float(params['fwhm_axial']),
+        'radio_80': float(params['radio_80']),
+        'energia_1fwhm': float(list(params['energia_encerrada'].values())[1]),
+        'max_sidelobe_ratio': float(params['sidelobes']['max_sidelobe_ratio']),
+        'z_focus': float(z_positions[focus]),
+        'power_gain': float(power.max() / power[0]),
+    }
+
+
+def drift(metrics, reference, tolerances=TOLERANCES):
+    """
+    Drift of each toleranced metric against the reference.
+
+    Returns:
+        dict: Relative drift per metric (absolute for max_sidelobe_ratio); inf if
+            the metric is missing in one of the two
+    """
+    result = {}
+    for name in tolerances:
+        a, b = metrics.get(name), reference.get(name)
+        if a is None or b is None:
+            result[name] = 0.0 if a is None and b is None else float('inf')
+        elif name == 'max_sidelobe_ratio':
+            result[name] = abs(a - b)
+        else:
+            result[name] = abs(a - b) / abs(b)
+    return result
+
+
+def field_digest(field, d):
+    """Hash of an input field callable by its samples on a domain's grid."""
+    phi = np.ascontiguousarray(field(d.X, d.Y, d), dtype=np.complex64)
+    return hashlib.sha256(phi.tobytes()).hexdigest()[:16]
+
+
+def case_key(laser, tejido, L, grids, steps, reference, tolerances, eps, field, exhaustive, version=None):
+    """
+    Hash of everything the recommendation depends on.
+
+    Parameters:
+        field (str): field_digest of the input field on the reference grid
+        exhaustive (bool): Whether every candidate runs
+        version (str, optional): Code version; code_version() by default, the
+            sources of deep_tissue_imaging and benchmark
+        (the others as in autotune, with the grids and reference normalized)
+
+    Returns:
+        str: Hex digest
+    """
+    case = [_class_constants(laser), _class_constants(tejido), [float(v) for v in L],
+            [list(g) for g in grids], [float(s) for s in steps], [list(reference[0]), float(reference[1])],
+            tolerances, float(eps), field, bool(exhaustive), version or code_version()]
+    return hashlib.sha256(json.dumps(case, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _grid(g):
+    return (g, g) if np.isscalar(g) else tuple(g)
+
+
+def autotune(laser, tejido, L=(45e-6, 45e-6, 361e-6), grids=(64, 96, 128, 192, 256),
+             steps=(2e-6, 1e-6, 0.5e-6), reference=None, tolerances=TOLERANCES, field=None,
+             eps=1e-1, record=None, exhaustive=False):
+    """
+    Find the cheapest resolution whose PSF metrics match a fine reference.
+
+    Parameters:
+        laser: Light source properties
+        tejido: Tissue properties
+        L (tuple): Domain size (Lx, Ly, Lz) in meters
+        grids (tuple): Candidate grids, N for Nx = Ny = N or (Nx, Ny)
+        steps (tuple): Candidate dz in meters, each dividing tejido.l_s
+        reference (tuple, optional): ((Nx, Ny), dz) of the reference; the finest
+            grid and step by default
+        tolerances (dict): Allowed drift per metric (see TOLERANCES)
+        field (callable, optional): field(X, Y, d) giving the input field; a
+            TEM00 beam of the laser by default
+        eps (float): Threshold of the transparent boundary ratios, an amplitude in
+            sqrt(W/m²). Below ~1e-1 the ratios of the faint tail at the grid edge
+            amplify rounding noise on the finest grids, which would dominate the drift
+        record (str, optional): JSON file of recorded results, read and updated
+        exhaustive (bool): Run every candidate instead of stopping at the first
+            (cheapest) one within tolerance
+
+    Returns:
+        dict: 'recommended' ({'Nx', 'Ny', 'dz'} or None if no candidate passed),
+            'reference' and 'trials' (resolution, metrics, drift, seconds, passed);
+            a trial whose power grows fails
+    """
+    grids = [_grid(g) for g in grids]
+    reference = reference or (max(grids, key=lambda g: g[0] * g[1]), min(steps))
+    reference = (_grid(reference[0]), reference[1])
+    for dz in steps:
+        if abs(tejido.l_s / dz - round(tejido.l_s / dz)) > 1e-6:
+            raise ValueError(f"dz = {dz} doesn't divide l_s = {tejido.l_s}; the masks would move")
+
+    if field is None:
+        def field(X, Y, d):
+            return campo_tem00(X, Y, laser.w0, laser.I_peak)
+
+    d_ref = build_domain(L[0], L[1], L[2], reference[0][0], reference[0][1], int(round(L[2] / reference[1])),
+                         laser, tejido, eps=eps)
+    key = case_key(laser, tejido, L, grids, steps, reference, tolerances, eps, field_digest(field, d_ref),
+                   exhaustive)
+    records = {}
+    if record is not None and os.path.exists(record):
+        with open(record) as f:
+            records = json.load(f)
+        if key in records:
+            return records[key]
+
+    def run(grid, dz, masks):
+        Nz = int(round(L[2] / dz))
+        d = build_domain(L[0], L[1], L[2], grid[0], grid[1], Nz, laser, tejido, eps=eps)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if masks is None:
+                manager.initialize_masks(d.X.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+            else:
+                manager.masks = {i: _resample(theta, x_ref, y_ref, d.X[0], d.Y[:, 0])
+                                 for i, theta in masks.items()}
+            t0 = time.perf_counter()
+            history = prop.full_propagation_within_tissue(field(d.X, d.Y, d), tejido, d, manager)
+            seconds = time.perf_counter() - t0
+        return d, history, seconds
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = PhaseMaskManager(tmp)
+        d_ref, history, seconds = run(*reference, None)
+        masks = dict(manager.masks)
+        x_ref, y_ref = d_ref.X[0], d_ref.Y[:, 0]
+        ref_metrics = _metrics(history, d_ref)
+        del history
+        if ref_metrics['power_gain'] > 1 + MAX_POWER_GAIN:
+            raise ValueError(f"The reference propagation gains power (x{ref_metrics['power_gain']:.3g}): "
+                             "the transparent boundary is unstable, raise eps or shorten Lz")
+
+        result = {
+            'reference': {'Nx': reference[0][0], 'Ny': reference[0][1], 'dz': reference[1],
+                          'metrics': ref_metrics, 'seconds': seconds},
+            'tolerances': tolerances,
+            'trials': [],
+            'recommended': None,
+        }
+        candidates = sorted(((g, dz) for g in grids for dz in steps if (g, dz) != reference),
+                            key=lambda c: c[0][0] * c[0][1] / c[1])
+        for grid, dz in candidates:
+            d, history, seconds = run(grid, dz, masks)
+            metrics = _metrics(history, d)
+            deviation = drift(metrics, ref_metrics, tolerances)
+            passed = (metrics['power_gain'] <= 1 + MAX_POWER_GAIN
+                      and all(deviation[name] <= tol for name, tol in tolerances.items()))
+            result['trials'].append({'Nx': grid[0], 'Ny': grid[1], 'dz': dz, 'metrics': metrics,
+                                     'drift': deviation, 'seconds': seconds, 'passed': passed})
+            if passed and result['recommended'] is None:
+                result['recommended'] = {'Nx': grid[0], 'Ny': grid[1], 'dz': dz}
+                if not exhaustive:
+                    break
+
+    if record is not None:
+        records[key] = result
+        with open(record, 'w') as f:
+            json.dump(records, f, indent=1)
+    return result
+
+
+if __name__ == "__main__":
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_gaussiano_enfocado
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+
+    parser = argparse.ArgumentParser(description="Cheapest resolution with converged PSF metrics.")
+    # Up to l_s: after the first mask the boundary of the fine grids can go unstable
+    parser.add_argument('--Lz', type=float, default=100e-6)
+    parser.add_argument('--focus', type=float, default=60e-6, help="focus depth of the input beam in meters")
+    parser.add_argument('--grids', type=int, nargs='+', default=[64, 96, 128, 192])
+    parser.add_argument('--steps', type=float, nargs='+', default=[2e-6, 1e-6, 0.5e-6])
+    parser.add_argument('--record', default=None)
+    parser.add_argument('--exhaustive', action='store_true')
+    args = parser.parse_args()
+
+    def focused(X, Y, d):
+        return campo_gaussiano_enfocado(X, Y, laser.w0, laser.I_peak, d.k, args.focus)
+
+    r = autotune(laser, tejido, (45e-6, 45e-6, args.Lz), args.grids, args.steps, field=focused,
+                 record=args.record, exhaustive=args.exhaustive)
+    ref = r['reference']
+    print(f"reference {ref['Nx']}x{ref['Ny']}, dz {ref['dz']*1e6:.2f} µm: {ref['seconds']:.1f} s, "
+          f"focus at {ref['metrics']['z_focus']*1e6:.1f} µm")
+    for t in r['trials']:
+        worst = max(t['drift'], key=lambda name: t['drift'][name] / r['tolerances'][name])
+        print(f"  {t['Nx']:4d}x{t['Ny']:<4d} dz {t['dz']*1e6:.2f} µm: {t['seconds']:6.1f} s, "
+              f"worst {worst} {t['drift'][worst]:.3f}, {'pass' if t['passed'] else 'fail'}")
+    rec = r['recommended']
+    if rec is None:
+        print("no candidate within tolerance")
+    else:
+        print(f"recommended {rec['Nx']}x{rec['Ny']}, dz {rec['dz']*1e6:.2f} µm "
+              f"({ref['seconds'] / next(t['seconds'] for t in r['trials'] if t['passed']):.1f}x faster than the reference)")
@@ -0,0 +1,188 @@
+"""
+Latency and throughput of the warm simulation service.
+
+Starts a SimulationService in a child process on a Unix socket and measures:
+
+- a script run: a fresh interpreter that imports the package, builds the
+  domain, initializes the masks and computes one PSF, as the analysis scripts do;
+- the latency of single PSF requests to the service, the first one (cold
+  service) and then warm ones;
+- the throughput of concurrent clients pipelining PSF requests of beams
+  focused at different depths, with request batching and without it
+  (max_batch=1);
+- a streamed propagation: the time to the first diagnostics record and to
+  the result.
+
+The PSF metrics returned by the service are checked against compute_psf in
+this process.
+
+Run from dti_reference_implementation:
+    python -m benchmark.service_benchmark --N 64 --Nz 60
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.propagators.service import ServiceClient, SimulationService
+
+_SCRIPT = """
+import contextlib, io
+from benchmark.phase_mask_manager import PhaseMaskManager
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+from deep_tissue_imaging.propagators.propagation import compute_psf
+d = build_domain(45e-6, 45e-6, {Nz} * 1e-6, {N}, {N}, {Nz}, laser, tejido, eps=1e-2)
+with contextlib.redirect_stdout(io.StringIO()):
+    compute_psf(campo_tem00(d.X, d.Y, laser.w0, laser.I_peak), tejido, d, PhaseMaskManager({masks!r}))
+"""
+
+
+# Key shared with the child services of this run
+_AUTHKEY = os.urandom(32)
+
+
+def _serve(address, max_batch, authkey):
+    SimulationService(address, authkey, max_batch=max_batch).serve_forever()
+
+
+def _start(address, max_batch):
+    process = multiprocessing.Process(target=_serve, args=(address, max_batch, _AUTHKEY), daemon=True)
+    process.start()
+    return process
+
+
+def _stop(address, process):
+    with ServiceClient(address, _AUTHKEY) as client:
+        client.shutdown()
+    process.join()
+
+
+def _percentile(times, q):
+    return float(np.percentile(times, q)) * 1e3
+
+
+def run_benchmark(N=64, Nz=60, requests=20, clients=4, depths=8):
+    """
+    Measure the service against script runs.
+
+    Parameters:
+        N (int): Grid size (Nx = Ny = N)
+        Nz (int): Number of z-steps of 1 µm
+        requests (int): Sequential warm requests timed
+        clients (int): Concurrent clients of the throughput runs
+        depths (int): Focus depths each client requests, pipelined
+
+    Returns:
+        dict: Times in seconds, latencies in ms, throughputs in requests/s and
+            the max relative deviation of the service's metrics
+    """
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+    from deep_tissue_imaging.propagators.propagation import compute_psf
+
+    # eps=1e-2 with Nz below l_s/dz, where the boundary is stable on these grids
+    domain = {'Lx': 45e-6, 'Ly': 45e-6, 'Lz': Nz * 1e-6, 'Nx': N, 'Ny': N, 'Nz': Nz,
+              'laser': 'fuente_microscopia_1', 'tejido': 'cerebro_emb_pez_cebra', 'eps': 1e-2}
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        masks = os.path.join(tmp, 'masks')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = _SCRIPT.format(N=N, Nz=Nz, masks=masks)
+        subprocess.run([sys.executable, '-c', script], cwd=root, check=True)  # generates the masks
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', script], cwd=root, check=True)
+        result['script_s'] = time.perf_counter() - t0
+
+        address = os.path.join(tmp, 'service.sock')
+        process = _start(address, max_batch=8)
+        with ServiceClient(address, _AUTHKEY) as client:
+            t0 = time.perf_counter()
+            params = client.psf(domain, masks=masks)
+            result['first_ms'] = (time.perf_counter() - t0) * 1e3
+            times = []
+            for _ in range(requests):
+                t0 = time.perf_counter()
+                client.psf(domain, masks=masks)
+                times.append(time.perf_counter() - t0)
+            result['warm_p50_ms'], result['warm_p95_ms'] = _percentile(times, 50), _percentile(times, 95)
+
+            d = build_domain(laser=laser, tejido=tejido, **{k: v for k, v in domain.items()
+                                                              if k not in ('laser', 'tejido')})
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, reference = compute_psf(campo_tem00(d.X, d.Y, laser.w0, laser.I_peak), tejido, d,
+                                           PhaseMaskManager(masks))
+            result['max_rel_dev'] = max(abs(float(params[k]) - float(reference[0][k])) / (abs(float(reference[0][k])) or 1)
+                                        for k in ('fwhm_lateral', 'fwhm_axial', 'radio_80', 'z_focus'))
+
+            t0 = time.perf_counter()
+            first = None
+            for message in client.propagate(domain, masks=masks, every=10, block_size=64 if N % 64 == 0 else N):
+                if first is None:
+                    first = time.perf_counter() - t0
+            result['stream_first_ms'], result['stream_s'] = first * 1e3, time.perf_counter() - t0
+        _stop(address, process)
+
+        def throughput(max_batch):
+            process = _start(address, max_batch)
+            with ServiceClient(address, _AUTHKEY) as client:
+                client.psf(domain, masks=masks)  # warm up
+            latencies = []
+
+            def run_client(c):
+                with ServiceClient(address, _AUTHKEY) as client:
+                    ids = [client.submit('psf', domain=domain, masks=masks,
+                                         beam={'kind': 'focused', 'z': (0.3 + 0.5 * j / depths) * Nz * 1e-6,
+                                               'x0': 1e-6 * c})
+                           for j in range(depths)]
+                    sent = time.perf_counter()
+                    for i in ids:
+                        client.result(i)
+                        latencies.append(time.perf_counter() - sent)
+
+            t0 = time.perf_counter()
+            threads = [threading.Thread(target=run_client, args=(c,)) for c in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - t0
+            with ServiceClient(address, _AUTHKEY) as client:
+                stats = client.stats()
+            _stop(address, process)
+            return clients * depths / seconds, _percentile(latencies, 50), stats
+
+        result['batched_rps'], result['batched_p50_ms'], stats = throughput(8)
+        result['mean_batch'] = stats['requests'] / stats['batches']
+        result['unbatched_rps'], result['unbatched_p50_ms'], _ = throughput(1)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and throughput of the simulation service.")
+    parser.add_argument('--N', type=int, default=64)
+    parser.add_argument('--Nz', type=int, default=60)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=4)
+    args = parser.parse_args()
+
+    r = run_benchmark(args.N, args.Nz, args.requests, args.clients)
+    print(f"{args.N}x{args.N}x{args.Nz}: script run {r['script_s']:.2f} s, first service request {r['first_ms']:.0f} ms, "
+          f"warm requests p50 {r['warm_p50_ms']:.0f} ms, p95 {r['warm_p95_ms']:.0f} ms "
+          f"(metrics max relative deviation {r['max_rel_dev']:.1e})")
+    print(f"  streamed propagation: first record {r['stream_first_ms']:.0f} ms, result {r['stream_s']:.2f} s")
+    print(f"  {args.clients} clients pipelining: batched {r['batched_rps']:.1f} req/s (mean batch {r['mean_batch']:.1f}, "
+          f"p50 {r['batched_p50_ms']:.0f} ms), unbatched {r['unbatched_rps']:.1f} req/s "
+          f"(p50 {r['unbatched_p50_ms']:.0f} ms)")
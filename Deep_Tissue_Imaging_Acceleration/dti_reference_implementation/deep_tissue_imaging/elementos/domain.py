@@ -1,5 +1,8 @@
+import numpy as np
 from numpy import ndarray
 
+from deep_tissue_imaging.elementos.precision import PRECISIONS
+
 class Domain:
     X: ndarray
     Y: ndarray
@@ -14,10 +17,11 @@ class Domain:
     k: float
     sigma_phi: float
     sigma_x: float
+    precision: str
 
     def __init__(self,
                  X, Y, Nx, Ny, Nz, dx, dy, dz, eps,
-                 k0, k, sigma_phi, sigma_x
+                 k0, k, sigma_phi, sigma_x, precision='single'
                  ):
         self.X = X
         self.Y = Y
@@ -32,5 +36,41 @@ class Domain:
         self.k = k
         self.sigma_phi = sigma_phi
         self.sigma_x = sigma_x
+        self.precision = precision
+
+
+
+def build_domain(Lx, Ly, Lz, Nx, Ny, Nz, laser, tejido, eps=1e-12, sigma_x=5e-6, precision='single'):
+    """
+    Build a Domain from the physical sizes and grid resolution.
+
+    The derived constants follow deep_tissue_imaging_1.py: k from the laser
+    wavelength and the tissue index, and sigma_phi from the index fluctuation
+    over one scattering length.
+
+    Parameters:
+        Lx, Ly, Lz (float): Domain size in meters
+        Nx, Ny, Nz (int): Number of grid points (Nz is the number of z-steps)
+        laser: Light source properties (wavelength)
+        tejido: Tissue properties (n_0, Dn, l_s)
+        eps (float): Threshold for the transparent boundary ratios
+        sigma_x (float): Correlation length of the phase masks in meters
+        precision (str): 'single' (float32/complex64) or 'double' (float64/complex128),
+            the dtype of the grids and constants and of the propagated fields (see precision)
 
+    Returns:
+        Domain: The domain
+    """
+    real = PRECISIONS[precision][0]
+    Lx, Ly, Lz = real(Lx), real(Ly), real(Lz)
+    dz = real(Lz / Nz)
+    dx = real(Lx / Nx)
+    dy = real(Ly / Ny)
+    x = np.linspace(-Lx/2, Lx/2, Nx, dtype=real)
+    y = np.linspace(-Ly/2, Ly/2, Ny, dtype=real)
+    X, Y = np.meshgrid(x, y)
 
+    k0 = real(2*np.pi / laser.wavelength)
+    k = real(k0 * tejido.n_0)
+    sigma_phi = real(k * tejido.Dn * tejido.l_s)
+    return Domain(X, Y, Nx, Ny, Nz, dx, dy, dz, real(eps), k0, k, sigma_phi, real(sigma_x), precision)
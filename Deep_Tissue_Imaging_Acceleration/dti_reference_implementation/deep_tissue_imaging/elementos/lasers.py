@@ -1,7 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
 
 
 def campo_tem00(X, Y, w0, I0, fase_inicial=0.0):
@@ -23,6 +20,32 @@ def campo_tem00(X, Y, w0, I0, fase_inicial=0.0):
     return np.complex64(Ex * fase)
 
 
+def campo_gaussiano_enfocado(X, Y, w0, I0, k, z_foco, x0=0.0, y0=0.0):
+    """
+    Genera en z = 0 un haz gaussiano que converge a un foco en z = z_foco.
+
+    El haz es la solución paraxial de los operadores de step_operators,
+    phi = (q_f/q) exp(i k r²/(2q)) con q = (z - z_foco) - i z_R, así que
+    propagado sin tejido alcanza el radio w0 y la intensidad I0 en el foco.
+
+    Parámetros:
+        X, Y (ndarray): mallas 2D con coordenadas espaciales en metros.
+        w0 (float): radio del haz en el foco en metros.
+        I0 (float): intensidad pico en el foco en W/m².
+        k (float): número de onda en el medio (Domain.k).
+        z_foco (float): profundidad del foco en metros.
+        x0, y0 (float): desplazamiento lateral del foco en metros.
+
+    Retorna:
+        ndarray complejo: campo eléctrico complejo E(x,y) en z = 0
+    """
+    z_R = k * w0**2 / 2
+    q_foco = -1j * z_R
+    q = -z_foco + q_foco
+    R2 = (X - x0)**2 + (Y - y0)**2
+    return np.complex64(np.sqrt(I0) * (q_foco / q) * np.exp(1j * k * R2 / (2 * q)))
+
+
 class fuente_microscopia_1:
     wavelength = np.float32(800e-9)  # m longitud onda
     w0 = np.float32(3e-6)  # m beam waist 3um
@@ -31,6 +54,9 @@ class fuente_microscopia_1:
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+
     # Parámetros del haz
     w0 = fuente_microscopia_1.w0  # Radio del haz en metros (3 µm)
     I0 = fuente_microscopia_1.I_peak   # Intensidad pico en W/m²
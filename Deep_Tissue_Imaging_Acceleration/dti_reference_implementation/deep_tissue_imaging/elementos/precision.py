@@ -0,0 +1,182 @@
+"""
+Floating point precision policy of a run, and a sentinel for silent casts.
+
+A Domain carries a precision: 'single' (float32/complex64, production and
+the overlays) or 'double' (float64/complex128, reference). build_domain
+makes the grids and constants in that precision, the propagation entry
+points cast the input field to it, and the step operators keep the dtype of
+the field they get: their scalar constants come from `field_types(phi)`
+instead of a fixed np.float32/np.complex64.
+
+One missed wrapper (a float64 constant times a complex64 field) promotes a
+whole operator to double and doubles its memory traffic without any error;
+a hard-coded np.complex64 buffer silently truncates a double run.
+`PrecisionSentinel` is the debug check for both. While active, it inspects
+every function of the hot loop modules as it returns: the return value and
+the local variables. It records each floating array or NumPy scalar whose
+precision differs from the policy; narrower NumPy scalars are let through,
+since the tissue constants are float32 and any array they meet promotes
+them. Temporaries that are never bound to a name aren't seen, but a cast
+one changes the value it flows into:
+
+    with PrecisionSentinel('single') as sentinel:
+        full_propagation_within_tissue(phi, tejido, d)
+    sentinel.check()
+"""
+
+import logging
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Real and complex types of each policy
+PRECISIONS = {
+    'single': (np.float32, np.complex64),
+    'double': (np.float64, np.complex128),
+}
+
+# Modules of the propagation loop watched by PrecisionSentinel
+HOT_LOOP = (
+    'deep_tissue_imaging.propagators.step_operators',
+    'deep_tissue_imaging.propagators.partitioned_solver',
+    'deep_tissue_imaging.propagators.propagation',
+    'deep_tissue_imaging.propagators.spectral',
+    'deep_tissue_imaging.propagators.layered_plan',
+    'deep_tissue_imaging.propagators.roi_propagation',
+    'deep_tissue_imaging.propagators.field_cache',
+    'deep_tissue_imaging.propagators.transmission_matrix',
+    'deep_tissue_imaging.propagators.multiresolution',
+    'deep_tissue_imaging.propagators.realizations',
+    'deep_tissue_imaging.propagators.service',
+    'deep_tissue_imaging.propagators.adjoint',
+    'deep_tissue_imaging.hardware.diffraction_backend',
+    'benchmark.phase_mask_manager',
+)
+
+# Functions of the watched modules that compute in double on purpose, whatever
+# the policy: the multi-resolution planner's estimates and resampling weights
+OFF_LOOP = (
+    'deep_tissue_imaging.propagators.multiresolution.resampling_matrix',
+    'deep_tissue_imaging.propagators.multiresolution._keys',
+    'deep_tissue_imaging.propagators.multiresolution._edge_fraction',
+    'deep_tissue_imaging.propagators.multiresolution._fd_wavenumber2',
+    'deep_tissue_imaging.propagators.multiresolution._phase_spread',
+)
+
+
+def precision_types(d):
+    """(real, complex) types of a domain's policy; 'single' for domains without one."""
+    return PRECISIONS[getattr(d, 'precision', 'single')]
+
+
+def field_types(phi):
+    """(real, complex) types matching a field's precision (complex64 for float32 or complex64 fields)."""
+    complex_type = np.result_type(phi, np.complex64).type
+    return np.finfo(complex_type).dtype.type, complex_type
+
+
+def _floating_dtype(value):
+    if isinstance(value, (np.ndarray, np.generic)) and value.dtype.kind in 'fc':
+        return value.dtype
+    return None
+
+
+class PrecisionSentinel:
+    """
+    Records the functions of the hot loop whose values leave a precision policy.
+
+    Runs as a trace function (sys.settrace) while the context is active, so it
+    slows the loop down and displaces debuggers or coverage tools: a debug
+    check, not something to leave on in a sweep.
+
+    A value wider or narrower than the policy propagates to everything
+    downstream of it, so a function is marked as an origin when its arguments
+    were within the policy and its locals or return value were not, unless a
+    watched function it called did the same: the cast happened in it or in a
+    call outside the watched modules.
+
+    Parameters:
+        precision (str): Policy, a key of PRECISIONS
+        modules (tuple): Module names (prefixes) whose functions are inspected
+        skip (tuple): Qualified names of functions of those modules left out
+
+    Attributes:
+        violations (dict): (module, function) -> {'values' ({name: dtype}, '<return>'
+            for the return value), 'line', 'count', 'origin'}, in order of detection
+    """
+
+    def __init__(self, precision='single', modules=HOT_LOOP, skip=OFF_LOOP):
+        self.precision = precision
+        self.bits = np.finfo(PRECISIONS[precision][0]).bits
+        self.modules = tuple(modules)
+        self.skip = frozenset(skip)
+        self.violations = {}
+        self._fed = set()
+
+    def __enter__(self):
+        self._previous = sys.gettrace()
+        sys.settrace(self._call)
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(self._previous)
+        return False
+
+    def _violates(self, value):
+        dtype = _floating_dtype(value)
+        if dtype is None:
+            return False
+        bits = np.finfo(dtype).bits
+        return bits > self.bits or (bits < self.bits and isinstance(value, np.ndarray))
+
+    def _call(self, frame, event, arg):
+        module = frame.f_globals.get('__name__', '')
+        if not module.startswith(self.modules) or f'{module}.{frame.f_code.co_name}' in self.skip:
+            return None
+        frame.f_trace_lines = False
+        code = frame.f_code
+        arguments = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+        off_arguments = any(self._violates(frame.f_locals.get(name)) for name in arguments)
+
+        def on_return(frame, event, arg):
+            if event == 'return':
+                values = list(frame.f_locals.items())
+                values += [('<return>', value) for value in (arg if isinstance(arg, tuple) else (arg,))]
+                off = {name: str(value.dtype) for name, value in values if self._violates(value)}
+                fed = id(frame) in self._fed
+                self._fed.discard(id(frame))
+                if off:
+                    self._record(frame, off, not (off_arguments or fed))
+                    if not off_arguments:
+                        # The off-policy values of the caller came from here
+                        self._fed.add(id(frame.f_back))
+            return on_return
+        return on_return
+
+    def _record(self, frame, off, origin):
+        key = (frame.f_globals['__name__'], frame.f_code.co_name)
+        if key not in self.violations:
+            self.violations[key] = {'values': {}, 'line': frame.f_lineno, 'count': 0, 'origin': False}
+            logger.warning("precision %s no respetada en %s.%s: %s", self.precision, key[0], key[1],
+                           ", ".join(f"{name} {dtype}" for name, dtype in off.items()),
+                           extra={'precision': self.precision, 'values': off, 'origin': origin})
+        violation = self.violations[key]
+        violation['values'].update(off)
+        violation['count'] += 1
+        violation['origin'] = violation['origin'] or origin
+
+    def report(self):
+        """The violations, origins first, one line per function."""
+        if not self.violations:
+            return f"precision {self.precision}: all values follow the policy"
+        ordered = sorted(self.violations.items(), key=lambda item: not item[1]['origin'])
+        return "\n".join(f"{'origin ' if v['origin'] else '       '}{module}.{function} (line {v['line']}, "
+                         f"{v['count']} calls): " + ", ".join(f"{name} {dtype}" for name, dtype in v['values'].items())
+                         for (module, function), v in ordered)
+
+    def check(self):
+        """Raise TypeError if any value left the policy."""
+        if self.violations:
+            raise TypeError(f"Values outside the {self.precision} precision policy:\n{self.report()}")
@@ -0,0 +1,276 @@
+"""
+Headless rendering of propagation histories to image files.
+
+Unlike `plotting`, nothing here needs an interactive backend: per-slice
+frames are written as 8-bit palette PNGs with Pillow (colormap lookup, no
+figure or axes), the XZ/YZ cross-section figure is drawn on an Agg canvas, and
+animations are assembled from the frames with Pillow. Frames are rendered
+across a process pool; a history given as a `.npy` path (or a memmap loaded
+from one) or as a history_store file is opened by every worker instead of
+being sent to it.
+
+Run from dti_reference_implementation:
+    python -m deep_tissue_imaging.elementos.render phi_history.npy previews --log --gif
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.history_store import HistoryFile
+
+LOG_FLOOR = 1e-6  # Log scaling floor, relative to the maximum intensity
+
+
+def _open_history(source):
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        return HistoryFile(source)
+    return source
+
+
+def _source_of(history):
+    """Picklable handle of the history: the file of memmaps and history files, else the array itself."""
+    if isinstance(history, HistoryFile):
+        return str(history.path)
+    filename = getattr(history, 'filename', None)
+    if isinstance(history, np.memmap) and filename and str(filename).endswith('.npy'):
+        return str(filename)
+    return history
+
+
+def history_grid(history):
+    """
+    Spatial meshgrids and z positions of a history from its run metadata.
+
+    Parameters:
+        history: A HistoryFile (or anything with a `metadata` dict as in run_metadata)
+
+    Returns:
+        tuple: (X, Y, z_positions) in meters, or None if the history carries no domain
+    """
+    domain = getattr(history, 'metadata', {}).get('domain')
+    if domain is None:
+        return None
+    n, ny, nx = history.shape
+    # build_domain samples linspace(-L/2, L/2, N) with dx = L/N
+    x_end, y_end = nx * domain['dx'] / 2, ny * domain['dy'] / 2
+    X, Y = np.meshgrid(np.linspace(-x_end, x_end, nx), np.linspace(-y_end, y_end, ny))
+    # A budgeted history keeps only some planes (see memory_budget.BudgetedHistory)
+    planes = np.asarray(history.metadata.get('planes', np.arange(n)))
+    return X, Y, planes * domain['dz']
+
+
+def intensity(phi):
+    """Intensity |phi|^2 as float32, without the complex abs."""
+    if np.iscomplexobj(phi):
+        return (phi.real**2 + phi.imag**2).astype(np.float32, copy=False)
+    return np.asarray(phi, dtype=np.float32)
+
+
+def _scale(I, log, vmax):
+    if log:
+        return np.log10(np.maximum(I, vmax * LOG_FLOOR))
+    return I
+
+
+def intensity_range(history, chunk=32):
+    """Maximum intensity over the whole history, read `chunk` slices at a time."""
+    history = _open_history(history)
+    return max(float(intensity(history[i:i + chunk]).max()) for i in range(0, history.shape[0], chunk))
+
+
+def cross_sections(history, row=None, col=None, chunk=32):
+    """
+    XZ and YZ intensity cross-sections of a history.
+
+    Parameters:
+        history (ndarray or str): History of shape (Nz+1, Ny, Nx), a HistoryFile or a file path
+        row (int, optional): Row (y index) of the XZ section; centre by default
+        col (int, optional): Column (x index) of the YZ section; centre by default
+        chunk (int): Number of slices read at a time
+
+    Returns:
+        tuple: (xz, yz) intensities of shapes (Nz+1, Nx) and (Nz+1, Ny)
+    """
+    history = _open_history(history)
+    n, ny, nx = history.shape
+    row = ny // 2 if row is None else row
+    col = nx // 2 if col is None else col
+    xz = np.empty((n, nx), dtype=np.float32)
+    yz = np.empty((n, ny), dtype=np.float32)
+    for i in range(0, n, chunk):
+        block = history[i:i + chunk]
+        xz[i:i + chunk] = intensity(block[:, row, :])
+        yz[i:i + chunk] = intensity(block[:, :, col])
+    return xz, yz
+
+
+def save_cross_sections(history, X, Y, z_positions, path, log=False, row=None, col=None, pixels=False):
+    """
+    Write a figure with the XZ and YZ intensity cross-sections of a history.
+
+    Parameters:
+        history (ndarray or str): History of shape (Nz+1, Ny, Nx), a HistoryFile or a file path
+        X, Y (ndarray): Spatial meshgrids (in meters, or pixels)
+        z_positions (ndarray): The z positions in meters (or planes)
+        path (str): Output image path (format from the extension)
+        log (bool): Plot log10 of the intensity
+        row, col (int, optional): Indices of the sections; centre by default
+        pixels (bool): X, Y and z_positions are in pixels and planes, for a
+            history without a grid
+
+    Returns:
+        str: The output path
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    xz, yz = cross_sections(history, row, col)
+    vmax = max(xz.max(), yz.max())
+    scale, unit = (1, 'px') if pixels else (1e6, 'μm')
+    z_um = np.asarray(z_positions) * scale
+
+    fig = Figure(figsize=(12, 5))
+    FigureCanvasAgg(fig)
+    for i, (section, coords, label) in enumerate(((xz, X[0, :], 'X'), (yz, Y[:, 0], 'Y'))):
+        ax = fig.add_subplot(1, 2, i + 1)
+        extent = [z_um[0], z_um[-1], coords[0] * scale, coords[-1] * scale]
+        im = ax.imshow(_scale(section, log, vmax).T, extent=extent, origin='lower',
+                       aspect='auto', cmap='viridis')
+        fig.colorbar(im, ax=ax, label='log10 Intensity (W/m²)' if log else 'Intensity (W/m²)')
+        ax.set_xlabel(f'Z ({unit})')
+        ax.set_ylabel(f'{label} ({unit})')
+        ax.set_title(f'{label}Z Intensity')
+    fig.tight_layout()
+    fig.savefig(path)
+    return path
+
+
+def _palette(cmap):
+    from matplotlib import colormaps
+
+    return (colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8).reshape(-1)
+
+
+def _render_slices(slices, paths, log, vmax, cmap):
+    from PIL import Image
+
+    palette = _palette(cmap)
+    vmin = np.log10(vmax * LOG_FLOOR) if log else 0.0
+    vtop = np.log10(vmax) if log else vmax
+    for phi, path in zip(slices, paths):
+        # 8-bit colormap indices in a palette image: no RGB expansion and fast PNG encoding
+        level = (_scale(intensity(phi), log, vmax) - vmin) * (255 / (vtop - vmin))
+        image = Image.fromarray(np.clip(level, 0, 255).astype(np.uint8)[::-1], mode='P')
+        image.putpalette(palette)
+        image.save(path, compress_level=1)
+    return len(paths)
+
+
+def _render_chunk(source, indices, paths, log, vmax, cmap):
+    """Worker entry: `source` is a history file path (indexed by `indices`) or the selected slices."""
+    if isinstance(source, str):
+        history = _open_history(source)
+        slices = (history[i] for i in indices)
+    else:
+        slices = source
+    return _render_slices(slices, paths, log, vmax, cmap)
+
+
+def render_frames(history, out_dir, log=False, stride=1, workers=None, cmap='viridis', prefix='frame'):
+    """
+    Render one PNG per z-slice of a history with a common color scale.
+
+    Parameters:
+        history (ndarray or str): History of shape (Nz+1, Ny, Nx), a memmap, a HistoryFile,
+            or the path of a .npy or history_store file
+        out_dir (str): Output directory (created if needed)
+        log (bool): Render log10 of the intensity
+        stride (int): Render every `stride`-th slice
+        workers (int, optional): Number of worker processes; os.cpu_count() by default,
+            1 renders in this process
+        cmap (str): Matplotlib colormap name
+        prefix (str): File name prefix of the frames
+
+    Returns:
+        list: Paths of the rendered frames, in z order
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    source = _source_of(history)
+    history = _open_history(source)
+    vmax = intensity_range(history)
+
+    indices = list(range(0, history.shape[0], stride))
+    paths = [os.path.join(out_dir, f'{prefix}_{i:05d}.png') for i in indices]
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        _render_slices((history[i] for i in indices), paths, log, vmax, cmap)
+        return paths
+
+    n_chunks = min(len(indices), workers * 4)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for chunk in np.array_split(np.arange(len(indices)), n_chunks):
+            chunk_indices = [indices[c] for c in chunk]
+            # Workers open a .npy history themselves; otherwise only the slices of the chunk are sent
+            chunk_source = source if isinstance(source, str) else history[chunk_indices]
+            futures.append(pool.submit(_render_chunk, chunk_source, chunk_indices,
+                                       [paths[c] for c in chunk], log, vmax, cmap))
+        for future in futures:
+            future.result()
+    return paths
+
+
+def render_animation(frame_paths, path, fps=15):
+    """
+    Assemble rendered frames into an animated GIF.
+
+    Parameters:
+        frame_paths (list): Frame image paths in order (from render_frames)
+        path (str): Output .gif path
+        fps (int): Frames per second
+
+    Returns:
+        str: The output path
+    """
+    from PIL import Image
+
+    # Frames are palette images already, so no color quantization is needed
+    frames = [Image.open(p) for p in frame_paths]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=int(1000 / fps), loop=0)
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Render a propagation history to PNG frames.")
+    parser.add_argument('history', help="History .npy file of shape (Nz+1, Ny, Nx) or history_store file")
+    parser.add_argument('out_dir')
+    parser.add_argument('--log', action='store_true', help="log10 intensity scale")
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--gif', action='store_true', help="Also write animation.gif")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    os.makedirs(args.out_dir, exist_ok=True)
+    history = _open_history(args.history)
+    grid = history_grid(history)
+    pixels = grid is None
+    if pixels:
+        # A .npy file carries no grid: sections are drawn in pixel units
+        n, ny, nx = history.shape
+        X, Y = np.meshgrid(np.arange(nx), np.arange(ny))
+        grid = (X, Y, np.arange(n))
+    save_cross_sections(history, *grid, os.path.join(args.out_dir, 'cross_sections.png'), log=args.log,
+                        pixels=pixels)
+    frames = render_frames(history, args.out_dir, args.log, args.stride, args.workers)
+    if args.gif:
+        render_animation(frames, os.path.join(args.out_dir, 'animation.gif'))
+    print(f"Rendered {len(frames)} frames in {time.perf_counter() - t0:.2f} s")
@@ -0,0 +1,290 @@
+"""
+SQLite store of sweep results, deduplicated by a hash of the configuration.
+
+A run is keyed by `config_key`: a SHA-256 over the canonical JSON of its
+domain, tissue and laser constants (see history_store.run_metadata), the
+content of its phase masks, the code version and any extra parameters
+(input beam, backend, ...). A row holds the PSF metrics, the run timings,
+the path of any stored fields (e.g. a history_store file) and a campaign
+label. A sweep asks `ResultsDB.missing` for the keys without results and
+only runs those.
+
+Pool workers can write concurrently: every call opens its own connection
+(connections don't survive a fork), the database runs in WAL mode so
+readers don't block the writer, and writers wait up to `timeout` seconds for
+the lock. The first result stored under a key wins; later ones are ignored.
+
+Metrics and configurations are JSON columns, so campaigns can be queried
+with SQLite's JSON functions:
+
+    db.query("campaign = ? AND json_extract(metrics, '$.fwhm_lateral') < ?", ('n2', 4e-6))
+"""
+
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.history_store import run_metadata
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT PRIMARY KEY,
+    campaign TEXT,
+    created REAL,
+    code_version TEXT,
+    config TEXT,
+    metrics TEXT,
+    timings TEXT,
+    fields TEXT
+)
+"""
+
+_COLUMNS = ('key', 'campaign', 'created', 'code_version', 'config', 'metrics', 'timings', 'fields')
+
+# Packages whose sources a run depends on: the metrics (medir_psf_params) and the
+# phase masks (phase_mask_manager) live in benchmark
+_CODE_PACKAGES = ('deep_tissue_imaging', 'benchmark')
+
+_code_version = None
+
+
+def code_version():
+    """Hash of the sources of the deep_tissue_imaging and benchmark packages (computed once per process)."""
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        h = hashlib.sha256()
+        paths = [path for package in _CODE_PACKAGES
+                 for path in glob.glob(os.path.join(root, package, '**', '*.py'), recursive=True)]
+        for path in sorted(paths):
+            h.update(os.path.relpath(path, root).encode())
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()[:16]
+    return _code_version
+
+
+def _jsonable(value):
+    """Plain JSON types from medir_psf_params-style results (numpy scalars, float keys)."""
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def run_config(d, tejido, laser, mask_manager=None, **extra):
+    """
+    Canonical configuration of a run.
+
+    Parameters:
+        d: Domain properties
+        tejido: Tissue properties
+        laser: Light source properties
+        mask_manager (PhaseMaskManager, optional): Masks of the run, hashed by content
+            (initialized on d if needed); without it the run draws random masks
+        **extra: Other parameters of the run (JSON-serializable)
+
+    Returns:
+        dict: The configuration
+    """
+    config = run_metadata(d, tejido, laser, **_jsonable(extra))
+    if mask_manager is None:
+        config['masks'] = 'random'
+    else:
+        if not mask_manager.masks:
+            mask_manager.initialize_masks(d.X.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+        config['masks'] = {str(i): hashlib.sha256(np.ascontiguousarray(theta).tobytes()).hexdigest()
+                           for i, theta in sorted(mask_manager.masks.items())}
+    return config
+
+
+def config_key(config, version=None):
+    """
+    Key of a configuration from run_config.
+
+    Parameters:
+        config (dict): The configuration
+        version (str, optional): Code version; code_version() by default
+
+    Returns:
+        str: Hex digest
+    """
+    # Parameter classes are identified by their constants, not their names
+    config = {name: {k: v for k, v in value.items() if k != 'name'} if name in ('tejido', 'laser') else value
+              for name, value in config.items()}
+    canonical = json.dumps([config, version or code_version()], sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultsDB:
+    """
+    Results of a sweep in an SQLite file.
+
+    Parameters:
+        path (str): Database file (created if needed)
+        timeout (float): Seconds a writer waits for the lock
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute(_SCHEMA)
+            con.execute('CREATE INDEX IF NOT EXISTS runs_campaign ON runs (campaign)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """A connection for one transaction, committed and closed on exit."""
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def put(self, key, config, metrics, timings=None, fields=None, campaign=None, version=None):
+        """
+        Store the results of a run.
+
+        Parameters:
+            key (str): Key from config_key
+            config (dict): Configuration from run_config
+            metrics (dict): PSF metrics (e.g. medir_psf_params output)
+            timings (dict, optional): Wall times in seconds
+            fields (str, optional): Path of the stored fields
+            campaign (str, optional): Campaign label
+            version (str, optional): Code version; code_version() by default
+
+        Returns:
+            bool: True if stored, False if the key already had results
+        """
+        row = (key, campaign, time.time(), version or code_version(), json.dumps(_jsonable(config)),
+               json.dumps(_jsonable(metrics)), json.dumps(_jsonable(timings or {})),
+               None if fields is None else str(fields))
+        with self._connect() as con:
+            cursor = con.execute(f"INSERT OR IGNORE INTO runs VALUES ({', '.join('?' * len(_COLUMNS))})", row)
+        return cursor.rowcount == 1
+
+    def get(self, key):
+        """The results stored under a key as a dict, or None."""
+        rows = self.query('key = ?', (key,))
+        return rows[0] if rows else None
+
+    def __contains__(self, key):
+        with self._connect() as con:
+            return con.execute('SELECT 1 FROM runs WHERE key = ?', (key,)).fetchone() is not None
+
+    def missing(self, keys):
+        """The keys without results, in their order."""
+        keys = list(keys)
+        with self._connect() as con:
+            con.execute('CREATE TEMP TABLE wanted (key TEXT)')
+            con.executemany('INSERT INTO wanted VALUES (?)', ((k,) for k in keys))
+            found = {k for (k,) in con.execute('SELECT key FROM runs WHERE key IN (SELECT key FROM wanted)')}
+        return [k for k in keys if k not in found]
+
+    def query(self, where='1', params=(), order='created'):
+        """
+        Rows matching an SQL condition, with the JSON columns decoded.
+
+        Parameters:
+            where (str): Condition on the columns (key, campaign, created,
+                code_version, config, metrics, timings, fields)
+            params (tuple): Parameters of the condition
+            order (str): ORDER BY expression
+
+        Returns:
+            list: One dict per row
+        """
+        with self._connect() as con:
+            rows = con.execute(f"SELECT {', '.join(_COLUMNS)} FROM runs WHERE {where} ORDER BY {order}",
+                               params).fetchall()
+        results = []
+        for row in rows:
+            result = dict(zip(_COLUMNS, row))
+            for column in ('config', 'metrics', 'timings'):
+                result[column] = json.loads(result[column])
+            results.append(result)
+        return results
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+
+def _sweep_worker(args):
+    """Run one configuration of the demo sweep and store it."""
+    db_path, n2, peak = args
+    import io
+
+    from benchmark.medir_psf_params import medir_psf_params
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra
+    from deep_tissue_imaging.propagators.propagation import full_propagation_within_tissue
+
+    tejido = type('tejido', (cerebro_emb_pez_cebra,), {'n2': np.float32(n2)})
+    laser = type('laser', (fuente_microscopia_1,), {'I_peak': np.float32(peak)})
+    d = build_domain(45e-6, 45e-6, 60e-6, 64, 64, 60, laser, tejido, eps=1e-2)
+    masks = PhaseMaskManager(os.path.join(os.path.dirname(db_path), 'masks'))
+    config = run_config(d, tejido, laser, masks, beam='campo_tem00')
+    key = config_key(config)
+
+    t0 = time.perf_counter()
+    history = full_propagation_within_tissue(campo_tem00(d.X, d.Y, laser.w0, laser.I_peak), tejido, d, masks)
+    seconds = time.perf_counter() - t0
+    with contextlib.redirect_stdout(io.StringIO()):
+        metrics = medir_psf_params(history[-1], d.X, d.Y, history, np.arange(d.Nz + 1) * d.dz)
+    return ResultsDB(db_path).put(key, config, metrics, {'propagation_s': seconds}, campaign='demo')
+
+
+if __name__ == "__main__":
+    import tempfile
+    from multiprocessing import Pool
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'results.sqlite')
+        db = ResultsDB(db_path)
+        # The masks are generated once, before the workers share them
+        from benchmark.phase_mask_manager import PhaseMaskManager
+        from deep_tissue_imaging.elementos.domain import build_domain
+        from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1
+        from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra
+        d = build_domain(45e-6, 45e-6, 60e-6, 64, 64, 60, fuente_microscopia_1, cerebro_emb_pez_cebra)
+        PhaseMaskManager(os.path.join(tmp, 'masks')).initialize_masks(d.X.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+        configs = [(db_path, n2, peak) for n2 in (2.5e-20, 1e-19, 4e-19) for peak in (1e13, 1e14)]
+
+        # Every configuration twice, from 4 workers at once: the duplicates are ignored
+        t0 = time.perf_counter()
+        with Pool(4) as pool:
+            stored = pool.map(_sweep_worker, configs + configs)
+        print(f"{len(configs)} configurations, each submitted twice: {sum(stored)} stored, "
+              f"{len(db)} rows, {time.perf_counter() - t0:.1f} s")
+
+        rows = db.query('campaign = ?', ('demo',), order="json_extract(config, '$.tejido.n2'), created")
+        for row in rows:
+            print(f"  n2 {row['config']['tejido']['n2']:.1e}, peak {row['config']['laser']['I_peak']:.0e}: "
+                  f"lateral FWHM {row['metrics']['fwhm_lateral'] * 1e6:.2f} µm, "
+                  f"{row['timings']['propagation_s']:.2f} s")
+
+        t0 = time.perf_counter()
+        keys = []
+        for _, n2, peak in configs + [(db_path, 2.5e-20, 1e15)]:
+            tejido = type('tejido', (cerebro_emb_pez_cebra,), {'n2': np.float32(n2)})
+            laser = type('laser', (fuente_microscopia_1,), {'I_peak': np.float32(peak)})
+            d = build_domain(45e-6, 45e-6, 60e-6, 64, 64, 60, laser, tejido, eps=1e-2)
+            keys.append(config_key(run_config(d, tejido, laser, PhaseMaskManager(os.path.join(tmp, 'masks')),
+                                              beam='campo_tem00')))
+        print(f"re-planning the sweep plus one new peak: {len(db.missing(keys))} of {len(keys)} to run "
+              f"({(time.perf_counter() - t0) * 1e3:.0f} ms)")
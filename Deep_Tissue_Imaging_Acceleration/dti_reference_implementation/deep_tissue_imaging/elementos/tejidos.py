@@ -8,3 +8,11 @@ class cerebro_emb_pez_cebra:
     alpha = np.float32(0.3) # mm*-1
     beta = np.float32(1e-11) # m/W
     n2 = np.float32(3e-20) # m²/W
+
+class materia_blanca:
+    n_0 = np.float32(1.37) # Agua + lípidos, Tuchin 2007
+    Dn = np.float32(0.02) # ±0.02	Dif. entre membranas y citosol
+    l_s = np.float32(100e-6) # 	100 μm	Scattering forward, típico de white matter
+    alpha = np.float32(0.2) # mm*-1
+    beta = np.float32(1.5e-11) # m/W
+    n2 = np.float32(2.5e-20) # m²/W
@@ -0,0 +1,5 @@
+"""
+Hardware package for deep tissue imaging.
+Contains the PYNQ overlay backends for the propagation operators and an
+in-process stand-in of pynq for developing the host pipeline off-board.
+"""
@@ -0,0 +1,132 @@
+"""
+Pool of reusable DMA buffers.
+
+Buffers are allocated once per (shape, dtype) with pynq.allocate (or
+mock_pynq.allocate off-board) and handed out again after release, so z-steps
+reuse the same contiguous memory. Each PooledBuffer exposes zero-copy views of
+its memory with the field shape, and tracks which side last wrote it so that
+cache flushes and invalidates are only issued when they are needed.
+"""
+
+import contextlib
+
+import numpy as np
+
+
+class PooledBuffer:
+    """
+    Contiguous DMA buffer handed out by a DMABufferPool.
+
+    The ownership protocol is: access the memory from the host through
+    `view`, call `for_device()` before a kernel reads it, call
+    `mark_device_write()` after a kernel wrote it, and `for_host()` (or `view`,
+    which calls it) before reading it on the host again.
+
+    Parameters:
+        buffer: Flat buffer returned by the allocator
+        shape (tuple): Shape of the views handed to the host
+    """
+
+    def __init__(self, buffer, shape):
+        self.buffer = buffer
+        self.shape = tuple(shape)
+        self.flushes = 0
+        self.invalidates = 0
+        self._host_dirty = False
+        self._device_dirty = False
+
+    @property
+    def physical_address(self):
+        return self.buffer.physical_address
+
+    @property
+    def view(self):
+        """Zero-copy host view with `shape`; the host is assumed to write through it."""
+        self.for_host()
+        self._host_dirty = True
+        return np.asarray(self.buffer).reshape(self.shape)
+
+    def read(self):
+        """Zero-copy read-only host view with `shape`."""
+        self.for_host()
+        view = np.asarray(self.buffer).reshape(self.shape)
+        view.flags.writeable = False
+        return view
+
+    def write(self, array):
+        """Copy `array` into the buffer."""
+        np.copyto(self.view, array.reshape(self.shape))
+
+    def for_device(self):
+        """Flush the host cache if the host wrote the buffer since the last flush."""
+        if self._host_dirty:
+            self.buffer.flush()
+            self.flushes += 1
+            self._host_dirty = False
+
+    def mark_device_write(self):
+        """Record that a kernel wrote the buffer."""
+        self._device_dirty = True
+
+    def for_host(self):
+        """Invalidate the host cache if a kernel wrote the buffer since the last invalidate."""
+        if self._device_dirty:
+            self.buffer.invalidate()
+            self.invalidates += 1
+            self._device_dirty = False
+
+
+class DMABufferPool:
+    """
+    Pool of DMA buffers keyed by shape and dtype.
+
+    Parameters:
+        allocate (callable): pynq.allocate or mock_pynq.allocate
+    """
+
+    def __init__(self, allocate):
+        self.allocate = allocate
+        self._free = {}
+        self.allocations = 0
+        self.reuses = 0
+
+    def acquire(self, shape, dtype=np.complex64):
+        """
+        Get a buffer holding an array of the given shape and dtype.
+
+        Parameters:
+            shape (tuple): Shape of the host views (e.g. (Ny, Nx))
+            dtype (dtype): Element type
+
+        Returns:
+            PooledBuffer: A free buffer from the pool, or a new one
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        free = self._free.get(key)
+        if free:
+            self.reuses += 1
+            return free.pop()
+        self.allocations += 1
+        buffer = self.allocate(shape=(int(np.prod(shape)),), dtype=dtype)
+        return PooledBuffer(buffer, shape)
+
+    def release(self, pooled):
+        """Return a buffer to the pool for reuse."""
+        key = (pooled.shape, np.dtype(pooled.buffer.dtype))
+        self._free.setdefault(key, []).append(pooled)
+
+    @contextlib.contextmanager
+    def borrow(self, shape, dtype=np.complex64):
+        """Context manager acquiring a buffer and releasing it on exit."""
+        pooled = self.acquire(shape, dtype)
+        try:
+            yield pooled
+        finally:
+            self.release(pooled)
+
+    def free(self):
+        """Free the memory of every buffer currently in the pool."""
+        for buffers in self._free.values():
+            for pooled in buffers:
+                pooled.buffer.freebuffer()
+        self._free = {}
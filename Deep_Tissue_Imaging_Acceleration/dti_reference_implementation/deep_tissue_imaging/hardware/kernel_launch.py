@@ -0,0 +1,169 @@
+"""
+Kernel launches with awaitable completion.
+
+`KernelLauncher` starts an HLS kernel through its control register and waits
+for ap_done without spinning: it awaits the IP interrupt when one is wired and
+otherwise polls with an adaptive back-off. `KernelQueue` serializes pending
+launches on one IP so the host can keep working (nonlinear operators, mask
+application, other fields) while the fabric computes.
+"""
+
+import asyncio
+import time
+
+# Bits of the HLS block-level control register (ap_ctrl_hs)
+AP_START = 0x1
+AP_DONE = 0x2
+AP_IDLE = 0x4
+
+# Interrupt registers of the HLS AXI-lite adapter
+AP_GIE = 0x04  # Global interrupt enable
+AP_IER = 0x08  # IP interrupt enable (bit 0: ap_done)
+AP_ISR = 0x0C  # IP interrupt status, toggle-on-write
+
+
+class KernelLauncher:
+    """
+    Start an HLS kernel and wait for its completion.
+
+    Parameters:
+        ip: IP handle with `read(offset)` and `write(offset, value)`
+        ctrl (int): Offset of the control register
+        interrupt (optional): Object with an awaitable `wait()` (pynq.Interrupt);
+            if None the control register is polled
+        poll_min (float): Shortest polling interval in seconds
+        poll_max (float): Longest polling interval in seconds
+    """
+
+    def __init__(self, ip, ctrl=0x00, interrupt=None, poll_min=1e-5, poll_max=1e-3):
+        self.ip = ip
+        self.ctrl = ctrl
+        self.interrupt = interrupt
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.last_duration = None
+        self.polls = 0
+
+        if interrupt is not None:
+            self.ip.write(AP_GIE, 1)
+            self.ip.write(AP_IER, 1)
+
+    def _delays(self):
+        """Polling intervals: half the last kernel time first, then exponential back-off."""
+        if self.last_duration is not None:
+            yield min(self.poll_max, self.last_duration / 2)
+        delay = self.poll_min
+        while True:
+            yield delay
+            delay = min(self.poll_max, delay * 2)
+
+    def _done(self):
+        self.polls += 1
+        return (self.ip.read(self.ctrl) & AP_DONE) != 0
+
+    async def wait(self):
+        """Await ap_done of the running kernel."""
+        if self.interrupt is not None:
+            await self.interrupt.wait()
+            self.ip.write(AP_ISR, 1)
+            return
+        delays = self._delays()
+        while not self._done():
+            await asyncio.sleep(next(delays))
+
+    def wait_sync(self):
+        """Block until ap_done, sleeping between polls instead of spinning."""
+        delays = self._delays()
+        while not self._done():
+            time.sleep(next(delays))
+        if self.interrupt is not None:
+            self.ip.write(AP_ISR, 1)
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        self.ip.write(self.ctrl, AP_START)
+
+    def _finished(self):
+        self.last_duration = time.perf_counter() - self._t0
+
+    async def launch(self):
+        """Start the kernel (arguments already programmed) and await its completion."""
+        self.start()
+        await self.wait()
+        self._finished()
+
+    def launch_sync(self):
+        """Start the kernel (arguments already programmed) and block until it finishes."""
+        self.start()
+        self.wait_sync()
+        self._finished()
+
+
+class KernelQueue:
+    """
+    FIFO of pending launches on one kernel.
+
+    A job is a coroutine function taking the KernelLauncher; it programs the
+    arguments, awaits `launcher.launch()` as many times as it needs and returns
+    its result. Jobs run one at a time in submission order, and `submit`
+    returns a future the caller can await while doing other work.
+
+    Parameters:
+        launcher (KernelLauncher): Launcher of the kernel shared by the jobs
+    """
+
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self._queue = None
+        self._worker = None
+        self._loop = None
+
+    @property
+    def pending(self):
+        """Number of jobs waiting to start."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def submit(self, job):
+        """
+        Queue a job for execution.
+
+        Parameters:
+            job (coroutine function): async callable receiving the launcher
+
+        Returns:
+            asyncio.Future: Resolves to the job's result
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((job, future))
+        return future
+
+    async def _run(self):
+        while True:
+            job, future = await self._queue.get()
+            try:
+                result = await job(self.launcher)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    async def close(self):
+        """Wait for the pending jobs and stop the worker."""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
@@ -0,0 +1,362 @@
+"""
+In-process stand-in for the parts of pynq used by the overlays.
+
+This module mimics `Overlay`, `allocate` and the AXI-lite register file of the
+`diffraction_only` IP, of the `diff_losses` IP (diffraction plus the loss
+and Kerr operators) and of the 64-point `thomas_solver` IP, so the host
+pipeline can be developed and tested on any Linux box. The simulated IPs run
+the ADI operators from `step_operators` (or the partitioned solver), or
+custom_thomas_solver, on the buffers addressed by their registers,
+optionally in a background thread with a configurable latency and a
+simulated interrupt.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+import types
+
+import numpy as np
+
+import deep_tissue_imaging.propagators.step_operators as so
+from deep_tissue_imaging.propagators.partitioned_solver import adi_x_partitioned, adi_y_partitioned
+from deep_tissue_imaging.hardware.kernel_launch import AP_DONE, AP_GIE, AP_IDLE, AP_IER, AP_ISR, AP_START
+
+# Register map of the diffraction_only IP as driven by diffraction_overlay_debug.py.
+# 'n_steps' is only implemented by the simulated IP: it lets a single kernel
+# call advance several z-steps.
+DIFFRACTION_ONLY_REGS = {
+    'ctrl': 0x00,
+    'in_lo': 0x10,
+    'in_hi': 0x14,
+    'out_lo': 0x18,
+    'out_hi': 0x1C,
+    'n_steps': 0x20,
+}
+
+# Register map of the diff_losses IP as driven by diff_losses_nsteps_test.ipynb,
+# which advances 'n_steps' full steps (diffraction, 2-photon, Kerr and linear
+# absorption) per call. The board IP reads the field in column-major order.
+DIFF_LOSSES_REGS = {
+    'ctrl': 0x00,
+    'in_lo': 0x10,
+    'in_hi': 0x14,
+    'out_lo': 0x1C,
+    'out_hi': 0x20,
+    'n_steps': 0x28,
+}
+
+# Register map of the thomas_solver IP driven by OverlayThomasSolver: the
+# complex coefficients of one 64-point system as (real, imag) float32 words
+# and the addresses of its right-hand side and solution. Like FULL_STEP_LAYOUT
+# this is the host-side contract, with each 32-bit scalar on an 8-byte stride.
+THOMAS_SOLVER_REGS = {
+    'ctrl': 0x00,
+    'dp_r': 0x10,
+    'dp_i': 0x18,
+    'dp1_r': 0x20,
+    'dp1_i': 0x28,
+    'dp2_r': 0x30,
+    'dp2_i': 0x38,
+    'off_r': 0x40,
+    'off_i': 0x48,
+    'b': 0x50,
+    'x': 0x5C,
+}
+
+# Fake physical memory: base address -> MockBuffer
+_memoria = {}
+_direcciones = itertools.count(0x8_0000_0000, 0x10_0000)
+
+
+class MockBuffer(np.ndarray):
+    """
+    ndarray with the extra attributes of a pynq `PynqBuffer`.
+
+    Flushes and invalidates are counted so tests can check cache maintenance.
+    """
+
+    def __array_finalize__(self, obj):
+        self.physical_address = getattr(obj, 'physical_address', 0)
+        self.flush_count = getattr(obj, 'flush_count', 0)
+        self.invalidate_count = getattr(obj, 'invalidate_count', 0)
+
+    def flush(self):
+        self.flush_count += 1
+
+    def invalidate(self):
+        self.invalidate_count += 1
+
+    def freebuffer(self):
+        _memoria.pop(self.physical_address, None)
+
+    def free(self):
+        self.freebuffer()
+
+
+def allocate(shape, dtype=np.uint32, **kwargs):
+    """
+    Allocate a zeroed buffer registered at a fake physical address.
+
+    Parameters:
+        shape (tuple or int): Shape of the buffer
+        dtype (dtype): Element type of the buffer
+
+    Returns:
+        MockBuffer: Buffer with `physical_address`, `flush` and `invalidate`
+    """
+    buffer = np.zeros(shape, dtype=dtype).view(MockBuffer)
+    buffer.physical_address = next(_direcciones)
+    buffer.flush_count = 0
+    buffer.invalidate_count = 0
+    _memoria[buffer.physical_address] = buffer
+    return buffer
+
+
+def buffer_at(address):
+    """Return the buffer registered at a fake physical address."""
+    try:
+        return _memoria[address]
+    except KeyError:
+        raise ValueError(f"No buffer allocated at physical address {address:#x}") from None
+
+
+class MockInterrupt:
+    """
+    Simulated `pynq.Interrupt` of a mock IP.
+
+    Like the interrupt line, it stays raised until the IP status register is
+    cleared, so `wait` returns immediately for an unacknowledged interrupt.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def trigger(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        if not self._event.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, self._event.wait)
+
+
+class MockHLSIP:
+    """
+    AXI-lite control and interrupt logic of a simulated HLS IP.
+
+    Writing AP_START to the control register runs the kernel, `_run` in the
+    subclasses. With `latency` > 0 the kernel runs in a background thread and
+    ap_done is raised no earlier than `latency` seconds after the start, which
+    models the fabric computing while the host keeps working. When the ap_done
+    interrupt is enabled through GIE/IER, `interrupt` is triggered on
+    completion. `register_map` names the registers like a pynq register map
+    ('CTRL' for the control register).
+
+    Parameters:
+        regs (dict): Register offsets of the IP
+        latency (float): Minimum kernel duration in seconds
+    """
+
+    def __init__(self, regs, latency=0.0):
+        self.regs = regs
+        self.latency = latency
+        self.registers = {offset: 0 for offset in regs.values()}
+        self.registers.update({AP_GIE: 0, AP_IER: 0, AP_ISR: 0})
+        self.registers[regs['ctrl']] = AP_IDLE
+        self.register_map = types.SimpleNamespace(**{
+            'CTRL' if name == 'ctrl' else name: types.SimpleNamespace(address=offset)
+            for name, offset in regs.items()})
+        self.interrupt = MockInterrupt()
+        self.launches = 0
+        self._lock = threading.Lock()
+
+    def read(self, offset):
+        with self._lock:
+            value = self.registers.get(offset, 0)
+            if offset == self.regs['ctrl']:
+                # ap_done is clear-on-read
+                self.registers[offset] = value & ~AP_DONE
+            return value
+
+    def write(self, offset, value):
+        if isinstance(value, (bytes, bytearray)):
+            # Bulk write of consecutive registers, as pynq MMIO.write does for bytes
+            for i, word in enumerate(np.frombuffer(value, dtype=np.uint32)):
+                self.write(offset + 4 * i, word)
+            return
+        value = int(value) & 0xFFFFFFFF
+        if offset == self.regs['ctrl']:
+            if value & AP_START:
+                self._start()
+            return
+        with self._lock:
+            if offset == AP_ISR:
+                self.registers[offset] ^= value
+                if not self.registers[offset] & 1:
+                    self.interrupt.clear()
+            else:
+                self.registers[offset] = value
+
+    def _address(self, lo, hi=None):
+        """64-bit address in registers lo and hi (the word after lo if None)."""
+        high = self.regs[lo] + 4 if hi is None else self.regs[hi]
+        return self.registers[self.regs[lo]] | (self.registers.get(high, 0) << 32)
+
+    def _start(self):
+        with self._lock:
+            if not self.registers[self.regs['ctrl']] & AP_IDLE:
+                raise RuntimeError("ap_start written while the kernel is running")
+            self.registers[self.regs['ctrl']] = AP_START
+        if self.latency > 0:
+            threading.Thread(target=self._execute, daemon=True).start()
+        else:
+            self._execute()
+
+    def _execute(self):
+        t0 = time.perf_counter()
+        self._run()
+        self.launches += 1
+        remaining = self.latency - (time.perf_counter() - t0)
+        if remaining > 0:
+            time.sleep(remaining)
+        with self._lock:
+            self.registers[self.regs['ctrl']] = AP_DONE | AP_IDLE
+            interrupt = self.registers[AP_GIE] & 1 and self.registers[AP_IER] & 1
+            if interrupt:
+                self.registers[AP_ISR] |= 1
+        if interrupt:
+            self.interrupt.trigger()
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class MockDiffractionIP(MockHLSIP):
+    """
+    Simulated `diffraction_only` IP.
+
+    A kernel run applies `n_steps` times adi_x followed by adi_y to the input
+    buffer and stores the result in the output buffer, using the constants of
+    the domain the IP was built for (see MockHLSIP for latency and interrupt).
+
+    Parameters:
+        domain (Domain): Domain whose constants the IP is built for
+        regs (dict): Register offsets of the IP
+        latency (float): Minimum kernel duration in seconds
+        block_size (int, optional): Run the ADI solves with the partitioned solver in
+            blocks of this size, which is much faster than the reference operators
+            when the latency models the fabric
+    """
+
+    def __init__(self, domain, regs=DIFFRACTION_ONLY_REGS, latency=0.0, block_size=None):
+        super().__init__(regs, latency)
+        self.domain = domain
+        self.block_size = block_size
+        self.registers[regs['n_steps']] = 1
+
+    def _run(self):
+        d = self.domain
+        in_buffer = buffer_at(self._address('in_lo', 'in_hi'))
+        out_buffer = buffer_at(self._address('out_lo', 'out_hi'))
+        phi = np.asarray(in_buffer).reshape(d.X.shape)
+        for _ in range(max(1, self.registers[self.regs['n_steps']])):
+            phi = self._step(phi)
+        np.copyto(np.asarray(out_buffer).reshape(d.X.shape), phi)
+
+    def _step(self, phi):
+        d = self.domain
+        if self.block_size is None:
+            phi = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx)
+            return so.adi_y(phi, d.Nx, d.eps, d.k, d.dz, d.dy)
+        phi = adi_x_partitioned(phi, d.Ny, d.eps, d.k, d.dz, d.dx, self.block_size)
+        return adi_y_partitioned(phi, d.Nx, d.eps, d.k, d.dz, d.dy, self.block_size)
+
+
+class MockDiffLossesIP(MockDiffractionIP):
+    """
+    Simulated `diff_losses` IP: `n_steps` full steps per call.
+
+    Each step is the diffraction step of MockDiffractionIP followed by both
+    halves of the 2-photon, Kerr and linear absorption operators, as the
+    diffraction backends apply them (propagation._after_diffraction).
+
+    Parameters:
+        domain (Domain): Domain whose constants the IP is built for
+        tejido: Tissue whose constants the IP is built for
+        regs (dict): Register offsets of the IP
+        latency (float): Minimum kernel duration in seconds
+        block_size (int, optional): Block size of the partitioned ADI solves
+    """
+
+    def __init__(self, domain, tejido, regs=DIFF_LOSSES_REGS, latency=0.0, block_size=None):
+        super().__init__(domain, regs, latency, block_size)
+        self.tejido = tejido
+
+    def _step(self, phi):
+        d, t = self.domain, self.tejido
+        phi = super()._step(phi)
+        for _ in range(2):
+            phi = so.half_2photon_absorption(phi, t.beta, d.dz)
+            phi = so.half_nonlinear(phi, d.k, t.n2, d.dz)
+            phi = so.half_linear_absorption(phi, t.alpha, d.dz)
+        return phi
+
+
+class MockThomasIP(MockHLSIP):
+    """
+    Simulated `thomas_solver` IP.
+
+    A kernel run solves the 64-point system with the coefficients in its
+    registers by custom_thomas_solver, in complex64, from the right-hand side
+    buffer into the solution buffer (see MockHLSIP for latency and interrupt).
+
+    Parameters:
+        regs (dict): Register offsets of the IP
+        latency (float): Minimum kernel duration in seconds
+    """
+
+    def __init__(self, regs=THOMAS_SOLVER_REGS, latency=0.0):
+        super().__init__(regs, latency)
+
+    def _complex(self, name):
+        words = np.array([self.registers[self.regs[name + '_r']], self.registers[self.regs[name + '_i']]],
+                         dtype=np.uint32)
+        return words.view(np.complex64)[0]
+
+    def _run(self):
+        b = np.asarray(buffer_at(self._address('b')))
+        x = np.asarray(buffer_at(self._address('x')))
+        np.copyto(x, so.custom_thomas_solver(self._complex('dp'), self._complex('dp1'), self._complex('dp2'),
+                                             self._complex('off'), b))
+
+
+class MockOverlay:
+    """
+    Simulated `Overlay` exposing `diffraction_only_0` and `thomas_solver_0` IPs, and
+    a `diff_losses_0` IP if built for a tissue.
+
+    Parameters:
+        bitfile (str): Name of the bitstream (kept only for reference)
+        domain (Domain): Domain whose constants the simulated IP is built for
+        latency (float): Minimum kernel duration of the simulated IPs in seconds
+        tejido (optional): Tissue of the diff_losses IP; without it there is none
+        block_size (int, optional): Block size of the partitioned ADI solves of the
+            simulated IPs; the reference operators if None
+    """
+
+    def __init__(self, bitfile, domain, latency=0.0, tejido=None, block_size=None):
+        self.bitfile = bitfile
+        self.diffraction_only_0 = MockDiffractionIP(domain, latency=latency, block_size=block_size)
+        self.thomas_solver_0 = MockThomasIP(latency=latency)
+        self.ip_dict = {'diffraction_only_0': {'type': 'xilinx.com:hls:diffraction_only:1.0'},
+                        'thomas_solver_0': {'type': 'xilinx.com:hls:thomas_solver:1.0'}}
+        if tejido is not None:
+            self.diff_losses_0 = MockDiffLossesIP(domain, tejido, latency=latency, block_size=block_size)
+            self.ip_dict['diff_losses_0'] = {'type': 'xilinx.com:hls:diff_losses:1.0'}
+
+    def free(self):
+        pass
@@ -0,0 +1,417 @@
+"""
+Cost-model planner splitting the step operators between the host and the fabric.
+
+A step of full_step_within_tissue is split into the operators the overlays
+implement, applied as the diffraction backends apply them (see
+propagation._after_diffraction):
+
+    diffraction   adi_x and adi_y
+    losses        both halves of the 2-photon, Kerr and linear absorption
+                  operators; in the linear regime one scalar factor per launch
+    mask          the phase mask after every spm-th step, always on the host
+
+A plan loads one overlay and runs the rest on the host:
+
+    host              every operator on the ARM cores
+    diffraction_only  diffraction on the fabric
+    diff_losses       diffraction and losses fused on the fabric
+    thomas_solver     the 64-point block solves of the partitioned ADI solver on
+                      the fabric, one launch per block; the spikes and the
+                      reduced systems stay on the host
+
+(The convolution, matrix product and scalar multiplier overlays implement
+none of the operators of a step at the grid sizes we run.)
+
+`CostModel` prices each operator: host compute per grid element, fabric
+compute as cycles per element at the fabric clock plus a pipeline latency
+per launch, and each launch as a fixed host overhead (programming the
+registers, cache maintenance, waiting for ap_done) plus the DMA of its data
+in and out at the port bandwidth. The default model is a rough KV260: the
+diff_losses numbers come from diff_losses_nsteps_test.ipynb (361 steps of
+64x64 in 1.567 s, ~106 cycles per element at 100 MHz) and the host numbers
+are per-element costs of the numpy operators on the A53 cores.
+`CostModel.measure` replaces the host costs and the launch overhead with
+timings of the machine it runs on.
+
+A launch advances several z-steps (the n_steps register) when nothing
+between them has to run on the host: up to the next mask with diff_losses,
+and with diffraction_only in the linear regime, where the losses of n steps
+are one scalar applied after the launch. `plan_placement` picks for every
+overlay the smallest batch that brings the launch and transfer overhead
+under a fraction of the compute: only the planes at launch boundaries come
+back to the host, so a larger batch loses planes for nothing. Launches are
+synchronous, so the predicted step time is the sum of the host compute, the
+fabric compute, the transfers and the launch overheads. `simulate` checks it
+by running a plan on the mock overlay, with every kernel lasting the modeled
+fabric and DMA time and the host operators run for real, and counts its
+launches. A Thomas solver plan is only counted: its kernels are too short
+to model with a sleeping thread, so its time is that of the mock IP's
+Python solves.
+"""
+
+import copy
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.precision import precision_types
+from deep_tissue_imaging.hardware import mock_pynq
+from deep_tissue_imaging.hardware.diffraction_backend import OverlayDiffraction, SoftwareDiffraction
+from deep_tissue_imaging.hardware.mock_pynq import DIFF_LOSSES_REGS, DIFFRACTION_ONLY_REGS
+from deep_tissue_imaging.hardware.thomas_backend import THOMAS_BLOCK_SIZE, OverlayThomasSolver
+from deep_tissue_imaging.propagators.partitioned_solver import adi_x_partitioned, adi_y_partitioned
+from deep_tissue_imaging.propagators.propagation import _after_diffraction, _mask_step
+
+# Operators of a step each overlay runs
+OVERLAYS = {
+    'host': (),
+    'diffraction_only': ('diffraction',),
+    'diff_losses': ('diffraction', 'losses'),
+    'thomas_solver': ('block_solves',),
+}
+
+# Seconds per grid element on the A53 cores (numpy, complex64). 'solver_host' is
+# the partitioned solver without its block solves, what stays on the host when
+# they run on the Thomas solver overlay
+HOST_COSTS = {
+    'diffraction': 1.5e-6,
+    'solver_host': 9e-7,
+    'losses': 3e-7,
+    'linear_losses': 1.5e-8,
+    'mask': 1e-7,
+}
+
+# Fabric compute: clock in Hz, cycles per grid element and step, latency per launch
+# in seconds, and optionally the host overhead of a launch of the overlay
+FABRIC_COSTS = {
+    'diffraction_only': {'clock': 100e6, 'cycles': 100, 'latency': 2e-5},
+    'diff_losses': {'clock': 100e6, 'cycles': 106, 'latency': 2e-5},
+    'thomas_solver': {'clock': 100e6, 'cycles': 3, 'latency': 2e-6},
+}
+
+
+class CostModel:
+    """
+    Per-operator costs of the host, the fabric and the transfers between them.
+
+    Parameters:
+        host (dict, optional): Host seconds per grid element of each operator (see HOST_COSTS)
+        fabric (dict, optional): Fabric compute of each overlay (see FABRIC_COSTS)
+        bandwidth (float): DMA bandwidth in bytes per second, each way
+        launch (float): Host overhead of one kernel launch in seconds, for the
+            overlays without their own 'launch' in `fabric`
+        itemsize (int): Bytes per field element
+    """
+
+    def __init__(self, host=None, fabric=None, bandwidth=1.2e9, launch=5e-5, itemsize=8):
+        self.host = dict(HOST_COSTS, **(host or {}))
+        self.fabric = copy.deepcopy(FABRIC_COSTS)
+        for name, costs in (fabric or {}).items():
+            self.fabric.setdefault(name, {}).update(costs)
+        self.bandwidth = bandwidth
+        self.launch = launch
+        self.itemsize = itemsize
+
+    def fabric_time(self, overlay, elements, n_steps=1):
+        """Fabric compute of one launch of `n_steps` steps over `elements` grid elements."""
+        f = self.fabric[overlay]
+        return f['latency'] + n_steps * elements * f['cycles'] / f['clock']
+
+    def launch_time(self, overlay):
+        """Host overhead of one launch on an overlay."""
+        return self.fabric[overlay].get('launch', self.launch)
+
+    def transfer_time(self, elements):
+        """DMA time of `elements` field elements in and out."""
+        return 2 * elements * self.itemsize / self.bandwidth
+
+    @classmethod
+    def measure(cls, d, tejido, repeat=10, **kwargs):
+        """
+        A model with the host costs and the launch overhead measured on this machine.
+
+        The host diffraction is the partitioned solver (blocks of 64 when the
+        grid allows it, whole rows otherwise), the one the host plans run.
+        The launch overhead of the diffraction_only and diff_losses overlays is
+        measured on the mock diffraction_only IP, with a kernel lasting one
+        modeled diffraction step on d's grid: it includes the polling of
+        KernelLauncher.wait_sync past ap_done. The Thomas solver overlay keeps
+        the model's launch overhead, and simulate doesn't time it: its mock IP
+        solves every block in Python, far slower than the fabric.
+
+        Parameters:
+            d: Domain properties (grid)
+            tejido: Tissue properties
+            repeat (int): Timed repetitions; the fastest is kept, as interference
+                from other processes only adds time
+            **kwargs: Other arguments of CostModel (fabric, bandwidth)
+
+        Returns:
+            CostModel: The measured model
+        """
+        model = cls(**kwargs)
+        elements = d.Nx * d.Ny
+        phi = np.exp(-(d.X**2 + d.Y**2) / np.max(d.X)**2).astype(precision_types(d)[1])
+        theta = np.zeros(d.X.shape, dtype=phi.real.dtype)
+        block = _host_block(d)
+        host = SoftwareDiffraction(block_size=block)
+        scalar = phi.real.dtype.type(0.5)
+
+        def identity(dp, dp1, dp2, do, b):
+            return b
+
+        def timed(operation):
+            times = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                operation()
+                times.append(time.perf_counter() - t0)
+            return min(times)
+
+        model.host = {
+            'diffraction': timed(lambda: host.propagate(phi, d)) / elements,
+            'solver_host': timed(lambda: adi_y_partitioned(
+                adi_x_partitioned(phi, d.Ny, d.eps, d.k, d.dz, d.dx, block, identity),
+                d.Nx, d.eps, d.k, d.dz, d.dy, block, identity)) / elements,
+            'losses': timed(lambda: _after_diffraction(phi, tejido, d)) / elements,
+            'linear_losses': timed(lambda: scalar * phi) / elements,
+            'mask': timed(lambda: phi * np.exp(1j * theta)) / elements,
+        }
+
+        overlay = mock_pynq.MockOverlay('placement.bit', d, block_size=block)
+        ip = overlay.diffraction_only_0
+        backend = OverlayDiffraction(ip, mock_pynq.allocate, interrupt=ip.interrupt)
+        ip.latency = model.fabric_time('diffraction_only', elements) + model.transfer_time(elements)
+        backend.propagate(phi, d)
+        launch = max(0.0, timed(lambda: backend.propagate(phi, d)) - ip.latency)
+        for name in ('diffraction_only', 'diff_losses'):
+            model.fabric[name]['launch'] = launch
+        backend.free()
+        return model
+
+
+def _host_block(d):
+    """Block size of the host's partitioned solves: 64 where it divides the grid, whole rows otherwise."""
+    return THOMAS_BLOCK_SIZE if d.Nx % THOMAS_BLOCK_SIZE == 0 and d.Ny % THOMAS_BLOCK_SIZE == 0 else max(d.Nx, d.Ny)
+
+
+def launch_sizes(Nz, spm, batch):
+    """
+    Steps of every launch of a run, none of them crossing a mask.
+
+    Parameters:
+        Nz (int): Number of z-steps
+        spm (int): Steps per mask (a mask follows step k when k % spm == 0 and k != 0)
+        batch (int): Most steps per launch
+
+    Returns:
+        list: Steps of each launch, in order
+    """
+    sizes, k = [], 0
+    while k < Nz:
+        next_mask = spm * max(1, -(-k // spm))
+        n = min(batch, Nz - k, next_mask - k + 1)
+        sizes.append(n)
+        k += n
+    return sizes
+
+
+def _batched(overlay, linear):
+    return overlay == 'diff_losses' or (overlay == 'diffraction_only' and linear)
+
+
+def predict(model, overlay, shape, Nz, spm, batch=1, linear=False):
+    """
+    Predicted time of a run under a placement.
+
+    Parameters:
+        model (CostModel): Costs
+        overlay (str): Key of OVERLAYS
+        shape (tuple): Field shape (Ny, Nx)
+        Nz (int): Number of z-steps
+        spm (int): Steps per mask
+        batch (int): Most steps per launch (diff_losses, or diffraction_only in the linear regime)
+        linear (bool): Whether the run is in the linear regime (nonlinear_negligible)
+
+    Returns:
+        dict: 'overlay', 'batch', 'linear', 'launches', the seconds of 'host',
+            'fabric', 'transfer' and 'launch' work over the run, and the 'step' time
+    """
+    elements = int(np.prod(shape))
+    h = model.host
+    sizes = launch_sizes(Nz, spm, batch if _batched(overlay, linear) else 1)
+    masks = len(range(spm, Nz, spm))
+    cost = {'overlay': overlay, 'batch': max(sizes), 'linear': linear, 'launches': 0,
+            'host': masks * elements * h['mask'], 'fabric': 0.0, 'transfer': 0.0, 'launch': 0.0}
+
+    # Losses on the host: per step, or one scalar per launch in the linear regime
+    if 'losses' not in OVERLAYS[overlay]:
+        per_step = h['linear_losses'] if linear else h['losses']
+        cost['host'] += (len(sizes) if linear else Nz) * elements * per_step
+
+    if overlay == 'host':
+        cost['host'] += Nz * elements * h['diffraction']
+    elif overlay == 'thomas_solver':
+        # Two sweeps per step, every 64-point block of every row or column one launch;
+        # partitioned_thomas_solver solves the spikes on the host
+        blocks = 2 * Nz * elements // THOMAS_BLOCK_SIZE
+        cost['host'] += Nz * elements * h['solver_host']
+        cost['fabric'] = blocks * model.fabric_time(overlay, THOMAS_BLOCK_SIZE)
+        cost['transfer'] = blocks * model.transfer_time(THOMAS_BLOCK_SIZE)
+        cost['launches'] = blocks
+    else:
+        cost['fabric'] = sum(model.fabric_time(overlay, elements, n) for n in sizes)
+        cost['transfer'] = len(sizes) * model.transfer_time(elements)
+        cost['launches'] = len(sizes)
+    cost['launch'] = cost['launches'] * (model.launch_time(overlay) if cost['launches'] else 0.0)
+    cost['step'] = (cost['host'] + cost['fabric'] + cost['transfer'] + cost['launch']) / Nz
+    return cost
+
+
+def plan_placement(model, shape, Nz, spm, linear=False, overhead=0.05, overlays=None):
+    """
+    Predicted cost of every placement, with the batch of each, best first.
+
+    The batch is the smallest number of steps per launch that brings the launch,
+    transfer and pipeline overheads within `overhead` of the compute, or the
+    fastest if none does.
+
+    Parameters:
+        model (CostModel): Costs
+        shape (tuple): Field shape (Ny, Nx)
+        Nz (int): Number of z-steps
+        spm (int): Steps per mask
+        linear (bool): Whether the run is in the linear regime
+        overhead (float): Tolerated overhead as a fraction of the compute
+        overlays (iterable, optional): Placements to consider; all of OVERLAYS if None
+
+    Returns:
+        list: predict() of each placement, sorted by step time
+    """
+    elements = int(np.prod(shape))
+    plans = []
+    for overlay in overlays or OVERLAYS:
+        if not _batched(overlay, linear):
+            plans.append(predict(model, overlay, shape, Nz, spm, 1, linear))
+            continue
+        candidates = [predict(model, overlay, shape, Nz, spm, n, linear) for n in range(1, min(Nz, spm + 1) + 1)]
+        for candidate in candidates:
+            compute = Nz * elements * model.fabric[overlay]['cycles'] / model.fabric[overlay]['clock']
+            waste = candidate['fabric'] - compute + candidate['transfer'] + candidate['launch']
+            if waste <= overhead * (compute + candidate['host']):
+                break
+        else:
+            candidate = min(candidates, key=lambda c: c['step'])
+        plans.append(candidate)
+    return sorted(plans, key=lambda c: c['step'])
+
+
+def simulate(plan, model, phi, tejido, d, mask_manager=None):
+    """
+    Run a plan on the mock overlay and time it.
+
+    Every kernel lasts its modeled fabric and DMA time (the mock IP computes
+    within it); the host operators, the launches and the waits are real. A
+    thomas_solver plan runs the partitioned solver with its block solves on
+    the mock Thomas IP, without a modeled duration: its launches check the
+    model, its time doesn't (see the module docstring).
+
+    Parameters:
+        plan (dict): A plan from plan_placement or predict
+        model (CostModel): Costs the kernel durations are modeled with
+        phi (ndarray): Initial complex field
+        tejido: Tissue properties
+        d: Domain properties
+        mask_manager (PhaseMaskManager, optional): Phase mask manager
+
+    Returns:
+        tuple: (planes, history, step, launches) with the planes at launch
+            boundaries, the fields at them, the measured seconds per step and the
+            kernel launches of the run
+    """
+    overlay, linear = plan['overlay'], plan['linear']
+    spm = int(tejido.l_s/d.dz)
+    elements = d.Nx * d.Ny
+    real, cplx = precision_types(d)
+    phi = np.asarray(phi, dtype=cplx)
+    if mask_manager is not None:
+        mask_manager.initialize_masks(phi.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+    sizes = launch_sizes(d.Nz, spm, plan['batch'] if _batched(overlay, linear) else 1)
+
+    if overlay == 'host':
+        backend = SoftwareDiffraction(block_size=_host_block(d))
+        mock = None
+    elif overlay == 'thomas_solver':
+        mock = mock_pynq.MockOverlay('placement.bit', d)
+        ip = mock.thomas_solver_0
+        solver = OverlayThomasSolver(ip, mock_pynq.allocate, interrupt=ip.interrupt)
+        backend = SoftwareDiffraction(block_size=THOMAS_BLOCK_SIZE, block_solver=solver)
+    else:
+        mock = mock_pynq.MockOverlay('placement.bit', d, tejido=tejido, block_size=_host_block(d))
+        ip = getattr(mock, f'{overlay}_0')
+        regs = DIFF_LOSSES_REGS if overlay == 'diff_losses' else DIFFRACTION_ONLY_REGS
+        backend = OverlayDiffraction(ip, mock_pynq.allocate, regs, interrupt=ip.interrupt)
+
+    planes, history = [0], [phi]
+    mask_counter, k = 0, 0
+    t0 = time.perf_counter()
+    for n in sizes:
+        if mock is not None and overlay != 'thomas_solver':
+            ip.latency = model.fabric_time(overlay, elements, n) + model.transfer_time(elements)
+        phi = backend.propagate(phi, d, n)
+        if overlay != 'diff_losses':
+            if linear:
+                phi = np.exp(real(-tejido.alpha * d.dz / 2 * n)) * phi
+            else:
+                phi = _after_diffraction(phi, tejido, d)
+        k += n
+        phi, mask_counter = _mask_step(phi, k - 1, spm, mask_counter, d, mask_manager)
+        planes.append(k)
+        history.append(phi)
+    seconds = time.perf_counter() - t0
+    launches = 0 if mock is None else ip.launches
+    if isinstance(backend, OverlayDiffraction):
+        backend.free()
+    return planes, np.stack(history), seconds / d.Nz, launches
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import os
+    import tempfile
+
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+    from deep_tissue_imaging.propagators.propagation import full_propagation_within_tissue
+
+    def show(plan):
+        return (f"{plan['overlay']:16s} batch {plan['batch']:3d}, {plan['launches']:6d} launches: "
+                f"{plan['step'] * 1e3:7.2f} ms/step (host {plan['host'] * 1e3:.0f}, fabric {plan['fabric'] * 1e3:.0f}, "
+                f"transfer {plan['transfer'] * 1e3:.0f}, launch {plan['launch'] * 1e3:.0f} ms)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with contextlib.redirect_stdout(io.StringIO()):
+            masks = {N: PhaseMaskManager(os.path.join(tmp, str(N))) for N in (64, 128)}
+        for N, Nz in ((64, 150), (128, 150)):
+            # eps=1e-1: on 128x128 the boundary ratios go unstable after the first mask with 1e-2
+            d = build_domain(45e-6, 45e-6, Nz * 1e-6, N, N, Nz, laser, tejido, eps=1e-1)
+            spm = int(tejido.l_s/d.dz)
+            phi0 = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+            measured = CostModel.measure(d, tejido)
+            reference = full_propagation_within_tissue(phi0, tejido, d, masks[N])
+            for linear in (False, True):
+                print(f"{N}x{N}x{Nz}, {'linear' if linear else 'nonlinear'} regime, KV260 model:")
+                for plan in plan_placement(CostModel(), phi0.shape, Nz, spm, linear):
+                    print("  " + show(plan))
+                print(f"  measured model (launch overhead {measured.launch_time('diff_losses') * 1e6:.0f} µs), against the mock overlay:")
+                for plan in plan_placement(measured, phi0.shape, Nz, spm, linear):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        planes, history, step, launches = simulate(plan, measured, phi0, tejido, d, masks[N])
+                    assert launches == plan['launches'], (launches, plan['launches'])
+                    dev = float(np.max(np.abs(history - reference[planes])) / np.max(np.abs(reference)))
+                    timing = ("launches as modeled" if plan['overlay'] == 'thomas_solver' else
+                              f"simulated {step * 1e3:.2f} ms/step ({(step - plan['step']) / plan['step']:+.0%})")
+                    print("  " + show(plan) + f", {timing}, max relative deviation {dev:.0e}")
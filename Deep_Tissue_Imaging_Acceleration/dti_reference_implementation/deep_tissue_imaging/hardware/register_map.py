@@ -0,0 +1,189 @@
+"""
+Bulk encoding of AXI-lite parameter blocks.
+
+A RegisterBlock holds a whole parameter set of an IP (float, complex, 32-bit
+and 64-bit fields) in typed staging arrays. Their uint32 views are the bit
+patterns the registers need, so packing the block is a few numpy scatters
+into one contiguous uint32 array instead of a float_to_uint32 round trip per
+register, and the block goes to the IP in one bulk write. Complex values are
+split into (real, imag) words and 64-bit values (buffer addresses) into
+(low, high) words by the same views.
+"""
+
+import numpy as np
+
+_STAGING = {
+    'f32': (np.float32, 1),
+    'u32': (np.uint32, 1),
+    'c64': (np.complex64, 2),  # (real, imag) words
+    'u64': (np.uint64, 2),     # (low, high) words
+}
+
+# Parameter registers of a full-step (diffraction + loss + Kerr) IP running
+# several z-steps per call. This is the host-side contract for that kernel;
+# HLS places each 32-bit scalar on an 8-byte stride.
+FULL_STEP_LAYOUT = {
+    'ung_x': ('c64', (0x10, 0x18)),
+    'ung_y': ('c64', (0x20, 0x28)),
+    'eps': ('f32', (0x30,)),
+    'lin_abs': ('f32', (0x38,)),
+    'tpa': ('f32', (0x40,)),
+    'kerr': ('f32', (0x48,)),
+    'n_steps': ('u32', (0x50,)),
+    'phi_in': ('u64', (0x58, 0x5C)),
+    'phi_out': ('u64', (0x64, 0x68)),
+}
+
+
+class RegisterBlock:
+    """
+    Contiguous uint32 image of a set of IP registers.
+
+    Parameters:
+        layout (dict): name -> (kind, offsets) with kind one of 'f32', 'u32'
+            (one offset), 'c64' (real and imaginary offsets) or 'u64' (low and
+            high offsets). The block spans from the lowest to the highest
+            offset; it must not include the control register at 0x00
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+        offsets = [o for _, field_offsets in layout.values() for o in field_offsets]
+        if 0x00 in offsets:
+            raise ValueError("A register block must not include the control register")
+        self.base = min(offsets)
+        self.words = np.zeros((max(offsets) - self.base) // 4 + 1, dtype=np.uint32)
+
+        self._slot = {}
+        self._staging = {}
+        self._bits = {}
+        self._dest = {}
+        for kind, (dtype, n_words) in _STAGING.items():
+            names = [name for name, (k, _) in layout.items() if k == kind]
+            for i, name in enumerate(names):
+                if len(layout[name][1]) != n_words:
+                    raise ValueError(f"Field '{name}' of kind {kind} needs {n_words} offsets")
+                self._slot[name] = (kind, i)
+            if names:
+                self._staging[kind] = np.zeros(len(names), dtype=dtype)
+                self._bits[kind] = self._staging[kind].view(np.uint32)
+                self._dest[kind] = np.array([(o - self.base) // 4 for name in names
+                                             for o in layout[name][1]], dtype=np.intp)
+
+    @classmethod
+    def from_register_map(cls, register_map, fields):
+        """
+        Build a block from the register names of a pynq register map.
+
+        Complex fields 'name' map to the registers 'name_r' and 'name_i', and
+        64-bit fields to the register 'name' and the word after it.
+
+        Parameters:
+            register_map: ip.register_map of a pynq IP
+            fields (dict): name -> kind
+
+        Returns:
+            RegisterBlock: Block with the offsets of the register map
+        """
+        layout = {}
+        for name, kind in fields.items():
+            if kind == 'c64':
+                offsets = (getattr(register_map, name + '_r').address,
+                           getattr(register_map, name + '_i').address)
+            elif kind == 'u64':
+                address = getattr(register_map, name).address
+                offsets = (address, address + 4)
+            else:
+                offsets = (getattr(register_map, name).address,)
+            layout[name] = (kind, offsets)
+        return cls(layout)
+
+    def __setitem__(self, name, value):
+        kind, i = self._slot[name]
+        self._staging[kind][i] = value
+
+    def __getitem__(self, name):
+        kind, i = self._slot[name]
+        return self._staging[kind][i]
+
+    def update(self, values=None, **kwargs):
+        """Set several fields from a dict and/or keyword arguments."""
+        for source in (values or {}, kwargs):
+            for name, value in source.items():
+                self[name] = value
+
+    def pack(self):
+        """
+        Encode the staged values into the uint32 image.
+
+        Returns:
+            ndarray: The uint32 words from `base` to the last register
+        """
+        for kind, bits in self._bits.items():
+            self.words[self._dest[kind]] = bits
+        return self.words
+
+    def write(self, ip):
+        """Pack the block and write it to the IP in one bulk write."""
+        self.pack()
+        ip.write(self.base, self.words.tobytes())
+
+
+def adi_parameters(d):
+    """ADI coefficients of the domain: ung along x and y and the boundary threshold."""
+    return {
+        'ung_x': np.complex64(1j * d.dz / (4 * d.k * d.dx**2)),
+        'ung_y': np.complex64(1j * d.dz / (4 * d.k * d.dy**2)),
+        'eps': d.eps,
+    }
+
+
+def tissue_parameters(tejido, d):
+    """Per-half-step loss and Kerr factors of the tissue, as used by step_operators."""
+    return {
+        'lin_abs': np.exp(np.float32(-tejido.alpha * d.dz / 4)),
+        'tpa': np.float32(tejido.beta * d.dz / 4),
+        'kerr': np.float32(d.k * tejido.n2 * d.dz / 2),
+    }
+
+
+def full_step_parameters(tejido, d):
+    """Every parameter of FULL_STEP_LAYOUT except the buffer addresses and step count."""
+    return {**adi_parameters(d), **tissue_parameters(tejido, d)}
+
+
+if __name__ == "__main__":
+    import timeit
+
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+
+    d = build_domain(45e-6, 45e-6, 361e-6, 256, 256, 361, laser, tejido)
+    params = full_step_parameters(tejido, d)
+    block = RegisterBlock(FULL_STEP_LAYOUT)
+
+    def bulk():
+        block.update(params, n_steps=4, phi_in=0x8_1234_5678, phi_out=0x8_9ABC_DEF0)
+        block.pack()
+
+    def scalar():
+        # One float_to_uint32 per register, as the notebooks do today
+        to_bits = lambda f: int(np.frombuffer(np.float32(f).tobytes(), dtype=np.uint32)[0])
+        words = {}
+        for name, value in params.items():
+            kind, offsets = FULL_STEP_LAYOUT[name]
+            parts = (value.real, value.imag) if kind == 'c64' else (value,)
+            for offset, part in zip(offsets, parts):
+                words[offset] = to_bits(part)
+        for name, address in (('phi_in', 0x8_1234_5678), ('phi_out', 0x8_9ABC_DEF0)):
+            lo, hi = FULL_STEP_LAYOUT[name][1]
+            words[lo], words[hi] = address & 0xFFFFFFFF, address >> 32
+        return words
+
+    reference = scalar()
+    bulk()
+    assert all(block.words[(o - block.base) // 4] == w for o, w in reference.items())
+    n = 2000
+    print(f"bulk pack: {timeit.timeit(bulk, number=n) / n * 1e6:.1f} us, "
+          f"per-register encoding: {timeit.timeit(scalar, number=n) / n * 1e6:.1f} us")
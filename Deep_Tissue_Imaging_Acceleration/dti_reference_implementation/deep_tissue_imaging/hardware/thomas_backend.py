@@ -0,0 +1,101 @@
+"""
+Block solver running on the 64-point Thomas solver overlay.
+
+`OverlayThomasSolver` has the signature of custom_thomas_solver, so it can be
+passed as `block_solver` to partitioned_thomas_solver to dispatch the block
+systems of a length-N ADI solve to the fabric.
+"""
+
+import numpy as np
+
+from deep_tissue_imaging.hardware.buffer_pool import DMABufferPool
+from deep_tissue_imaging.hardware.kernel_launch import KernelLauncher
+from deep_tissue_imaging.hardware.register_map import RegisterBlock
+
+THOMAS_BLOCK_SIZE = 64
+
+
+class OverlayThomasSolver:
+    """
+    Solve one 64-point tridiagonal system on the Thomas solver IP.
+
+    Register offsets are looked up by name in the IP register map (dp_r,
+    dp_i, ..., off_r, off_i, b, x), as in ThomasSolverTest.ipynb, and the
+    coefficients and buffer addresses go to the IP in one bulk write.
+
+    Parameters:
+        ip: Thomas solver IP (overlay.thomas_solver_0)
+        allocate (callable): pynq.allocate or mock_pynq.allocate
+        interrupt (optional): Interrupt of the IP (pynq.Interrupt); polled if None
+    """
+
+    def __init__(self, ip, allocate, interrupt=None):
+        self.ip = ip
+        self.pool = DMABufferPool(allocate)
+        self.launcher = KernelLauncher(ip, ip.register_map.CTRL.address, interrupt)
+        self._b = self.pool.acquire((THOMAS_BLOCK_SIZE,), np.complex64)
+        self._x = self.pool.acquire((THOMAS_BLOCK_SIZE,), np.complex64)
+        self._args = RegisterBlock.from_register_map(
+            ip.register_map, {'dp': 'c64', 'dp1': 'c64', 'dp2': 'c64', 'off': 'c64', 'b': 'u64', 'x': 'u64'})
+        self._args.update(b=self._b.physical_address, x=self._x.physical_address)
+
+    def __call__(self, dp, dp1, dp2, do, b):
+        """Solve the system like custom_thomas_solver(dp, dp1, dp2, do, b)."""
+        if b.shape != (THOMAS_BLOCK_SIZE,):
+            raise ValueError(f"The Thomas overlay solves {THOMAS_BLOCK_SIZE}-point systems, got {b.shape}")
+        self._args.update(dp=dp, dp1=dp1, dp2=dp2, off=do)
+        self._args.write(self.ip)
+        self._b.write(b)
+        self._b.for_device()
+        self.launcher.launch_sync()
+        self._x.mark_device_write()
+        return self._x.read().copy()
+
+
+if __name__ == "__main__":
+    import time
+
+    import deep_tissue_imaging.propagators.step_operators as so
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+    from deep_tissue_imaging.hardware import mock_pynq
+    from deep_tissue_imaging.propagators.partitioned_solver import adi_x_partitioned, partitioned_thomas_solver
+
+    d = build_domain(45e-6, 45e-6, 10e-6, 128, 128, 10, laser, tejido)
+    overlay = mock_pynq.MockOverlay('thomas_solver.bit', d)
+    ip = overlay.thomas_solver_0
+
+    # One block system against the software solve it mirrors
+    rng = np.random.default_rng(0)
+    ung = np.complex64(1j * d.dz / (4 * d.k * d.dx**2))
+    dp, do = np.complex64(1 + 2 * ung), np.complex64(-ung)
+    dp1, dp2 = np.complex64(1 + 1.7 * ung), np.complex64(1 + 2.2 * ung)
+    b = (rng.standard_normal(THOMAS_BLOCK_SIZE) + 1j * rng.standard_normal(THOMAS_BLOCK_SIZE)).astype(np.complex64)
+    for interrupt in (None, ip.interrupt):
+        solver = OverlayThomasSolver(ip, mock_pynq.allocate, interrupt)
+        x = solver(dp, dp1, dp2, do, b)
+        assert np.array_equal(x, so.custom_thomas_solver(dp, dp1, dp2, do, b))
+
+    # A 256-point system in blocks on the IP against the batched software blocks
+    b = (rng.standard_normal(256) + 1j * rng.standard_normal(256)).astype(np.complex64)
+    x_ref = so.custom_thomas_solver(dp, dp1, dp2, do, b)
+    x_sw = partitioned_thomas_solver(dp, dp1, dp2, do, b, THOMAS_BLOCK_SIZE)
+    x_ip = partitioned_thomas_solver(dp, dp1, dp2, do, b, THOMAS_BLOCK_SIZE, block_solver=solver)
+    err_sw = np.max(np.abs(x_sw - x_ref)) / np.max(np.abs(x_ref))
+    err_ip = np.max(np.abs(x_ip - x_ref)) / np.max(np.abs(x_ref))
+    print(f"256-point system in blocks of {THOMAS_BLOCK_SIZE}: relative error software {err_sw:.1e}, IP {err_ip:.1e}")
+    assert err_ip < 1e-5 and np.max(np.abs(x_ip - x_sw)) / np.max(np.abs(x_ref)) < 1e-5
+
+    # A whole adi_x sweep with its block systems dispatched to the IP: one launch per
+    # block and column, the spikes and the reduced systems stay on the host
+    phi = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+    launches = ip.launches
+    t0 = time.perf_counter()
+    out = adi_x_partitioned(phi, d.Ny, d.eps, d.k, d.dz, d.dx, THOMAS_BLOCK_SIZE, block_solver=solver)
+    t_ip = time.perf_counter() - t0
+    ref = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx)
+    err = np.max(np.abs(out - ref)) / np.max(np.abs(ref))
+    print(f"adi_x {d.Nx}x{d.Ny} on the IP: {ip.launches - launches} launches in {t_ip:.2f} s, "
+          f"relative error {err:.1e} against adi_x")
+    assert err < 1e-5 and ip.launches - launches == d.Nx * d.Ny // THOMAS_BLOCK_SIZE
@@ -0,0 +1,317 @@
+"""
+Adjoint propagation for gradients with respect to the input phase.
+
+For an objective J = sum(w |phi_N|^2) on the output plane of
+full_propagation_within_tissue, `input_phase_gradient` returns dJ/dtheta for
+an input field phi_0 = A exp(i theta) with one forward and one backward
+propagation. The backward pass runs the adjoint of every operator of the
+step in reverse order:
+
+    adi_x, adi_y   y = A(x)^-1 B(x) x, where the transparent boundary ratios
+                   make A and B depend on x. The adjoint solves the system with
+                   the conjugated (symmetric) matrix and adds the boundary
+                   ratio terms
+    2-photon loss  y = x exp(-c|x|^2)
+    Kerr           y = x exp(i c|x|^2)
+    linear loss    y = a x
+    phase mask     y = m x, |m| = 1
+
+Gradients follow the Wirtinger convention g = dJ/d(conj phi), with
+dJ = 2 Re(conj(g) dphi). The forward pass keeps every `checkpoint_every`-th
+field only; the backward pass recomputes each segment from its checkpoint,
+so memory holds about Nz/checkpoint_every + checkpoint_every fields.
+
+The forward pass runs the operators of full_step_within_tissue itself, with
+the partitioned ADI solver (adi_x_partitioned and the half operators of
+step_operators); only the adjoints are written here. Operators keep the
+dtype of the field, so a complex128 run can be checked against finite
+differences: `check` does that, and compares the output field with
+full_propagation_within_tissue.
+"""
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.precision import precision_types
+import deep_tissue_imaging.propagators.step_operators as so
+from deep_tissue_imaging.propagators.partitioned_solver import (
+    _boundary_ratio, _tridiagonal_product, adi_x_partitioned, partitioned_thomas_solver)
+
+
+def _sweep_adjoint(g, x, y, ung, eps, block_size):
+    """Adjoint of adi_x_partitioned at input x and output y applied to the output gradient g."""
+    n = x.shape[0]
+    m = block_size if n % block_size == 0 else n
+    # The boundary ratios of the forward sweep, and where they were used
+    r0, rn = _boundary_ratio(x[0], x[1], eps), _boundary_ratio(x[-1], x[-2], eps)
+    used0, usedn = np.abs(x[1]) >= eps, np.abs(x[-2]) >= eps
+    c = np.conj
+    dp_B = 1 - 2 * ung
+    dp_A = 1 + 2 * ung
+    # A and B are symmetric, so A^H = conj(A)
+    lam = partitioned_thomas_solver(c(dp_A), c(dp_A - ung * r0), c(dp_A - ung * rn), c(-ung), g, m)
+    gx = _tridiagonal_product(c(dp_B), c(dp_B + ung * r0), c(dp_B + ung * rn), c(ung), lam)
+
+    # d(A y - B x)/dr0 = -ung (y0 + x0) on row 0, with r0 = x0/x1 (and likewise at the far end)
+    s0 = np.where(used0, c(ung * (x[0] + y[0])) * lam[0], 0)
+    gx[0] += s0 * c(1 / np.where(used0, x[1], 1))
+    gx[1] -= s0 * c(x[0] / np.where(used0, x[1], 1)**2)
+    sn = np.where(usedn, c(ung * (x[-1] + y[-1])) * lam[-1], 0)
+    gx[-1] += sn * c(1 / np.where(usedn, x[-2], 1))
+    gx[-2] -= sn * c(x[-1] / np.where(usedn, x[-2], 1)**2)
+    return gx
+
+
+class _StepOperators:
+    """
+    One full step for fields of a given dtype and its adjoint.
+
+    The forward step is full_step_within_tissue with the partitioned ADI
+    solver: adi_x_partitioned, adi_y_partitioned and the half operators of
+    step_operators. The adjoint takes their coefficients in the same precision.
+    """
+
+    def __init__(self, tejido, d, dtype, block_size):
+        ctype = np.dtype(dtype).type
+        rtype = np.finfo(dtype).dtype.type
+        self.tejido = tejido
+        self.d = d
+        self.ung_x = ctype(1j * d.dz / (4 * d.k * d.dx**2))
+        self.ung_y = ctype(1j * d.dz / (4 * d.k * d.dy**2))
+        # Evaluated like half_linear_absorption, so the adjoint matches its rounding
+        self.lin = np.exp(rtype(-tejido.alpha * d.dz / 4))
+        self.tpa = rtype(tejido.beta * d.dz / 4)
+        self.kerr = rtype(d.k * tejido.n2 * d.dz / 2)
+        self.block_size = block_size
+
+    def _sweep(self, phi, n, h):
+        """adi_x_partitioned along axis 0, in whole columns if block_size doesn't divide them."""
+        m = self.block_size if phi.shape[0] % self.block_size == 0 else phi.shape[0]
+        return adi_x_partitioned(phi, n, self.d.eps, self.d.k, self.d.dz, h, m)
+
+    def halves(self, phi):
+        """2-photon loss, Kerr and linear loss. Returns the output and the inputs of the first two."""
+        t, d = self.tejido, self.d
+        x_tpa = phi
+        phi = so.half_2photon_absorption(phi, t.beta, d.dz)
+        x_kerr = phi
+        phi = so.half_nonlinear(phi, d.k, t.n2, d.dz)
+        return so.half_linear_absorption(phi, t.alpha, d.dz), (x_tpa, x_kerr)
+
+    def halves_adjoint(self, g, saved):
+        x_tpa, x_kerr = saved
+        g = self.lin * g
+        I = x_kerr.real**2 + x_kerr.imag**2
+        P = np.exp(1j * self.kerr * I)
+        g = np.conj(P) * (1 - 1j * self.kerr * I) * g + 1j * self.kerr * x_kerr**2 * P * np.conj(g)
+        I = x_tpa.real**2 + x_tpa.imag**2
+        e = np.exp(-self.tpa * I)
+        return e * (1 - self.tpa * I) * g - self.tpa * e * x_tpa**2 * np.conj(g)
+
+    def step(self, phi, tape=None):
+        """full_step_within_tissue; appends what the adjoint needs to `tape` if given."""
+        d = self.d
+        x1 = phi
+        phi = self._sweep(phi, d.Ny, d.dx)
+        y1 = phi
+        phi, h1 = self.halves(phi)
+        x2 = phi
+        # adi_y_partitioned
+        phi = self._sweep(phi.T, d.Nx, d.dy).T
+        y2 = phi
+        phi, h2 = self.halves(phi)
+        if tape is not None:
+            tape.append((x1, y1, h1, x2, y2, h2))
+        return phi
+
+    def step_adjoint(self, g, saved):
+        x1, y1, h1, x2, y2, h2 = saved
+        eps = self.d.eps
+        g = self.halves_adjoint(g, h2)
+        g = _sweep_adjoint(g.T, x2.T, y2.T, self.ung_y, eps, self.block_size).T
+        g = self.halves_adjoint(g, h1)
+        return _sweep_adjoint(g, x1, y1, self.ung_x, eps, self.block_size)
+
+
+def _mask_factors(tejido, d, Nz, shape, mask_manager, dtype):
+    """Mask factor applied after every step (None for none), as in propagation._mask_step."""
+    spm = int(tejido.l_s/d.dz)
+    factors = [None] * Nz
+    mask_counter = 0
+    for k in range(Nz):
+        if k % spm == 0 and k != 0:
+            if mask_manager is None:
+                raise ValueError("The adjoint needs the same masks in every pass; pass a PhaseMaskManager")
+            if not mask_manager.masks:
+                mask_manager.initialize_masks(shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+            mask_counter = (mask_counter % 3) + 1
+            factors[k] = np.exp(1j * mask_manager.masks[mask_counter]).astype(dtype)
+    return factors
+
+
+def input_phase_gradient(amplitude, theta, tejido, d, weights, mask_manager=None,
+                         block_size=64, checkpoint_every=None, dtype=None):
+    """
+    Objective and its gradient with respect to the input phase.
+
+    Parameters:
+        amplitude (ndarray): Input amplitude A (real or complex)
+        theta (ndarray): Input phase in radians, phi_0 = A exp(i theta)
+        tejido: Tissue properties
+        d: Domain properties
+        weights (ndarray): Weights w of the objective J = sum(w |phi_N|^2), e.g. 1
+            on a focal spot and 0 elsewhere
+        mask_manager (PhaseMaskManager, optional): Phase mask manager; required if
+            a mask falls within the d.Nz steps
+        block_size (int): Block size of the partitioned tridiagonal solves
+        checkpoint_every (int, optional): Steps between stored fields; about
+            sqrt(Nz) by default
+        dtype: Complex dtype of the fields; the domain's precision by default,
+            complex128 for gradient checks
+
+    Returns:
+        tuple: (J, dJ/dtheta) with the gradient of the shape of theta
+    """
+    dtype = dtype or precision_types(d)[1]
+    # Inputs in the precision of the fields
+    real = np.finfo(dtype).dtype.type
+    amplitude = np.asarray(amplitude, dtype=dtype if np.iscomplexobj(amplitude) else real)
+    theta = np.asarray(theta, dtype=real)
+    Nz = d.Nz
+    every = checkpoint_every or max(1, int(np.sqrt(Nz)))
+    ops = _StepOperators(tejido, d, dtype, block_size)
+    masks = _mask_factors(tejido, d, Nz, theta.shape, mask_manager, dtype)
+
+    phi0 = (amplitude * np.exp(1j * theta)).astype(dtype)
+    checkpoints = {}
+    phi = phi0
+    for k in range(Nz):
+        if k % every == 0:
+            checkpoints[k] = phi
+        phi = ops.step(phi)
+        if masks[k] is not None:
+            phi = phi * masks[k]
+    J = float(np.sum(weights * (phi.real**2 + phi.imag**2)))
+
+    g = (weights * phi).astype(dtype)
+    for start in sorted(checkpoints, reverse=True):
+        stop = min(start + every, Nz)
+        tape = []
+        phi = checkpoints.pop(start)
+        for k in range(start, stop):
+            phi = ops.step(phi, tape)
+            if masks[k] is not None:
+                phi = phi * masks[k]
+        for k in range(stop - 1, start - 1, -1):
+            if masks[k] is not None:
+                g = np.conj(masks[k]) * g
+            g = ops.step_adjoint(g, tape.pop())
+
+    # dJ = 2 Re(conj(g) dphi_0) with dphi_0 = i phi_0 dtheta
+    return J, 2 * np.real(np.conj(g) * 1j * phi0)
+
+
+def propagate_output(amplitude, theta, tejido, d, mask_manager=None, block_size=64, dtype=None):
+    """Output field of the propagation differentiated by input_phase_gradient."""
+    dtype = dtype or precision_types(d)[1]
+    # Inputs in the precision of the fields
+    real = np.finfo(dtype).dtype.type
+    amplitude = np.asarray(amplitude, dtype=dtype if np.iscomplexobj(amplitude) else real)
+    theta = np.asarray(theta, dtype=real)
+    ops = _StepOperators(tejido, d, dtype, block_size)
+    masks = _mask_factors(tejido, d, d.Nz, theta.shape, mask_manager, dtype)
+    phi = (amplitude * np.exp(1j * theta)).astype(dtype)
+    for k in range(d.Nz):
+        phi = ops.step(phi)
+        if masks[k] is not None:
+            phi = phi * masks[k]
+    return phi
+
+
+def check(amplitude, theta, tejido, d, weights, mask_manager=None, block_size=64, pixels=8, h=1e-6, seed=0):
+    """
+    Check propagate_output and input_phase_gradient on a case.
+
+    The output field is compared with full_propagation_within_tissue in the
+    domain's precision, and the complex128 gradient with central finite
+    differences of the objective on random pixels, the pixel of largest
+    gradient and a random direction.
+
+    Parameters:
+        amplitude, theta, tejido, d, weights, mask_manager, block_size: As for
+            input_phase_gradient; the masks must be initialized for theta's shape
+        pixels (int): Random pixels checked
+        h (float): Finite difference step in radians
+        seed (int): Seed of the pixels and direction
+
+    Returns:
+        dict: 'forward' relative deviation of the output from
+            full_propagation_within_tissue, 'pixel' worst pixel error relative to
+            max |dJ/dtheta| and 'direction' relative error of the directional derivative
+    """
+    from deep_tissue_imaging.propagators.propagation import full_propagation_within_tissue
+
+    out = propagate_output(amplitude, theta, tejido, d, mask_manager, block_size)
+    ref = full_propagation_within_tissue(amplitude * np.exp(1j * theta), tejido, d, mask_manager)[-1]
+    forward = float(np.max(np.abs(out - ref)) / np.max(np.abs(ref)))
+
+    def objective(t):
+        phi = propagate_output(amplitude, t, tejido, d, mask_manager, block_size, np.complex128)
+        return np.sum(weights * (phi.real**2 + phi.imag**2))
+
+    theta = np.asarray(theta, dtype=np.float64)
+    _, grad = input_phase_gradient(amplitude, theta, tejido, d, weights, mask_manager, block_size,
+                                   dtype=np.complex128)
+    rng = np.random.default_rng(seed)
+    worst = 0.0
+    for i in [*rng.choice(theta.size, pixels, replace=False), np.argmax(np.abs(grad))]:
+        e = np.zeros_like(theta)
+        e.flat[i] = h
+        fd = (objective(theta + e) - objective(theta - e)) / (2 * h)
+        worst = max(worst, abs(fd - grad.flat[i]) / np.max(np.abs(grad)))
+    direction = rng.normal(size=theta.shape)
+    fd = (objective(theta + h * direction) - objective(theta - h * direction)) / (2 * h)
+    adjoint = np.sum(grad * direction)
+    return {'forward': forward, 'pixel': float(worst), 'direction': float(abs(fd - adjoint) / abs(adjoint))}
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra
+
+    # Strong losses and Kerr phase so that every adjoint term matters, masks after steps 10 and 20
+    class tejido(cerebro_emb_pez_cebra):
+        l_s = np.float32(60e-6)
+        alpha = np.float32(2e3)
+        beta = np.float32(2e-7)
+        n2 = np.float32(2e-16)
+
+    d = build_domain(30e-6, 30e-6, 150e-6, 32, 32, 25, laser, tejido)
+    rng = np.random.default_rng(1)
+    amplitude = np.abs(campo_tem00(d.X, d.Y, laser.w0 * 2, laser.I_peak)).astype(np.float64)
+    theta = rng.normal(scale=0.5, size=amplitude.shape)
+    weights = ((d.X - 2e-6)**2 + d.Y**2 < (2e-6)**2).astype(np.float64)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        masks = PhaseMaskManager(tmp)
+        masks.initialize_masks(theta.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+
+        errors = check(amplitude, theta, tejido, d, weights, masks)
+        print(f"forward against full_propagation_within_tissue (complex64): relative error {errors['forward']:.1e}")
+        print(f"gradient check (complex128): worst pixel error {errors['pixel']:.1e} of max |grad|, "
+              f"directional derivative relative error {errors['direction']:.1e}")
+        # The partitioned solves round differently from adi_x/adi_y in single precision
+        assert errors['forward'] < 1e-4 and errors['pixel'] < 1e-6 and errors['direction'] < 1e-6
+
+        t0 = time.perf_counter()
+        propagate_output(amplitude, theta, tejido, d, masks)
+        t_forward = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        input_phase_gradient(amplitude, theta, tejido, d, weights, masks)
+        t_grad = time.perf_counter() - t0
+        print(f"complex64: forward {t_forward*1e3:.0f} ms, objective and gradient {t_grad*1e3:.0f} ms "
+              f"({t_grad / t_forward:.1f} forward propagations)")
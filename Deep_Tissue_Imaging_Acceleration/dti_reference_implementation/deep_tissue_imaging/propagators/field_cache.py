@@ -0,0 +1,223 @@
+"""
+Content-addressed cache of intermediate fields for incremental re-simulation.
+
+The key of plane k of a layered propagation (see layered_plan) is a hash
+chain over everything that determines it: the input field, the diffraction
+backend, and for every step before k the layer's domain and tissue constants
+and the content of any phase mask applied after it. Two runs that agree on
+steps 0..k-1 share the key of plane k however they differ deeper down, for
+instance in a deep layer's n2 or thickness or in a later mask.
+
+`run_plan_cached` looks up the deepest cached plane of a run, propagates
+only from there and stores the new planes. Planes are stored in segments
+ending at every `every`-th plane, each holding the planes since the previous
+one, so a resumed run still returns its whole history. The cache directory
+is kept under `max_bytes` by evicting the least recently used runs,
+deepest segments first, since shallow planes are shared by more runs.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.history_store import _class_constants, domain_metadata
+from deep_tissue_imaging.elementos.precision import precision_types
+from deep_tissue_imaging.propagators.layered_plan import run_plan
+
+
+def _backend_descriptor(diffraction):
+    """Class and scalar settings of a diffraction backend ('reference' for adi_x/adi_y)."""
+    if diffraction is None:
+        return 'reference'
+    settings = {name: value for name, value in sorted(vars(diffraction).items())
+                if not name.startswith('_') and isinstance(value, (bool, int, float, str, type(None)))}
+    return [type(diffraction).__name__, settings]
+
+
+def plane_keys(phi, plan, mask_manager=None, diffraction=None):
+    """
+    Hash keys of the Nz+1 planes of a propagation.
+
+    Parameters:
+        phi (ndarray): Initial complex field
+        plan (PropagationPlan): Plan from compile_plan
+        mask_manager (PhaseMaskManager, optional): Masks of the run (initialized
+            here if needed); required if the plan applies any mask
+        diffraction (optional): Diffraction backend of the run
+
+    Returns:
+        list: Hex digests, one per plane
+    """
+    if plan.mask_after.any():
+        if mask_manager is None:
+            raise ValueError("Random phase masks can't be cached; pass a PhaseMaskManager")
+        d0 = plan.layers[0].domain
+        mask_manager.initialize_masks(phi.shape, d0.X, d0.Y, d0.sigma_phi, d0.sigma_x)
+    # The input as run_plan casts it, in the precision of the plan's domain
+    phi = np.asarray(phi, dtype=precision_types(plan.layers[0].domain)[1])
+    mask_digests = {i: hashlib.sha256(np.ascontiguousarray(theta).tobytes()).hexdigest()
+                    for i, theta in (mask_manager.masks.items() if mask_manager is not None else ())}
+
+    layers = []
+    for ops in plan.layers:
+        tissue = _class_constants(ops.tejido)
+        del tissue['name']
+        layers.append(json.dumps([domain_metadata(ops.domain), tissue], sort_keys=True).encode())
+
+    h = hashlib.sha256(np.ascontiguousarray(phi).tobytes())
+    h.update(json.dumps([list(phi.shape), _backend_descriptor(diffraction)]).encode())
+    keys = [h.hexdigest()]
+    for layer, mask in zip(plan.step_layer, plan.mask_after):
+        h = hashlib.sha256(keys[-1].encode())
+        h.update(layers[layer])
+        if mask:
+            h.update(mask_digests[int(mask)].encode())
+        keys.append(h.hexdigest())
+    return keys
+
+
+class FieldCache:
+    """
+    Directory of cached history segments, bounded in size.
+
+    Parameters:
+        directory (str): Cache directory (created if needed)
+        max_bytes (int): Size above which the least recently used segments are evicted
+        every (int): Planes per stored segment; a run resumes from a multiple of it
+    """
+
+    def __init__(self, directory, max_bytes=2**30, every=10):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.every = every
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, plane, key):
+        return os.path.join(self.directory, f'{plane:06d}_{key}.npy')
+
+    def checkpoints(self, Nz):
+        """Planes that end a stored segment."""
+        return sorted(set(range(self.every, Nz + 1, self.every)) | {Nz})
+
+    def lookup(self, keys):
+        """
+        Longest run of stored segments from plane 0.
+
+        Parameters:
+            keys (list): Plane keys from plane_keys
+
+        Returns:
+            tuple: (plane, segments) where plane is the deepest plane reached and
+                segments the stored arrays of planes 1..plane in order
+        """
+        plane, segments = 0, []
+        now = time.time()
+        for c in self.checkpoints(len(keys) - 1):
+            path = self._path(c, keys[c])
+            try:
+                segment = np.load(path)
+            except (OSError, ValueError):
+                break
+            os.utime(path, (now, now))
+            segments.append(segment)
+            plane = c
+        return plane, segments
+
+    def store(self, keys, history, start=0):
+        """Store the segments of a history ending after plane `start`, then enforce the size bound."""
+        previous = 0
+        now = time.time()
+        for c in self.checkpoints(len(keys) - 1):
+            path = self._path(c, keys[c])
+            if c > start and not os.path.exists(path):
+                fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, history[previous + 1:c + 1])
+                os.replace(tmp, path)
+                # Same time for every segment of the run, so eviction order within it is by depth
+                os.utime(path, (now, now))
+            previous = c
+        self.evict()
+
+    def size(self):
+        """Total size of the stored segments in bytes."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.npy'))
+
+    def evict(self):
+        """Delete segments, least recently used and deepest first, until the cache fits in max_bytes."""
+        entries = sorted((entry.stat().st_mtime, -int(entry.name[:6]), entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.directory) if entry.name.endswith('.npy'))
+        total = sum(size for _, _, size, _ in entries)
+        for _, _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def run_plan_cached(phi, plan, cache, mask_manager=None, diffraction=None):
+    """
+    run_plan resumed from the deepest plane in the cache.
+
+    Parameters:
+        phi (ndarray): Initial complex field, cast to the precision of the plan's domain
+        plan (PropagationPlan): Plan from compile_plan
+        cache (FieldCache): Field cache
+        mask_manager (PhaseMaskManager, optional): Phase mask manager; required if
+            the plan applies any mask
+        diffraction (optional): Diffraction backend (see hardware.diffraction_backend)
+
+    Returns:
+        tuple: (phi_history, resumed_from) with the full history and the plane the
+            propagation resumed from (0 if nothing was cached, plan.Nz if all was)
+    """
+    phi = np.asarray(phi, dtype=precision_types(plan.layers[0].domain)[1])
+    keys = plane_keys(phi, plan, mask_manager, diffraction)
+    start, segments = cache.lookup(keys)
+
+    if start == plan.Nz:
+        phi_history = np.empty((plan.Nz + 1, *phi.shape), dtype=phi.dtype)
+    else:
+        resume = segments[-1][-1] if segments else phi
+        phi_history = run_plan(resume, plan, mask_manager, diffraction, start)
+    phi_history[0] = phi
+    if segments:
+        phi_history[1:start + 1] = np.concatenate(segments)
+
+    cache.store(keys, phi_history, start)
+    return phi_history, start
+
+
+if __name__ == "__main__":
+    import time
+
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra, materia_blanca
+    from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+    from deep_tissue_imaging.propagators.layered_plan import compile_plan
+
+    d = build_domain(45e-6, 45e-6, 150e-6, 128, 128, 150, laser, cerebro_emb_pez_cebra, eps=1e-3)
+    phi0 = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+    backend = SoftwareDiffraction(block_size=64)
+
+    # Sweep the Kerr coefficient of the deepest layer
+    with tempfile.TemporaryDirectory() as tmp:
+        masks = PhaseMaskManager(os.path.join(tmp, 'masks'))
+        cache = FieldCache(os.path.join(tmp, 'fields'), max_bytes=64 * 2**20)
+        for n2 in (2.5e-20, 5e-20, 1e-19):
+            deep = type('materia_blanca_n2', (materia_blanca,), {'n2': np.float32(n2)})
+            plan = compile_plan([(cerebro_emb_pez_cebra, 100e-6), (deep, 50e-6)], d)
+            t0 = time.perf_counter()
+            history, resumed = run_plan_cached(phi0, plan, cache, masks, backend)
+            t_cached = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            reference = run_plan(phi0, plan, masks, backend)
+            t_full = time.perf_counter() - t0
+            print(f"n2 = {n2:.1e}: resumed from plane {resumed}, {t_cached:.2f} s against {t_full:.2f} s, "
+                  f"max deviation {np.max(np.abs(history - reference)):.1e}, cache {cache.size() / 2**20:.1f} MB")
@@ -0,0 +1,253 @@
+"""
+Compiled propagation plans for layered tissues.
+
+A sample is a stack of layers, each a tissue class (n_0, Dn, l_s, alpha,
+beta, n2, as in tejidos) with a thickness. `compile_plan` resolves the stack
+once against a domain: the number of z-steps of every layer, the operator
+factors of every layer (wavenumber, loss and Kerr factors, mask phase
+deviation) and the steps after which a random phase mask is applied.
+`run_plan` then executes the schedule as runs of identical steps between
+mask insertions, without recomputing coefficients or deciding on masks at
+every step.
+
+Masks follow full_propagation_within_tissue: one after every l_s/dz steps,
+counted across layer interfaces with the l_s of the current layer, cycling
+through mask indices 1, 2, 3. A single-layer plan reproduces
+full_propagation_within_tissue.
+"""
+
+import copy
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.precision import field_types, precision_types
+import deep_tissue_imaging.propagators.step_operators as so
+
+
+class LayerOperators:
+    """
+    Operator factors of one layer on a domain, in the domain's precision.
+
+    Attributes:
+        domain (Domain): The domain with the layer's k and sigma_phi
+        lin (real): Amplitude factor of half_linear_absorption
+        tpa (real): Coefficient of |phi|^2 in half_2photon_absorption
+        kerr (real): Coefficient of |phi|^2 in the half_nonlinear phase
+    """
+
+    def __init__(self, tejido, d):
+        real = precision_types(d)[0]
+        self.tejido = tejido
+        self.domain = copy.copy(d)
+        self.domain.k = real(d.k0 * tejido.n_0)
+        self.domain.sigma_phi = real(self.domain.k * tejido.Dn * tejido.l_s)
+        self.lin = np.exp(real(-tejido.alpha * d.dz / 4))
+        self.tpa = real(tejido.beta * d.dz / 4)
+        self.kerr = real(self.domain.k * tejido.n2 * d.dz / 2)
+        self.spm = int(tejido.l_s / d.dz)
+
+
+class PropagationPlan:
+    """
+    Flat schedule of a layered propagation.
+
+    Attributes:
+        layers (list): LayerOperators of every layer
+        Nz (int): Total number of z-steps
+        step_layer (ndarray): Layer index of every step
+        mask_after (ndarray): Mask index (1, 2, 3) applied after every step, 0 for none
+        segments (list): (layer, start, stop, mask) runs of steps start..stop-1 of
+            one layer, followed by mask `mask` (0 for none)
+        z_positions (ndarray): z of the Nz+1 planes of the history in meters
+    """
+
+    def __init__(self, layers, step_layer, mask_after, dz):
+        self.layers = layers
+        self.step_layer = step_layer
+        self.mask_after = mask_after
+        self.Nz = len(step_layer)
+        self.z_positions = np.arange(self.Nz + 1) * dz
+
+        self.segments = []
+        start = 0
+        for k in range(self.Nz):
+            last = k == self.Nz - 1
+            if mask_after[k] or last or step_layer[k + 1] != step_layer[k]:
+                self.segments.append((int(step_layer[k]), start, k + 1, int(mask_after[k])))
+                start = k + 1
+
+    def interfaces(self):
+        """z positions in meters of the layer interfaces."""
+        steps = np.flatnonzero(np.diff(self.step_layer)) + 1
+        return self.z_positions[steps]
+
+
+def compile_plan(layers, d):
+    """
+    Compile a stack of layers into a propagation plan.
+
+    Parameters:
+        layers (list): (tejido, thickness) pairs from the surface down, thickness in meters
+        d (Domain): Domain with the grid and dz (its Nz, k and sigma_phi are replaced
+            by the plan's)
+
+    Returns:
+        PropagationPlan: The compiled plan
+    """
+    operators = []
+    step_layer = []
+    for i, (tejido, thickness) in enumerate(layers):
+        n_steps = int(round(thickness / d.dz))
+        if n_steps < 1:
+            raise ValueError(f"Layer {i} ({thickness*1e6:.2f} µm) is thinner than one z-step "
+                             f"({d.dz*1e6:.2f} µm)")
+        operators.append(LayerOperators(tejido, d))
+        step_layer += [i] * n_steps
+    step_layer = np.array(step_layer, dtype=np.int32)
+
+    # Mask after step k when at least l_s/dz steps of the current layer have passed
+    # since the last one (more if a thinner layer starts past its l_s); for one
+    # layer this is `k % spm == 0 and k != 0`
+    mask_after = np.zeros(len(step_layer), dtype=np.int8)
+    last_mask, mask_counter = 0, 0
+    for k, layer in enumerate(step_layer):
+        if k - last_mask >= operators[layer].spm:
+            mask_counter = (mask_counter % 3) + 1
+            mask_after[k] = mask_counter
+            last_mask = k
+
+    return PropagationPlan(operators, step_layer, mask_after, d.dz)
+
+
+def _half_operators(phi, I, ops):
+    """
+    half_2photon_absorption, half_nonlinear and half_linear_absorption from the
+    intensity I of phi. Returns the field and its intensity.
+    """
+    tpa = np.exp(-ops.tpa * I)
+    I = I * tpa * tpa
+    phi = phi * (tpa * ops.lin) * np.exp(field_types(phi)[1](1j * ops.kerr) * I)
+    return phi, I * (ops.lin * ops.lin)
+
+
+def _intensity(phi):
+    return phi.real**2 + phi.imag**2
+
+
+def _layer_step(phi, ops, diffraction):
+    d = ops.domain
+    if diffraction is not None and not hasattr(diffraction, 'propagate_x'):
+        # Fused backend, as propagation._after_diffraction
+        phi = diffraction.propagate(phi, d)
+        phi, I = _half_operators(phi, _intensity(phi), ops)
+        return _half_operators(phi, I, ops)[0]
+
+    phi = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx) if diffraction is None else diffraction.propagate_x(phi, d)
+    phi = _half_operators(phi, _intensity(phi), ops)[0]
+    phi = so.adi_y(phi, d.Nx, d.eps, d.k, d.dz, d.dy) if diffraction is None else diffraction.propagate_y(phi, d)
+    return _half_operators(phi, _intensity(phi), ops)[0]
+
+
+def run_plan(phi, plan, mask_manager=None, diffraction=None, start=0):
+    """
+    Propagate a field through a compiled plan.
+
+    Parameters:
+        phi (ndarray): Initial complex field, or the field at plane `start`, cast to
+            the precision of the plan's domain
+        plan (PropagationPlan): Plan from compile_plan
+        mask_manager (PhaseMaskManager, optional): Phase mask manager for consistent
+            masks; the masks are initialized with the first layer's sigma_phi and
+            scaled by each layer's sigma_phi
+        diffraction (optional): Diffraction backend (see hardware.diffraction_backend);
+            the reference adi_x/adi_y operators are used if not provided
+        start (int): Plane to resume from (with any mask due after step start-1
+            already applied to phi); the planes before it are left zero
+
+    Returns:
+        ndarray: History of the field propagation, of shape (plan.Nz+1, *phi.shape)
+    """
+    real, cplx = precision_types(plan.layers[0].domain)
+    phi = np.asarray(phi, dtype=cplx)
+    phi_history = np.zeros((plan.Nz + 1, *phi.shape), dtype=cplx)
+    phi_history[start] = phi
+
+    # Mask exponentials of every (layer, mask) inserted by the plan, computed once
+    factors = {}
+    if mask_manager is not None:
+        d0 = plan.layers[0].domain
+        mask_manager.initialize_masks(phi.shape, d0.X, d0.Y, d0.sigma_phi, d0.sigma_x)
+        for layer, _, _, mask in plan.segments:
+            if mask and (layer, mask) not in factors:
+                scale = plan.layers[layer].domain.sigma_phi / d0.sigma_phi
+                factors[layer, mask] = np.exp(cplx(1j) * (real(scale) * mask_manager.masks[mask].astype(real)))
+
+    for layer, first, stop, mask in plan.segments:
+        if stop <= start:
+            continue
+        ops = plan.layers[layer]
+        for k in range(max(first, start), stop):
+            phi = _layer_step(phi, ops, diffraction)
+            phi_history[k + 1] = phi
+        if mask:
+            if mask_manager is not None:
+                phi = phi * factors[layer, mask]
+            else:
+                d = ops.domain
+                phi = so.aplicar_mascara_fase_aleatoria(phi, d.X, d.Y, d.sigma_phi, d.sigma_x)
+            phi_history[stop] = phi
+
+    return phi_history
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra, materia_blanca
+    from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+    import deep_tissue_imaging.propagators.propagation as prop
+
+    # With eps=1e-12 the transparent boundary ratios of the scattered tail at the
+    # grid edge amplify rounding noise after the white matter mask
+    d = build_domain(45e-6, 45e-6, 150e-6, 128, 128, 150, laser, cerebro_emb_pez_cebra, eps=1e-3)
+    phi0 = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+    backend = SoftwareDiffraction(block_size=64)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        masks = PhaseMaskManager(tmp)
+
+        t0 = time.perf_counter()
+        reference = prop.full_propagation_within_tissue(phi0, cerebro_emb_pez_cebra, d, masks, backend,
+                                                        fast_linear=False)
+        t_ref = time.perf_counter() - t0
+        plan = compile_plan([(cerebro_emb_pez_cebra, 150e-6)], d)
+        t0 = time.perf_counter()
+        single = run_plan(phi0, plan, masks, backend)
+        t_plan = time.perf_counter() - t0
+        err = np.max(np.abs(single - reference)) / np.max(np.abs(reference))
+        print(f"one layer: full_propagation_within_tissue {t_ref:.2f} s, plan {t_plan:.2f} s, "
+              f"relative error {err:.1e}")
+
+        # A thinner layer that starts past its own l_s since the last mask inserts one at
+        # its first step, then one every l_s
+        class capa_fina(cerebro_emb_pez_cebra):
+            l_s = np.float32(50e-6)
+
+        thin = compile_plan([(cerebro_emb_pez_cebra, 110e-6), (capa_fina, 290e-6)], d)
+        expected = [110] + list(range(160, 400, 50))
+        assert list(np.flatnonzero(thin.mask_after)) == expected, np.flatnonzero(thin.mask_after)
+        assert list(thin.mask_after[expected]) == [1, 2, 3, 1, 2, 3]
+
+        stack = [(cerebro_emb_pez_cebra, 40e-6), (materia_blanca, 70e-6), (cerebro_emb_pez_cebra, 40e-6)]
+        plan = compile_plan(stack, d)
+        t0 = time.perf_counter()
+        layered = run_plan(phi0, plan, masks, backend)
+        t_plan = time.perf_counter() - t0
+        power = np.sum(np.abs(layered)**2, axis=(1, 2))
+        print(f"three layers: {plan.Nz} steps in {len(plan.segments)} segments, interfaces at "
+              f"{np.round(plan.interfaces() * 1e6, 1)} µm, masks after steps {np.flatnonzero(plan.mask_after)}, "
+              f"{t_plan:.2f} s, transmitted power {power[-1] / power[0]:.3f}")
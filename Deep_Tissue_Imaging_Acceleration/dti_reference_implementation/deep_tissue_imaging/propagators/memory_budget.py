@@ -0,0 +1,270 @@
+"""
+Memory budgets for the propagation entry points.
+
+Before a run, `MemoryBudget.make_plan` estimates its peak memory from the grid,
+the number of planes kept and the batch size, and picks the cheapest policy
+that fits the limit:
+
+    1. the whole history in memory
+    2. a smaller batch (compute_psf), which bounds the working fields
+    3. every plane spilled to a history file (if spill_dir is set), lossless
+    4. every n-th plane kept in memory, n as small as fits (the last plane is
+       always kept)
+
+`MemoryBudget.report` holds the estimate and, for a budget built with
+measure=True, the measured peak: the growth of the process's peak resident
+set over the run, which Linux lets us reset through /proc/self/clear_refs.
+Elsewhere the lifetime ru_maxrss is used, which only bounds the run's peak
+once it exceeds the earlier ones. (tracemalloc would be exact but slows the
+reference operators, which allocate per row, by an order of magnitude.)
+Resetting the peak and trimming the heap act on the whole process, so
+measuring is opt-in, for one run at a time in a process. A plan that
+doesn't fit even with one plane per batch raises MemoryError before anything
+is allocated.
+
+The working memory per field (WORKING_FIELDS) was measured on 128x128 and
+256x256 grids as growth of the resident set: about 7 field-sized buffers for
+the reference adi_x/adi_y operators and 16 for the partitioned solver and
+the batched steps. Of these, the numpy allocations (tracemalloc) are about 4
+and 12; the rest is allocator overhead.
+"""
+
+import ctypes
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.history_store import HistoryFile, HistoryWriter
+
+logger = logging.getLogger(__name__)
+
+# Peak field-sized buffers per field during a step, on top of the history,
+# in resident set (allocator overhead included)
+WORKING_FIELDS = {'reference': 7, 'partitioned': 16}
+
+# A spilled history holds a chunk of slices, their stacked and byte-shuffled
+# copies and the compressed bytes: up to 4 chunks of fields
+SPILL_CHUNK = 8
+
+
+class MemoryBudget:
+    """
+    Peak memory limit of a run, with its plan and report.
+
+    Parameters:
+        limit (int): Budget in bytes
+        spill_dir (str, optional): Directory for spilled histories; without it
+            the plan decimates instead of spilling
+        measure (bool): Measure the run's peak resident set. This resets the
+            process's peak counter and trims its heap, so the peak of concurrent
+            runs is mixed in and theirs is reset
+
+    Attributes:
+        plan (dict): Policy of the last run ('batch', 'decimate', 'spill', 'planes',
+            'estimate' in bytes)
+        report (dict): 'limit', 'estimate' and measured 'peak' (None unless measuring)
+            of the last run in bytes
+    """
+
+    def __init__(self, limit, spill_dir=None, measure=False):
+        self.limit = int(limit)
+        self.spill_dir = spill_dir
+        self.measure = measure
+        self.plan = None
+        self.report = None
+        self._baseline = None
+
+    @classmethod
+    def of(cls, budget):
+        """A MemoryBudget from a byte count, or the budget itself."""
+        return cls(budget) if isinstance(budget, (int, float, np.number)) else budget
+
+    def estimate(self, shape, Nz, batch=1, decimate=1, spill=False, working='reference', itemsize=8, stored=None,
+                 dtype=np.complex64):
+        """
+        Peak memory of a run in bytes.
+
+        Parameters:
+            shape (tuple): Field shape (Ny, Nx)
+            Nz (int): Number of z-steps
+            batch (int): Fields propagated together
+            decimate (int): Keep every decimate-th plane
+            spill (bool): Planes go to a history file instead of memory
+            working (str): Step operators, a key of WORKING_FIELDS
+            itemsize (int): Bytes per stored history element (8 complex64, 4 intensity)
+            stored (int, optional): Histories kept, batch by default (compute_psf keeps
+                the volumes of every field whatever its batch)
+            dtype: Complex dtype of the propagated fields (the domain's precision)
+
+        Returns:
+            int: Estimated peak bytes
+        """
+        field = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        working = WORKING_FIELDS[working] * batch * field
+        if spill:
+            return working + 4 * SPILL_CHUNK * field
+        planes = len(kept_planes(Nz, decimate))
+        return working + planes * (stored or batch) * int(np.prod(shape)) * itemsize
+
+    def make_plan(self, shape, Nz, batch=1, working='reference', itemsize=None, can_spill=True, dtype=np.complex64):
+        """
+        Cheapest policy within the limit (see the module docstring); also stored in self.plan.
+        Takes the arguments of estimate; itemsize defaults to that of dtype.
+
+        Returns:
+            dict: 'batch', 'decimate', 'spill', 'planes' and 'estimate'
+        """
+        itemsize = itemsize or np.dtype(dtype).itemsize
+
+        def plan(b, n, spill):
+            return {'batch': b, 'decimate': n, 'spill': spill,
+                    'planes': kept_planes(Nz, n),
+                    'estimate': self.estimate(shape, Nz, b, n, spill, working, itemsize, batch, dtype)}
+
+        candidates = [plan(batch, 1, False)]
+        candidates += [plan(b, 1, False) for b in range(batch - 1, 0, -1)]
+        if can_spill and self.spill_dir is not None:
+            candidates.append(plan(1, 1, True))
+        candidates += [plan(1, n, False) for n in range(2, Nz + 1)]
+        for candidate in candidates:
+            if candidate['estimate'] <= self.limit:
+                self.plan = candidate
+                return candidate
+        raise MemoryError(f"A run on {shape} needs at least {candidates[-1]['estimate'] / 2**20:.1f} MB, "
+                          f"the budget is {self.limit / 2**20:.1f} MB")
+
+    def start(self):
+        """If measuring, reset the peak resident set and record the current one."""
+        if not self.measure:
+            return
+        _release_free_heap()
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        self._baseline = _resident()[0]
+
+    def finish(self):
+        """Fill self.report; logs it and warns if the measured peak exceeds the limit."""
+        peak = None
+        if self._baseline is not None:
+            peak = _resident()[1] - self._baseline
+            self._baseline = None
+        self.report = {'limit': self.limit, 'estimate': self.plan['estimate'], 'peak': peak}
+        level = logging.WARNING if peak is not None and peak > self.limit else logging.INFO
+        logger.log(level, "memoria: pico %s, estimado %.1f MB, limite %.1f MB",
+                   'no medido' if peak is None else f'{peak / 2**20:.1f} MB',
+                   self.plan['estimate'] / 2**20, self.limit / 2**20,
+                   extra={'memory': dict(self.report, **{k: self.plan[k] for k in ('batch', 'decimate', 'spill')})})
+        return self.report
+
+
+def _release_free_heap():
+    """Return the allocator's free pages to the OS, so a run can't hide its peak in them (glibc only)."""
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _resident():
+    """(current, peak) resident set of the process in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return peak, peak
+
+
+def kept_planes(Nz, decimate):
+    """Planes kept with a decimation factor: every decimate-th plane and the last one."""
+    planes = list(range(0, Nz + 1, decimate))
+    if planes[-1] != Nz:
+        planes.append(Nz)
+    return planes
+
+
+class BudgetedHistory:
+    """
+    History of one run stored under a MemoryBudget plan.
+
+    Parameters:
+        plan (dict): Plan from MemoryBudget.make_plan
+        shape (tuple): Field shape (Ny, Nx)
+        spill_dir (str, optional): Directory of the spilled history file
+        metadata (dict, optional): Run metadata for a spilled history (see run_metadata)
+        dtype: Complex dtype of the planes, kept in memory or spilled losslessly
+    """
+
+    def __init__(self, plan, shape, spill_dir=None, metadata=None, dtype=np.complex64):
+        self._index = {plane: i for i, plane in enumerate(plan['planes'])}
+        self._writer = None
+        if plan['spill']:
+            fd, self.path = tempfile.mkstemp(dir=spill_dir, prefix='history_', suffix='.dtih')
+            os.close(fd)
+            self._writer = HistoryWriter(self.path, shape, np.dtype(dtype).name, chunk=SPILL_CHUNK,
+                                         metadata=dict(metadata or {}, planes=plan['planes']))
+        else:
+            self._array = np.zeros((len(plan['planes']), *shape), dtype=dtype)
+
+    def store(self, plane, phi):
+        """Keep plane `plane` if the plan does."""
+        if plane in self._index:
+            if self._writer is not None:
+                self._writer.append(phi)
+            else:
+                self._array[self._index[plane]] = phi
+
+    def result(self):
+        """The kept planes: an array, or a HistoryFile if spilled."""
+        if self._writer is None:
+            return self._array
+        self._writer.close()
+        return HistoryFile(self.path)
+
+
+if __name__ == "__main__":
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00, campo_gaussiano_enfocado
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+    from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+    from deep_tissue_imaging.propagators.propagation import compute_psf, full_propagation_within_tissue
+
+    # eps=1e-1: on 256x256 the boundary ratios of the focused beams go unstable with 1e-2
+    d = build_domain(45e-6, 45e-6, 100e-6, 256, 256, 100, laser, tejido, eps=1e-1)
+    phi0 = campo_tem00(d.X, d.Y, laser.w0, laser.I_peak)
+    full = full_propagation_within_tissue(phi0, tejido, d)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for limit, spill_dir, diffraction in ((64 * 2**20, None, None), (24 * 2**20, None, None),
+                                              (24 * 2**20, tmp, None), (24 * 2**20, tmp, SoftwareDiffraction(64))):
+            budget = MemoryBudget(limit, spill_dir, measure=True)
+            history = full_propagation_within_tissue(phi0, tejido, d, diffraction=diffraction, memory_budget=budget)
+            p, r = budget.plan, budget.report
+            planes = p['planes']
+            dev = max(float(np.max(np.abs(history[i] - full[plane]))) for i, plane in enumerate(planes)
+                      if i % 10 == 0) / float(np.max(np.abs(full)))
+            print(f"budget {limit / 2**20:.0f} MB{' + spill' if spill_dir else ''}"
+                  f"{' (partitioned)' if diffraction else ''}: decimate {p['decimate']}, spill {p['spill']}, "
+                  f"{len(planes)} planes, estimate {r['estimate'] / 2**20:.1f} MB, peak {r['peak'] / 2**20:.1f} MB, "
+                  f"max relative deviation {dev:.1e}")
+
+    phis = np.stack([campo_gaussiano_enfocado(d.X, d.Y, laser.w0, laser.I_peak, d.k, z) for z in (40e-6, 60e-6, 80e-6)])
+    volumes, params = compute_psf(phis, tejido, d, metrics=True)
+    for limit in (128 * 2**20, 48 * 2**20):
+        budget = MemoryBudget(limit, measure=True)
+        budgeted, budgeted_params = compute_psf(phis, tejido, d, memory_budget=budget)
+        p, r = budget.plan, budget.report
+        dev = float(np.max(np.abs(budgeted - volumes[:, p['planes']])) / np.max(volumes))
+        print(f"compute_psf, 3 beams, budget {limit / 2**20:.0f} MB: batch {p['batch']}, decimate {p['decimate']}, "
+              f"estimate {r['estimate'] / 2**20:.1f} MB, peak {r['peak'] / 2**20:.1f} MB, max relative deviation {dev:.1e}, "
+              f"z_focus {[round(q['z_focus'] * 1e6) for q in budgeted_params]} µm "
+              f"(full {[round(q['z_focus'] * 1e6) for q in params]} µm)")
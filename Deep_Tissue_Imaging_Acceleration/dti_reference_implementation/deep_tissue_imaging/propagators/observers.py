@@ -0,0 +1,209 @@
+"""
+Observers of the propagation loop.
+
+An observer is any callable `observer(z, phi, stats)`, passed in the
+`observers` list of full_propagation_within_tissue. It is called with the
+field after the steps that are a multiple of its `every` attribute (every
+step if it has none), including plane 0 before the first step. `stats` is
+a dict with:
+
+    'step'    index of the plane (0..Nz)
+    'linear'  whether the step ran linear_step_within_tissue
+    'mask'    index of the phase mask applied after the step, 0 if none
+
+The field is the loop's own array: observers must not modify it, and must
+copy it to keep it. Without observers the loop does no extra work.
+
+Mask insertions and regime changes are logged on the
+`deep_tissue_imaging.propagators.propagation` logger with their values in
+the record (`record.step`, `record.mask`, `record.peak`, ...).
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class BeamDiagnostics:
+    """
+    Power budget and beam moments every `every` steps.
+
+    Each record holds the plane's power, peak intensity, centroid and
+    second-moment widths (2 sigma, the 1/e^2 radius of a Gaussian), and the
+    power lost since plane 0 split into linear absorption, two-photon
+    absorption and the rest (outflow at the transparent boundaries; the
+    masks are phase-only). The absorption losses use the factors of the
+    step operators, exp(-beta dz/2 I) and exp(-alpha dz/2) on the intensity
+    per half step. A step ends with one half, whose input is recovered
+    exactly from the plane it produced by inverting them. The other half
+    acts after adi_x, on an intensity between the previous plane and that
+    input, and is taken at their mean. With every=1 this leaves in the rest
+    0.04% of the two-photon loss in the demo, against 0.3% for the rates
+    alpha P and beta ∫I² dA integrated by the trapezoidal rule. With
+    every > 1 the losses of the steps between records are interpolated
+    linearly, an estimate.
+
+    The intensity goes to two scratch buffers allocated at the first call;
+    the moments are dot products of its row and column sums.
+
+    Parameters:
+        d: Domain properties
+        tejido: Tissue properties
+        every (int): Steps between records
+        log (bool): Also log every record on this module's logger at INFO level,
+            with the record in `record.diagnostics`
+
+    Attributes:
+        records (list): One dict per observed plane
+    """
+
+    def __init__(self, d, tejido, every=10, log=False):
+        self.every = every
+        self.log = log
+        self.records = []
+        self._dA = float(d.dx) * float(d.dy)
+        self._x = np.asarray(d.X[0], dtype=np.float64)
+        self._y = np.asarray(d.Y[:, 0], dtype=np.float64)
+        # Intensity exponents of one half of the absorption operators
+        self._alpha_half = float(tejido.alpha) * float(d.dz) / 2
+        self._beta_half = float(tejido.beta) * float(d.dz) / 2
+        self._I = None
+
+    def _intensity(self, phi):
+        if self._I is None or self._I.shape != phi.shape or self._I.dtype != phi.real.dtype:
+            self._I = np.empty(phi.shape, dtype=phi.real.dtype)
+            self._tmp = np.empty(phi.shape, dtype=phi.real.dtype)
+        np.multiply(phi.real, phi.real, out=self._I)
+        np.multiply(phi.imag, phi.imag, out=self._tmp)
+        return np.add(self._I, self._tmp, out=self._I)
+
+    def _tpa_halves(self, I):
+        """
+        Two-photon losses of the half operators around plane I.
+
+        Returns:
+            tuple: (loss of the first half of the next step applied to I, loss of
+                the last half of the step that produced I)
+        """
+        b = self._beta_half
+        if b == 0:
+            return 0.0, 0.0
+        tmp = self._tmp
+        np.multiply(I, -b, out=tmp)
+        np.expm1(tmp, out=tmp)
+        first = -float(np.vdot(I, tmp)) * self._dA
+        # The last half maps I_in to I_in exp(-b I_in), then the linear half
+        # divides by c: solve g = b I_in = b c I exp(g) by fixed point (g << 1)
+        bc = b * np.exp(self._alpha_half)
+        np.multiply(I, bc, out=tmp)
+        for _ in range(3):
+            np.exp(tmp, out=tmp)
+            np.multiply(tmp, I, out=tmp)
+            np.multiply(tmp, bc, out=tmp)
+        np.expm1(tmp, out=tmp)
+        last = float(np.exp(self._alpha_half) * np.vdot(I, tmp)) * self._dA
+        return first, last
+
+    def _step_at(self, record, nonlinear):
+        """(tpa, linear) loss of a step from a record's plane, both halves applied to it."""
+        tpa_first, tpa_last = record['_tpa'] if nonlinear else (0.0, 0.0)
+        return (tpa_first + tpa_last,
+                -np.expm1(-self._alpha_half) * (record['power'] - tpa_first) + np.expm1(self._alpha_half) * record['power'])
+
+    def __call__(self, z, phi, stats):
+        I = self._intensity(phi)
+        px = I.sum(axis=0, dtype=np.float64)
+        py = I.sum(axis=1, dtype=np.float64)
+        total = px.sum()
+        power = total * self._dA
+        x_c = px @ self._x / total
+        y_c = py @ self._y / total
+        record = {
+            'step': stats['step'],
+            'z': float(z),
+            'power': power,
+            'peak': float(I.max()),
+            'centroid_x': x_c,
+            'centroid_y': y_c,
+            'width_x': 2 * np.sqrt(max(px @ self._x**2 / total - x_c**2, 0.0)),
+            'width_y': 2 * np.sqrt(max(py @ self._y**2 / total - y_c**2, 0.0)),
+            'linear': stats['linear'],
+            'mask': stats['mask'],
+        }
+
+        record['_tpa'] = self._tpa_halves(I)
+        if self.records:
+            last = self.records[-1]
+            n = record['step'] - last['step']
+            # A linear step (see linear_step_within_tissue) has no two-photon operator
+            nonlinear = not record['linear']
+            if n == 1:
+                # The first half follows adi_x, halfway between the previous plane and
+                # the input of the last half, which follows adi_y
+                tpa_first = (last['_tpa'][0] + record['_tpa'][1]) / 2 if nonlinear else 0.0
+                tpa_last = record['_tpa'][1] if nonlinear else 0.0
+                tpa = tpa_first + tpa_last
+                linear = -np.expm1(-self._alpha_half) * (last['power'] - tpa_first) + np.expm1(self._alpha_half) * power
+            else:
+                tpa, linear = (n * (a + b) / 2 for a, b in zip(self._step_at(last, nonlinear),
+                                                               self._step_at(record, nonlinear)))
+            record['linear_loss'] = last['linear_loss'] + linear
+            record['tpa_loss'] = last['tpa_loss'] + tpa
+            record['other_loss'] = last['other_loss'] + (last['power'] - power) - linear - tpa
+        else:
+            record['linear_loss'] = record['tpa_loss'] = record['other_loss'] = 0.0
+        self.records.append(record)
+
+        if self.log:
+            logger.info("z = %.1f µm: potencia %.3e W, pico %.2e W/m²", z * 1e6, power, record['peak'],
+                        extra={'diagnostics': record})
+
+    def table(self):
+        """The records as a dict of arrays, one per quantity."""
+        keys = [key for key in self.records[0] if not key.startswith('_')] if self.records else []
+        return {key: np.array([r[key] for r in self.records]) for key in keys}
+
+
+if __name__ == "__main__":
+    import time
+
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+    from deep_tissue_imaging.propagators.propagation import full_propagation_within_tissue
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    # Below the first mask (l_s/dz = 100), where the eps=1e-2 boundary is stable
+    d = build_domain(45e-6, 45e-6, 100e-6, 128, 128, 100, laser, tejido, eps=1e-2)
+    phi0 = campo_tem00(d.X, d.Y, laser.w0, 3e14)
+
+    t0 = time.perf_counter()
+    full_propagation_within_tissue(phi0, tejido, d)
+    t_plain = time.perf_counter() - t0
+
+    diagnostics = BeamDiagnostics(d, tejido, every=1)
+    t0 = time.perf_counter()
+    full_propagation_within_tissue(phi0, tejido, d, observers=[diagnostics])
+    t_observed = time.perf_counter() - t0
+
+    t = diagnostics.table()
+    print(f"{d.Nz} steps: {t_plain:.2f} s without observers, {t_observed:.2f} s with diagnostics every step")
+    for i in range(0, d.Nz + 1, 20):
+        print(f"z = {t['z'][i]*1e6:5.1f} µm  P = {t['power'][i]:.4e} W  peak {t['peak'][i]:.2e} W/m²  "
+              f"width {t['width_x'][i]*1e6:.2f} x {t['width_y'][i]*1e6:.2f} µm  "
+              f"lost: linear {t['linear_loss'][i]:.2e}, 2-photon {t['tpa_loss'][i]:.2e}, other {t['other_loss'][i]:.2e}")
+    # The beam stays clear of the boundaries, so the rest is the splitting error
+    assert np.all(np.abs(t['other_loss']) <= 1e-3 * t['tpa_loss'] + 1e-5 * t['power'][0])
+
+    # Without absorption the rest is all there is, and the ADI sweeps conserve power
+    lossless = type('sin_perdidas', (tejido,), {'alpha': np.float32(0), 'beta': np.float32(0)})
+    diagnostics = BeamDiagnostics(d, lossless, every=1)
+    full_propagation_within_tissue(phi0, lossless, d, observers=[diagnostics])
+    t = diagnostics.table()
+    print(f"lossless tissue: linear {t['linear_loss'][-1]:.1e}, 2-photon {t['tpa_loss'][-1]:.1e}, "
+          f"max |other| {np.max(np.abs(t['other_loss'])) / t['power'][0]:.1e} of the input")
+    assert t['linear_loss'][-1] == t['tpa_loss'][-1] == 0
+    assert np.all(np.abs(t['other_loss']) <= 1e-5 * t['power'][0])
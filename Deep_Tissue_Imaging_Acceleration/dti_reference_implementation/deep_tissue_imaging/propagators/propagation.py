@@ -1,34 +1,126 @@
+import logging
+
 import numpy as np
 import deep_tissue_imaging.propagators.step_operators as so
+from deep_tissue_imaging.propagators.partitioned_solver import adi_x_partitioned
+from deep_tissue_imaging.elementos.history_store import run_metadata
+from deep_tissue_imaging.elementos.precision import field_types, precision_types
+from deep_tissue_imaging.propagators.memory_budget import BudgetedHistory, MemoryBudget
+
+logger = logging.getLogger(__name__)
+
+def _after_diffraction(phi, tejido, d):
+    # Fused backends (the overlay IP) run adi_x and adi_y back to back, so both
+    # halves of the loss and Kerr operators follow the diffraction step instead
+    # of straddling adi_y: a splitting deviation of order dz times the nonlinear
+    # phase per step, bounded in the diffraction_backend demo
+    for _ in range(2):
+        phi = so.half_2photon_absorption(phi, tejido.beta, d.dz)
+        phi = so.half_nonlinear(phi, d.k, tejido.n2, d.dz)
+        phi = so.half_linear_absorption(phi, tejido.alpha, d.dz)
+    return phi
+
+def full_step_within_tissue(phi, tejido, d, diffraction=None):
+    if diffraction is not None and not hasattr(diffraction, 'propagate_x'):
+        return _after_diffraction(diffraction.propagate(phi, d), tejido, d)
 
-def full_step_within_tissue(phi, tejido, d):
-    phi = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx)
+    if diffraction is None:
+        phi = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx)
+    else:
+        phi = diffraction.propagate_x(phi, d)
     phi = so.half_2photon_absorption(phi, tejido.beta, d.dz)
     phi = so.half_nonlinear(phi, d.k, tejido.n2, d.dz)
     phi = so.half_linear_absorption(phi, tejido.alpha, d.dz)
 
-    phi = so.adi_y(phi, d.Nx, d.eps, d.k, d.dz, d.dy)
+    if diffraction is None:
+        phi = so.adi_y(phi, d.Nx, d.eps, d.k, d.dz, d.dy)
+    else:
+        phi = diffraction.propagate_y(phi, d)
     phi = so.half_2photon_absorption(phi, tejido.beta, d.dz)
     phi = so.half_nonlinear(phi, d.k, tejido.n2, d.dz)
     phi = so.half_linear_absorption(phi, tejido.alpha, d.dz)
     return phi
 
-def full_propagation_within_tissue(phi, tejido, d, mask_manager=None):
+def nonlinear_negligible(peak, tejido, d, margin=2.0):
+    """
+    Whether the 2-photon and Kerr factors of a step round to 1 in the domain's precision.
+
+    Parameters:
+        peak (float): Peak intensity |phi|^2 of the field entering the step
+        tejido: Tissue properties
+        d: Domain properties
+        margin (float): Allowance for the peak growing within the step
+
+    Returns:
+        bool: True if both exponents stay below the resolution at 1 up to margin * peak
+    """
+    I = margin * peak
+    # Exponents below half the spacing of the floats at 1 give factors that round to 1
+    unit_roundoff = np.finfo(precision_types(d)[0]).eps / 2
+    return max(tejido.beta * d.dz / 4 * I, d.k * tejido.n2 * d.dz / 2 * I) < unit_roundoff
+
+def linear_step_within_tissue(phi, tejido, d, diffraction=None):
+    """full_step_within_tissue without the 2-photon and Kerr operators, the linear absorption as one scalar."""
+    if diffraction is not None:
+        phi = diffraction.propagate(phi, d)
+    else:
+        phi = so.adi_x(phi, d.Ny, d.eps, d.k, d.dz, d.dx)
+        phi = so.adi_y(phi, d.Nx, d.eps, d.k, d.dz, d.dy)
+    # Two half_linear_absorption factors exp(-alpha dz/4) per step
+    return np.exp(field_types(phi)[0](-tejido.alpha * d.dz / 2)) * phi
+
+def _choose_step(phi, k, tejido, d, linear, fast_linear):
+    """Decide whether step k can run linear, logging changes of regime. Returns the decision."""
+    if not fast_linear:
+        return False
+    peak = float(np.max(phi.real**2 + phi.imag**2))
+    now_linear = nonlinear_negligible(peak, tejido, d)
+    if now_linear != linear:
+        logger.info("regimen %s desde z = %d (pico %.2e W/m²)", "lineal" if now_linear else "no lineal", k, peak,
+                    extra={'step': k, 'linear': now_linear, 'peak': peak})
+    return now_linear
+
+def full_propagation_within_tissue(phi, tejido, d, mask_manager=None, diffraction=None, fast_linear=False,
+                                   observers=None, memory_budget=None):
     """
     Perform full propagation within tissue with optional phase mask management.
 
     Parameters:
-        phi (ndarray): Initial complex field
+        phi (ndarray): Initial complex field, cast to the domain's precision
         tejido: Tissue properties
         d: Domain properties
         mask_manager (PhaseMaskManager, optional): Phase mask manager for consistent masks
+        diffraction (optional): Diffraction backend (see hardware.diffraction_backend);
+            the reference adi_x/adi_y operators are used if not provided. A fused
+            backend, without propagate_x/propagate_y, applies the loss and Kerr
+            halves after the whole step (see _after_diffraction)
+        fast_linear (bool): Run linear_step_within_tissue for the steps where, from the
+            peak intensity, the 2-photon and Kerr factors round to 1 (nonlinear_negligible).
+            Opt-in: the history then differs from the full operators by rounding
+            (see benchmark.linear_fast_path_benchmark)
+        observers (list, optional): Callables observer(z, phi, stats) called every
+            `observer.every` steps (see observers, e.g. observers.BeamDiagnostics)
+        memory_budget (int or MemoryBudget, optional): Peak memory limit in bytes; the
+            history is decimated or spilled to disk to fit (see memory_budget), and
+            the MemoryBudget holds the plan and, if it measures, the peak
 
     Returns:
-        ndarray: History of the field propagation
+        ndarray: History of the field propagation; under a memory budget only the
+            planes of budget.plan['planes'], as a HistoryFile if spilled
     """
     spm = int(tejido.l_s/d.dz)
-    phi_history = np.zeros((d.Nz + 1, *phi.shape), dtype=np.complex64)
-    phi_history[0] = phi
+    phi = np.asarray(phi, dtype=precision_types(d)[1])
+    if memory_budget is None:
+        phi_history = np.zeros((d.Nz + 1, *phi.shape), dtype=phi.dtype)
+        store = phi_history.__setitem__
+    else:
+        budget = MemoryBudget.of(memory_budget)
+        plan = budget.make_plan(phi.shape, d.Nz, working='reference' if diffraction is None else 'partitioned',
+                                dtype=phi.dtype)
+        budget.start()
+        history = BudgetedHistory(plan, phi.shape, budget.spill_dir, run_metadata(d, tejido), dtype=phi.dtype)
+        store = history.store
+    store(0, phi)
 
     # Initialize masks at the beginning if mask_manager is provided
     if mask_manager is not None:
@@ -36,25 +128,208 @@ def full_propagation_within_tissue(phi, tejido, d, mask_manager=None):
 
     # Track which mask to use (1, 2, 3)
     mask_counter = 0
+    linear = False
+    if observers:
+        _notify(observers, 0, phi, d, spm, linear)
 
     for k in range(0, d.Nz):
-        phi = full_step_within_tissue(phi, tejido, d)
-        if k % spm == 0 and k != 0:
-            # Increment mask counter (1, 2, 3, 1, 2, 3, ...)
-            mask_counter = (mask_counter % 3) + 1
-
-            if mask_manager is not None:
-                # Use the mask manager with the current mask index
-                phi = mask_manager.apply_mask(phi, mask_counter)
-                print(f"aplicada mascara aleatoria {mask_counter} en z = {k}")
-            else:
-                # Use the original function if no mask manager is provided
-                phi = so.aplicar_mascara_fase_aleatoria(phi, d.X, d.Y, d.sigma_phi, d.sigma_x)
-                print(f"aplicada mascara aleatoria en z = {k}")
+        linear = _choose_step(phi, k, tejido, d, linear, fast_linear)
+        if linear:
+            phi = linear_step_within_tissue(phi, tejido, d, diffraction)
+        else:
+            phi = full_step_within_tissue(phi, tejido, d, diffraction)
+        phi, mask_counter = _mask_step(phi, k, spm, mask_counter, d, mask_manager)
+        store(k + 1, phi)
+        if observers:
+            _notify(observers, k + 1, phi, d, spm, linear)
+
+    if memory_budget is not None:
+        phi_history = history.result()
+        budget.finish()
+    return phi_history
+
+def _mask_step(phi, k, spm, mask_counter, d, mask_manager, region=None):
+    """Apply the random phase mask due after step k. Returns (phi, mask_counter)."""
+    if k % spm == 0 and k != 0:
+        # Increment mask counter (1, 2, 3, 1, 2, 3, ...)
+        mask_counter = (mask_counter % 3) + 1
+
+        if mask_manager is not None:
+            # Use the mask manager with the current mask index
+            phi = mask_manager.apply_mask(phi, mask_counter, region)
+            logger.info("aplicada mascara aleatoria %d en z = %d", mask_counter, k,
+                        extra={'step': k, 'mask': mask_counter})
+        else:
+            # Use the original function if no mask manager is provided
+            phi = so.aplicar_mascara_fase_aleatoria(phi, d.X, d.Y, d.sigma_phi, d.sigma_x)
+            logger.info("aplicada mascara aleatoria en z = %d", k, extra={'step': k, 'mask': mask_counter})
+    return phi, mask_counter
+
+def _notify(observers, step, phi, d, spm, linear):
+    """Call the observers due at plane `step` (see observers)."""
+    stats = None
+    for observer in observers:
+        if step % getattr(observer, 'every', 1) == 0:
+            if stats is None:
+                mask = ((step - 1) // spm - 1) % 3 + 1 if step > 1 and (step - 1) % spm == 0 else 0
+                stats = {'step': step, 'linear': linear, 'mask': mask}
+            observer(step * d.dz, phi, stats)
+
+async def full_propagation_within_tissue_async(phi, tejido, d, diffraction, mask_manager=None, fast_linear=False,
+                                               observers=None):
+    """
+    Full propagation within tissue with the diffraction steps awaited on a hardware backend.
+
+    Each diffraction step is queued with `diffraction.propagate_async`, so
+    several propagations gathered on one event loop interleave: the host runs
+    the loss, Kerr and mask operators of one field while the fabric computes
+    the diffraction step of another.
+
+    Parameters:
+        phi (ndarray): Initial complex field
+        tejido: Tissue properties
+        d: Domain properties
+        diffraction (OverlayDiffraction): Backend with `propagate_async`
+        mask_manager (PhaseMaskManager, optional): Phase mask manager for consistent masks
+        fast_linear (bool): Skip the 2-photon and Kerr operators where they round to 1,
+            as in full_propagation_within_tissue
+        observers (list, optional): Observers of the loop, as in full_propagation_within_tissue
+
+    Returns:
+        ndarray: History of the field propagation
+    """
+    spm = int(tejido.l_s/d.dz)
+    phi = np.asarray(phi, dtype=precision_types(d)[1])
+    phi_history = np.zeros((d.Nz + 1, *phi.shape), dtype=phi.dtype)
+    phi_history[0] = phi
 
+    if mask_manager is not None:
+        mask_manager.initialize_masks(phi.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+
+    mask_counter = 0
+    linear = False
+    if observers:
+        _notify(observers, 0, phi, d, spm, linear)
+
+    for k in range(0, d.Nz):
+        linear = _choose_step(phi, k, tejido, d, linear, fast_linear)
+        phi = await diffraction.propagate_async(phi, d)
+        if linear:
+            phi = np.exp(field_types(phi)[0](-tejido.alpha * d.dz / 2)) * phi
+        else:
+            phi = _after_diffraction(phi, tejido, d)
+        phi, mask_counter = _mask_step(phi, k, spm, mask_counter, d, mask_manager)
         phi_history[k + 1] = phi
+        if observers:
+            _notify(observers, k + 1, phi, d, spm, linear)
 
     return phi_history
 
-def compute_psf(phi, tejido, dominio):
-    pass
+def _full_step_batch(phi, tejido, d, block_size, linear=False):
+    """
+    full_step_within_tissue on a batch of fields (B, Ny, Nx), every column of every
+    field solved at once; linear_step_within_tissue if `linear`.
+    """
+    B, ny, nx = phi.shape
+    # adi_x solves along axis 0 of each field: side by side, the fields are one wide grid
+    m = block_size if ny % block_size == 0 else ny
+    wide = phi.transpose(1, 0, 2).reshape(ny, B * nx)
+    wide = adi_x_partitioned(wide, B * nx, d.eps, d.k, d.dz, d.dx, m)
+    phi = wide.reshape(ny, B, nx).transpose(1, 0, 2)
+    if not linear:
+        phi = _half_operators(phi, tejido, d)
+
+    m = block_size if nx % block_size == 0 else nx
+    tall = phi.transpose(2, 0, 1).reshape(nx, B * ny)
+    tall = adi_x_partitioned(tall, B * ny, d.eps, d.k, d.dz, d.dy, m)
+    phi = tall.reshape(nx, B, ny).transpose(1, 2, 0)
+    if linear:
+        return np.exp(field_types(phi)[0](-tejido.alpha * d.dz / 2)) * phi
+    return _half_operators(phi, tejido, d)
+
+def _half_operators(phi, tejido, d, k=None):
+    phi = so.half_2photon_absorption(phi, tejido.beta, d.dz)
+    phi = so.half_nonlinear(phi, d.k if k is None else k, tejido.n2, d.dz)
+    return so.half_linear_absorption(phi, tejido.alpha, d.dz)
+
+def compute_psf(phi, tejido, dominio, mask_manager=None, block_size=64, metrics=True, memory_budget=None):
+    """
+    Compute the 3-D PSF of a batch of input fields through one tissue realization.
+
+    All the fields (e.g. beams focused at several depths or lateral offsets,
+    see lasers.campo_gaussiano_enfocado) advance together: each ADI sweep
+    solves the tridiagonal systems of every field in one partitioned solve,
+    so the coefficients and shared spikes are built once per step for the
+    whole batch, and every field sees the same phase masks.
+
+    Parameters:
+        phi (ndarray): Input fields, shape (B, Ny, Nx), or one field (Ny, Nx), cast to
+            the domain's precision
+        tejido: Tissue properties
+        dominio: Domain properties
+        mask_manager (PhaseMaskManager, optional): Phase mask manager for consistent
+            masks; without it, one random mask per insertion is applied to every field
+        block_size (int): Block size of the partitioned tridiagonal solves
+            (a whole row or column if it does not divide the grid)
+        metrics (bool): Measure medir_psf_params for every field
+        memory_budget (int or MemoryBudget, optional): Peak memory limit in bytes; the
+            fields run in smaller batches, then the volumes are decimated in z to fit
+            (see memory_budget), and the MemoryBudget holds the plan and, if it
+            measures, the peak
+
+    Returns:
+        tuple: (volumes, params) with the intensity volumes of shape (B, Nz+1, Ny, Nx)
+            (under a memory budget, only the planes of budget.plan['planes']) and a list
+            with the medir_psf_params dict of every field at its focal plane (the plane
+            of maximum intensity), or None if metrics is False
+    """
+    d = dominio
+    real, cplx = precision_types(d)
+    phi = np.asarray(phi, dtype=cplx)
+    if phi.ndim == 2:
+        phi = phi[None]
+    spm = int(tejido.l_s/d.dz)
+
+    batch, planes = phi.shape[0], list(range(d.Nz + 1))
+    if memory_budget is not None:
+        budget = MemoryBudget.of(memory_budget)
+        plan = budget.make_plan(phi.shape[1:], d.Nz, batch, 'partitioned', itemsize=np.dtype(real).itemsize,
+                                can_spill=False, dtype=cplx)
+        batch, planes = plan['batch'], plan['planes']
+        budget.start()
+    index = {plane: i for i, plane in enumerate(planes)}
+
+    volumes = np.zeros((phi.shape[0], len(planes), *phi.shape[1:]), dtype=real)
+    volumes[:, 0] = phi.real**2 + phi.imag**2
+
+    if mask_manager is not None:
+        mask_manager.initialize_masks(phi.shape[1:], d.X, d.Y, d.sigma_phi, d.sigma_x)
+
+    # Without a mask manager, every batch draws the same random masks
+    state = np.random.get_state()
+    for start in range(0, phi.shape[0], batch):
+        np.random.set_state(state)
+        fields = phi[start:start + batch]
+        mask_counter = 0
+        for k in range(0, d.Nz):
+            fields = _full_step_batch(fields, tejido, d, block_size)
+            fields, mask_counter = _mask_step(fields, k, spm, mask_counter, d, mask_manager)
+            if k + 1 in index:
+                volumes[start:start + batch, index[k + 1]] = fields.real**2 + fields.imag**2
+
+    if memory_budget is not None:
+        budget.finish()
+    if not metrics:
+        return volumes, None
+
+    from benchmark.medir_psf_params import medir_psf_params
+
+    z_positions = np.array(planes) * d.dz
+    params = []
+    for volume in volumes:
+        focus = np.argmax(volume.max(axis=(1, 2)))
+        # The intensity volume as-is: medir_psf_params then measures the axial width on the
+        # same quantity as for a complex history (see calcular_fwhm_axial)
+        params.append(medir_psf_params(volume[focus], d.X, d.Y, volume, z_positions))
+        params[-1]['z_focus'] = z_positions[focus]
+    return volumes, params
@@ -0,0 +1,337 @@
+"""
+Monte Carlo statistics of the PSF over tissue realizations.
+
+A realization is one draw of the three phase masks, made as
+PhaseMaskManager.generate_mask makes them (Gaussian phase noise of deviation
+sigma_phi smoothed over the correlation length sigma_x), but from a
+generator seeded by (seed, realization index) instead of the fixed seeds of
+the manager. `RealizationScheduler` propagates the beam through batches of
+realizations. Each batch is stacked into one partitioned solve, as the
+fields of compute_psf are, except that every field gets its own masks. The
+scheduler measures the PSF of each realization at its focal plane and keeps
+running means and Student-t confidence intervals of the requested metrics.
+It stops when every interval is narrower than its target, or when the
+realization or time budget runs out.
+
+Widths are relative to the mean, except for max_sidelobe_ratio, which is
+already a ratio and whose width is absolute (as in the autotuner's drift).
+Realizations whose power grows past rounding (the transparent boundary
+instability), or where a metric can't be measured (NaN), are counted but
+left out of the statistics.
+
+Only the per-plane peak intensity and the brightest plane of every field
+are kept, so the memory doesn't grow with Nz.
+"""
+
+import logging
+import math
+import time
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.precision import precision_types
+from deep_tissue_imaging.propagators.propagation import _full_step_batch
+
+logger = logging.getLogger(__name__)
+
+# Full width of the confidence interval, relative to the mean (absolute for
+# max_sidelobe_ratio)
+TARGETS = {
+    'fwhm_lateral': 0.05,
+    'fwhm_axial': 0.05,
+    'radio_80': 0.05,
+    'max_sidelobe_ratio': 0.02,
+}
+
+
+def draw_masks(d, seed, realization):
+    """
+    Phase masks 1..3 of one realization.
+
+    Parameters:
+        d: Domain properties
+        seed (int): Seed of the run
+        realization (int): Index of the realization
+
+    Returns:
+        ndarray: theta of the three masks, shape (3, Ny, Nx), in the domain's precision
+    """
+    from scipy.ndimage import gaussian_filter
+
+    real = precision_types(d)[0]
+    rng = np.random.default_rng([seed, realization])
+    dx = real(np.abs(d.X[0, 1] - d.X[0, 0]))
+    dy = real(np.abs(d.Y[1, 0] - d.Y[0, 0]))
+    sigma = (real(d.sigma_x / dy), real(d.sigma_x / dx))
+    return np.stack([gaussian_filter(rng.normal(0.0, d.sigma_phi, d.X.shape).astype(real), sigma=sigma,
+                                     mode='reflect')
+                     for _ in range(3)])
+
+
+class RunningEstimate:
+    """Running mean and variance of a metric (Welford), with its confidence interval."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / (self.n - 1)) if self.n > 1 else float('nan')
+
+    def interval(self, confidence):
+        """(low, high) of the Student-t interval of the mean; nan with fewer than 2 values."""
+        if self.n < 2:
+            return float('nan'), float('nan')
+        from scipy.stats import t
+
+        half = float(t.ppf(0.5 + confidence / 2, self.n - 1)) * self.std / math.sqrt(self.n)
+        return self.mean - half, self.mean + half
+
+    def width(self, confidence, relative=True):
+        low, high = self.interval(confidence)
+        if relative:
+            return (high - low) / abs(self.mean) if self.mean else float('inf')
+        return high - low
+
+
+class RealizationScheduler:
+    """
+    Run tissue realizations in batches until the PSF metrics are known to a target.
+
+    Parameters:
+        phi (ndarray): Input field (Ny, Nx), cast to the domain's precision
+        tejido: Tissue properties
+        d: Domain properties
+        targets (dict): Largest confidence interval width per metric (see TARGETS);
+            only these metrics are estimated
+        confidence (float): Confidence level of the intervals
+        batch (int): Realizations propagated together
+        min_realizations (int): Realizations before the intervals are trusted
+        max_realizations (int): Realization budget
+        time_budget (float, optional): Wall time budget in seconds; no batch starts
+            that would be expected to overrun it
+        seed (int): Seed of the masks (realization r draws from (seed, r))
+        block_size (int): Block size of the partitioned solves
+
+    Attributes:
+        estimates (dict): RunningEstimate per metric
+        records (list): Metrics of every realization, with its index and whether it
+            entered the statistics
+        batches (list): Snapshot of the estimates after every batch
+        stop_reason (str): 'converged', 'realizations' or 'time' once run
+    """
+
+    def __init__(self, phi, tejido, d, targets=TARGETS, confidence=0.95, batch=4, min_realizations=8,
+                 max_realizations=200, time_budget=None, seed=0, block_size=64):
+        unknown = set(targets) - set(TARGETS)
+        if unknown:
+            raise ValueError(f"Unknown metrics {sorted(unknown)}; known: {sorted(TARGETS)}")
+        phi = np.asarray(phi, dtype=precision_types(d)[1])
+        self.phi = phi
+        self.tejido = tejido
+        self.d = d
+        self.targets = dict(targets)
+        self.confidence = confidence
+        self.batch = batch
+        self.min_realizations = max(min_realizations, 2)
+        self.max_realizations = max_realizations
+        self.time_budget = time_budget
+        self.seed = seed
+        self.block_size = block_size
+        self.estimates = {name: RunningEstimate() for name in self.targets}
+        self.records = []
+        self.batches = []
+        self.stop_reason = None
+
+    @property
+    def realizations(self):
+        return len(self.records)
+
+    @property
+    def valid(self):
+        return sum(r['valid'] for r in self.records)
+
+    def widths(self):
+        """Current interval width per metric, in the units of its target."""
+        return {name: e.width(self.confidence, relative=name != 'max_sidelobe_ratio')
+                for name, e in self.estimates.items()}
+
+    def converged(self):
+        if self.valid < self.min_realizations:
+            return False
+        widths = self.widths()
+        return all(widths[name] <= target for name, target in self.targets.items())
+
+    def propagate(self, realizations):
+        """
+        PSF metrics of a batch of realizations.
+
+        Parameters:
+            realizations (list): Indices of the realizations
+
+        Returns:
+            list: medir_psf_params-derived metrics dict per realization, with
+                'z_focus' and 'power_gain'
+        """
+        from benchmark.medir_psf_params import medir_psf_params
+
+        d, tejido = self.d, self.tejido
+        real, cplx = precision_types(d)
+        spm = int(tejido.l_s/d.dz)
+        thetas = np.stack([draw_masks(d, self.seed, r) for r in realizations])
+        fields = np.repeat(self.phi[None], len(realizations), axis=0)
+
+        B = len(realizations)
+        intensity = fields.real**2 + fields.imag**2
+        peaks = np.zeros((B, d.Nz + 1), dtype=real)
+        power = np.zeros((B, d.Nz + 1), dtype=real)
+        peaks[:, 0] = intensity.max(axis=(1, 2))
+        power[:, 0] = intensity.sum(axis=(1, 2))
+        focus_planes = intensity.copy()
+        focus = np.zeros(B, dtype=int)
+        mask_counter = 0
+        for k in range(d.Nz):
+            fields = _full_step_batch(fields, tejido, d, self.block_size)
+            if k % spm == 0 and k != 0:
+                mask_counter = (mask_counter % 3) + 1
+                fields = fields * np.exp(cplx(1j) * thetas[:, mask_counter - 1])
+            intensity = fields.real**2 + fields.imag**2
+            peaks[:, k + 1] = intensity.max(axis=(1, 2))
+            power[:, k + 1] = intensity.sum(axis=(1, 2))
+            brighter = peaks[:, k + 1] > peaks[np.arange(B), focus]
+            focus[brighter] = k + 1
+            focus_planes[brighter] = intensity[brighter]
+
+        z_positions = np.arange(d.Nz + 1, dtype=real) * d.dz
+        results = []
+        for b in range(B):
+            # medir_psf_params only takes the peak of each plane of the history; intensity
+            # peaks as-is, so the axial width is measured as for a complex history
+            params = medir_psf_params(focus_planes[b], d.X, d.Y, peaks[b][:, None], z_positions)
+            results.append({
+                'fwhm_lateral': float(params['fwhm_lateral']),
+                'fwhm_axial': float('nan') if params['fwhm_axial'] is None else float(params['fwhm_axial']),
+                'radio_80': float(params['radio_80']),
+                'max_sidelobe_ratio': float(params['sidelobes']['max_sidelobe_ratio']),
+                'z_focus': float(z_positions[focus[b]]),
+                'power_gain': float(power[b].max() / power[b, 0]),
+            })
+        return results
+
+    def run(self):
+        """
+        Run batches until the targets are met or a budget runs out.
+
+        Returns:
+            dict: mean, interval and width per metric, with the realization counts
+                and the stop reason (see summary)
+        """
+        from benchmark.resolution_autotuner import MAX_POWER_GAIN
+
+        t0 = time.perf_counter()
+        batch_s = None
+        while True:
+            if self.converged():
+                self.stop_reason = 'converged'
+                break
+            if self.realizations >= self.max_realizations:
+                self.stop_reason = 'realizations'
+                break
+            elapsed = time.perf_counter() - t0
+            if self.time_budget is not None and batch_s is not None and elapsed + batch_s > self.time_budget:
+                self.stop_reason = 'time'
+                break
+
+            start = self.realizations
+            indices = list(range(start, min(start + self.batch, self.max_realizations)))
+            t_batch = time.perf_counter()
+            results = self.propagate(indices)
+            batch_s = time.perf_counter() - t_batch
+            for r, metrics in zip(indices, results):
+                values = [metrics[name] for name in self.targets]
+                valid = metrics['power_gain'] <= 1 + MAX_POWER_GAIN and all(np.isfinite(values))
+                if valid:
+                    for name in self.targets:
+                        self.estimates[name].add(metrics[name])
+                self.records.append({'realization': r, 'valid': valid, **metrics})
+            self.batches.append(self.summary())
+            logger.info("lote de %d realizaciones en %.2f s: %d validas de %d", len(indices), batch_s, self.valid,
+                        self.realizations, extra={'realizations': self.realizations, 'widths': self.widths()})
+        logger.info("parada por %s tras %d realizaciones", self.stop_reason, self.realizations,
+                    extra={'stop_reason': self.stop_reason, 'realizations': self.realizations})
+        return self.summary()
+
+    def summary(self):
+        """
+        Current estimates.
+
+        Returns:
+            dict: {'realizations', 'valid', 'stop_reason', 'metrics'} where metrics
+                maps each metric to its mean, std, interval, width and target
+        """
+        widths = self.widths()
+        return {
+            'realizations': self.realizations,
+            'valid': self.valid,
+            'stop_reason': self.stop_reason,
+            'metrics': {name: {'mean': e.mean, 'std': e.std, 'interval': e.interval(self.confidence),
+                               'width': widths[name], 'target': self.targets[name]}
+                        for name, e in self.estimates.items()},
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import contextlib
+    import io
+
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_gaussiano_enfocado
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+
+    parser = argparse.ArgumentParser(description="Realizations until the PSF metrics are known to a target.")
+    parser.add_argument('--N', type=int, default=64)
+    parser.add_argument('--Nz', type=int, default=250)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--max', type=int, default=64)
+    parser.add_argument('--target', type=float, default=0.1, help="Relative interval width of the widths")
+    args = parser.parse_args()
+    targets = {name: args.target if name != 'max_sidelobe_ratio' else TARGETS[name] for name in TARGETS}
+
+    # eps=1: past the masks the smaller thresholds make the boundary unstable on some draws
+    d = build_domain(45e-6, 45e-6, args.Nz * 1e-6, args.N, args.N, args.Nz, laser, tejido, eps=1.0)
+    # Focused past the first mask, so the focal spot depends on the realization
+    phi0 = campo_gaussiano_enfocado(d.X, d.Y, laser.w0, laser.I_peak, d.k, 0.8 * args.Nz * 1e-6)
+
+    def report(label, scheduler, seconds):
+        s = scheduler.summary()
+        print(f"{label}: {s['realizations']} realizations ({s['valid']} valid) in {seconds:.1f} s, "
+              f"stopped by {s['stop_reason']}")
+        for name, m in s['metrics'].items():
+            scale = 1e6 if name != 'max_sidelobe_ratio' else 1
+            print(f"  {name}: {m['mean'] * scale:.4g} ± {m['std'] * scale:.2g}, interval "
+                  f"[{m['interval'][0] * scale:.4g}, {m['interval'][1] * scale:.4g}], "
+                  f"width {m['width']:.3f} (target {m['target']})")
+
+    with contextlib.redirect_stdout(io.StringIO()) as quiet:
+        runs = {}
+        for label, kwargs in (('early stopping', {}), ('fixed count', {'min_realizations': args.max})):
+            scheduler = RealizationScheduler(phi0, tejido, d, targets, batch=args.batch, max_realizations=args.max,
+                                             **kwargs)
+            t0 = time.perf_counter()
+            scheduler.run()
+            runs[label] = (scheduler, time.perf_counter() - t0)
+    for label, (scheduler, seconds) in runs.items():
+        report(label, scheduler, seconds)
+    early, fixed = runs['early stopping'][0], runs['fixed count'][0]
+    inside = {name: early.estimates[name].interval(early.confidence)[0] <= fixed.estimates[name].mean
+              <= early.estimates[name].interval(early.confidence)[1] for name in TARGETS}
+    print(f"fixed-count means inside the early-stopping intervals: {inside}")
@@ -0,0 +1,522 @@
+"""
+Long-running simulation service for repeated propagation and PSF requests.
+
+An analysis script pays for its setup on every run: the meshgrids of
+build_domain, the masks of PhaseMaskManager.initialize_masks (loaded from
+disk, their phasors recomputed at every insertion) and the interior spikes of
+the partitioned solver. `SimulationService` keeps them warm in one process:
+
+- domains by their build_domain arguments,
+- masks by directory and grid, with the phasors exp(iθ) computed once,
+- the partitioned solver's interior spikes (partitioned_solver keeps them per
+  domain constants for the life of the process),
+- a pool of worker threads, started once.
+
+It listens on a Unix socket (an address that is a path, readable by its
+owner only) or on loopback TCP (a (host, port) tuple) through
+multiprocessing.connection. Requests and results are pickled Python objects,
+so whoever holds the key can run code in the service: the key is random
+(os.urandom) unless one is given, never a constant, and travels to clients
+through a file only its owner can read (write_authkey/read_authkey). Hosts
+that don't resolve to loopback are refused. A request is a dict:
+
+    {'op': 'psf' or 'propagate',
+     'domain': build_domain arguments, with 'laser' and 'tejido' the names of
+               classes in elementos.lasers and elementos.tejidos,
+     'beam': {'kind': 'tem00'}, {'kind': 'focused', 'z': ..., 'x0': ..., 'y0': ...}
+             or {'phi': ndarray},
+     'masks': mask directory, or None for random masks,
+     ... options of the op}
+
+with the options 'volume' (also return the intensity volume) and
+'block_size' for 'psf', and 'every', 'planes' (stream the fields too),
+'history', 'block_size' (partitioned diffraction instead of the reference
+operators) and 'memory_budget' for 'propagate'.
+
+Workers run requests concurrently, except those that touch process-wide
+state: random masks (masks None) draw from the global np.random state, which
+compute_psf also saves and restores. These run one at a time, as does the
+first load of a mask directory, which generates its missing masks from
+seeded global draws. (A memory budget sent as a byte count doesn't measure,
+so it touches nothing shared.)
+
+PSF requests on the same domain and masks that arrive within `batch_window`
+of each other run as one compute_psf batch (up to `max_batch` beams), which
+shares the coefficients and spikes of every sweep. Propagations stream a
+BeamDiagnostics record (and optionally the field) every `every` steps before
+their result. `ServiceClient` submits requests, pipelined or one at a time,
+and collects the messages of each.
+
+Run a service from dti_reference_implementation (the key goes to
+/tmp/dti.sock.key):
+    python -m deep_tissue_imaging.propagators.service --address /tmp/dti.sock
+"""
+
+import collections
+import contextlib
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import numpy as np
+
+from deep_tissue_imaging.elementos import lasers, tejidos
+from deep_tissue_imaging.elementos.domain import build_domain
+from deep_tissue_imaging.elementos.precision import precision_types
+from deep_tissue_imaging.propagators.observers import BeamDiagnostics
+from deep_tissue_imaging.propagators.propagation import compute_psf, full_propagation_within_tissue
+
+logger = logging.getLogger(__name__)
+
+
+def write_authkey(path, authkey):
+    """Write a service key to a file readable by its owner only."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+
+
+def read_authkey(path):
+    """The service key written by write_authkey."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _check_loopback(address):
+    """Raise ValueError for a TCP address whose host doesn't resolve to loopback only."""
+    if isinstance(address, str):
+        return
+    host, port = address
+    hosts = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    if not hosts or not all(ipaddress.ip_address(h.split('%')[0]).is_loopback for h in hosts):
+        raise ValueError(f"The service only listens on loopback; {host!r} resolves to {sorted(hosts)}")
+
+
+class _WarmMasks:
+    """
+    The masks of a PhaseMaskManager on one grid, with their phasors computed once
+    in the domain's precision.
+
+    Stands in for the manager in the propagation entry points.
+    """
+
+    def __init__(self, manager, d):
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.initialize_masks(d.X.shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+        self.masks = dict(manager.masks)
+        real, cplx = precision_types(d)
+        self._phasors = {i: np.exp(cplx(1j) * theta.astype(real)) for i, theta in self.masks.items()}
+
+    def initialize_masks(self, shape, X, Y, desviacion_fase, correlacion_m):
+        return self.masks
+
+    def apply_mask(self, phi, mask_index, region=None):
+        phasor = self._phasors[mask_index]
+        return phi * (phasor if region is None else phasor[region])
+
+
+class _Request:
+    """A request with the connection to answer on and its arrival time."""
+
+    def __init__(self, message, connection):
+        self.message = message
+        self.connection = connection
+        self.arrived = time.perf_counter()
+        self.id = message.get('id')
+        self.op = message.get('op')
+        # Requests that can share a compute_psf batch
+        self.key = (json.dumps(message.get('domain'), sort_keys=True), message.get('masks'),
+                    message.get('block_size', 64)) if self.op == 'psf' else None
+
+
+class _Connection:
+    """A client connection; workers send on it concurrently."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            try:
+                self.connection.send(message)
+            except (OSError, EOFError):
+                # The client went away; its results are dropped
+                pass
+
+
+class SimulationService:
+    """
+    Local service keeping domains, masks and workers warm across requests.
+
+    Parameters:
+        address (str or tuple): Unix socket path, or (host, port) on loopback
+        authkey (bytes, optional): Key clients authenticate with; random by default
+            (see the authkey attribute)
+        workers (int): Worker threads computing requests
+        max_batch (int): Most PSF requests run in one compute_psf batch
+        batch_window (float): Seconds a worker waits for more PSF requests to batch
+            with the first one
+
+    Attributes:
+        authkey (bytes): Key of the service, to hand to its clients
+        stats (dict): Counters of the requests served, batches run and cache misses
+    """
+
+    def __init__(self, address, authkey=None, workers=1, max_batch=8, batch_window=0.01):
+        _check_loopback(address)
+        self.address = address
+        self.authkey = authkey or os.urandom(32)
+        self.workers = workers
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.stats = {'requests': 0, 'batches': 0, 'batched_requests': 0, 'domain_misses': 0, 'mask_misses': 0,
+                      'errors': 0}
+        self._domains = {}
+        self._masks = {}
+        self._cache_lock = threading.Lock()
+        # Held by requests and mask loads that use the global np.random state
+        self._process_lock = threading.Lock()
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._listener = None
+
+    # Warm state
+
+    def domain(self, spec):
+        """(Domain, laser, tejido) of a domain spec, built once."""
+        key = json.dumps(spec, sort_keys=True)
+        with self._cache_lock:
+            if key not in self._domains:
+                args = dict(spec)
+                laser = getattr(lasers, args.pop('laser'))
+                tejido = getattr(tejidos, args.pop('tejido'))
+                self._domains[key] = (build_domain(laser=laser, tejido=tejido, **args), laser, tejido)
+                self.stats['domain_misses'] += 1
+            return self._domains[key]
+
+    def masks(self, directory, d):
+        """The warm masks of a directory on d's grid, or None for random masks."""
+        if directory is None:
+            return None
+        key = (os.path.abspath(directory), d.X.shape)
+        with self._cache_lock:
+            warm = self._masks.get(key)
+        if warm is None:
+            # Generating missing masks seeds and draws from the global np.random state;
+            # the cache lock isn't held meanwhile, so the other requests aren't blocked
+            with self._process_lock:
+                with self._cache_lock:
+                    warm = self._masks.get(key)
+                if warm is None:
+                    from benchmark.phase_mask_manager import PhaseMaskManager
+
+                    warm = _WarmMasks(PhaseMaskManager(directory), d)
+                    with self._cache_lock:
+                        self._masks[key] = warm
+                        self.stats['mask_misses'] += 1
+        return warm
+
+    @staticmethod
+    def beam(spec, d, laser):
+        """Input field of a beam spec."""
+        if 'phi' in spec:
+            return np.asarray(spec['phi'])
+        if spec.get('kind', 'tem00') == 'tem00':
+            return lasers.campo_tem00(d.X, d.Y, laser.w0, spec.get('I_peak', laser.I_peak))
+        if spec['kind'] == 'focused':
+            return lasers.campo_gaussiano_enfocado(d.X, d.Y, laser.w0, spec.get('I_peak', laser.I_peak), d.k,
+                                                   spec['z'], spec.get('x0', 0.0), spec.get('y0', 0.0))
+        raise ValueError(f"Unknown beam kind {spec['kind']!r}")
+
+    # Serving
+
+    def serve_forever(self):
+        """Accept connections and serve requests until shutdown() or a 'shutdown' request."""
+        self._listener = Listener(self.address, authkey=self.authkey)
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        logger.info("servicio escuchando en %s", self.address, extra={'address': self.address})
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    connection = self._listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue
+                if not self._stopping.is_set():
+                    threading.Thread(target=self._reader, args=(_Connection(connection),), daemon=True).start()
+        finally:
+            self._stopping.set()
+            with self._condition:
+                self._condition.notify_all()
+            for thread in threads:
+                thread.join()
+            self._listener.close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def shutdown(self):
+        """
+        Stop the service from another thread: serve_forever returns once the
+        workers have finished the pending requests.
+        """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+        # Closing the listener doesn't interrupt accept(): connect to wake it up
+        with contextlib.suppress(OSError, EOFError, AuthenticationError):
+            Client(self.address, authkey=self.authkey).close()
+
+    def _reader(self, connection):
+        """Queue the requests of one connection."""
+        while True:
+            try:
+                message = connection.connection.recv()
+            except (OSError, EOFError):
+                break
+            op = message.get('op')
+            if op == 'ping':
+                connection.send({'id': message.get('id'), 'type': 'result', 'pending': len(self._pending)})
+            elif op == 'stats':
+                connection.send({'id': message.get('id'), 'type': 'result', 'stats': dict(self.stats)})
+            elif op == 'shutdown':
+                connection.send({'id': message.get('id'), 'type': 'result'})
+                self.shutdown()
+                break
+            else:
+                with self._condition:
+                    self._pending.append(_Request(message, connection))
+                    self._condition.notify()
+        connection.connection.close()
+
+    def _next_batch(self):
+        """Pop the next request, with the PSF requests that can share its batch."""
+        with self._condition:
+            while not self._pending:
+                if self._stopping.is_set():
+                    return None
+                self._condition.wait()
+            batch = [self._pending.popleft()]
+            if batch[0].key is None:
+                return batch
+            deadline = batch[0].arrived + self.batch_window
+            while len(batch) < self.max_batch:
+                for request in [r for r in self._pending if r.key == batch[0].key][:self.max_batch - len(batch)]:
+                    self._pending.remove(request)
+                    batch.append(request)
+                remaining = deadline - time.perf_counter()
+                if len(batch) >= self.max_batch or remaining <= 0 or self._stopping.is_set():
+                    break
+                self._condition.wait(remaining)
+            return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                if batch[0].op == 'psf':
+                    self._run_psf(batch)
+                elif batch[0].op == 'propagate':
+                    self._run_propagate(batch[0])
+                else:
+                    raise ValueError(f"Unknown op {batch[0].op!r}")
+            except Exception as error:
+                logger.exception("peticion %s fallida", [r.id for r in batch], extra={'ids': [r.id for r in batch]})
+                self._count(errors=len(batch))
+                for request in batch:
+                    request.connection.send({'id': request.id, 'type': 'error', 'error': repr(error)})
+            self._count(requests=len(batch))
+
+    def _exclusive(self, masks):
+        """The process lock for requests with random masks, else a no-op context."""
+        return self._process_lock if masks is None else contextlib.nullcontext()
+
+    def _count(self, **increments):
+        with self._cache_lock:
+            for name, n in increments.items():
+                self.stats[name] += n
+
+    def _run_psf(self, batch):
+        first = batch[0].message
+        start = time.perf_counter()
+        d, laser, tejido = self.domain(first['domain'])
+        masks = self.masks(first.get('masks'), d)
+        phis = np.stack([self.beam(r.message.get('beam', {}), d, laser) for r in batch])
+        setup = time.perf_counter() - start
+        # medir_psf_params prints its tables
+        with self._exclusive(masks), contextlib.redirect_stdout(io.StringIO()):
+            volumes, params = compute_psf(phis, tejido, d, masks, block_size=first.get('block_size', 64))
+        compute = time.perf_counter() - start - setup
+        self._count(batches=1, batched_requests=len(batch) if len(batch) > 1 else 0)
+        logger.info("lote psf de %d peticiones en %.3f s", len(batch), compute,
+                    extra={'batch': len(batch), 'compute_s': compute})
+        for request, volume, p in zip(batch, volumes, params):
+            message = {'id': request.id, 'type': 'result', 'params': p, 'batch': len(batch),
+                       'queued_s': start - request.arrived, 'setup_s': setup, 'compute_s': compute}
+            if request.message.get('volume'):
+                message['volume'] = volume
+            request.connection.send(message)
+
+    def _run_propagate(self, request):
+        message = request.message
+        start = time.perf_counter()
+        d, laser, tejido = self.domain(message['domain'])
+        masks = self.masks(message.get('masks'), d)
+        phi = self.beam(message.get('beam', {}), d, laser)
+        setup = time.perf_counter() - start
+        diagnostics = BeamDiagnostics(d, tejido, every=message.get('every', 10))
+        send_planes = message.get('planes', False)
+
+        def stream(z, phi, stats):
+            diagnostics(z, phi, stats)
+            record = {k: v for k, v in diagnostics.records[-1].items() if not k.startswith('_')}
+            update = {'id': request.id, 'type': 'plane', 'record': record}
+            if send_planes:
+                update['phi'] = phi.copy()
+            request.connection.send(update)
+        stream.every = diagnostics.every
+
+        diffraction = None
+        if message.get('block_size'):
+            from deep_tissue_imaging.hardware.diffraction_backend import SoftwareDiffraction
+
+            diffraction = SoftwareDiffraction(block_size=message['block_size'])
+        with self._exclusive(masks):
+            history = full_propagation_within_tissue(phi, tejido, d, masks, diffraction, observers=[stream],
+                                                     memory_budget=message.get('memory_budget'))
+        compute = time.perf_counter() - start - setup
+        result = {'id': request.id, 'type': 'result', 'phi': np.asarray(history[-1]), 'diagnostics':
+                  diagnostics.table(), 'queued_s': start - request.arrived, 'setup_s': setup, 'compute_s': compute}
+        if message.get('history'):
+            result['history'] = np.asarray(history)
+        request.connection.send(result)
+
+
+class ServiceClient:
+    """
+    Client of a SimulationService.
+
+    Requests can be pipelined: `submit` returns at once with the request id and
+    `messages` or `result` collect what the service sends back for it. A client
+    is not thread-safe; open one per thread.
+
+    Parameters:
+        address (str or tuple): Address of the service
+        authkey (bytes): Key of the service (SimulationService.authkey, or read_authkey
+            of the file the service wrote it to)
+        timeout (float): Seconds to wait for the service to accept the connection
+    """
+
+    def __init__(self, address, authkey, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.connection = Client(address, authkey=authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self._ids = itertools.count()
+        self._inbox = collections.defaultdict(collections.deque)
+
+    def submit(self, op, **request):
+        """Send a request (see the module docstring); returns its id."""
+        request_id = next(self._ids)
+        self.connection.send(dict(request, op=op, id=request_id))
+        return request_id
+
+    def messages(self, request_id):
+        """Yield the messages of a request up to its result; raises RuntimeError on an error."""
+        while True:
+            if self._inbox[request_id]:
+                message = self._inbox[request_id].popleft()
+            else:
+                message = self.connection.recv()
+                if message['id'] != request_id:
+                    self._inbox[message['id']].append(message)
+                    continue
+            if message['type'] == 'error':
+                del self._inbox[request_id]
+                raise RuntimeError(f"Request {request_id} failed: {message['error']}")
+            yield message
+            if message['type'] == 'result':
+                del self._inbox[request_id]
+                return
+
+    def result(self, request_id):
+        """The result message of a request, skipping the streamed ones."""
+        for message in self.messages(request_id):
+            pass
+        return message
+
+    def psf(self, domain, beam=None, masks=None, **options):
+        """PSF metrics (medir_psf_params) of one beam; see the module docstring for the specs."""
+        return self.result(self.submit('psf', domain=domain, beam=beam or {}, masks=masks, **options))['params']
+
+    def propagate(self, domain, beam=None, masks=None, every=10, **options):
+        """Stream the messages of a propagation: 'plane' records every `every` steps, then the 'result'."""
+        return self.messages(self.submit('propagate', domain=domain, beam=beam or {}, masks=masks, every=every,
+                                         **options))
+
+    def stats(self):
+        return self.result(self.submit('stats'))['stats']
+
+    def shutdown(self):
+        """Stop the service."""
+        self.result(self.submit('shutdown'))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Warm simulation service.")
+    parser.add_argument('--address', default='/tmp/deep_tissue_imaging.sock',
+                        help="Unix socket path, or host:port for loopback TCP")
+    parser.add_argument('--key-file', help="File the random key is written to (owner-only); "
+                                           "<address>.key for a Unix socket")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--batch-window', type=float, default=0.01)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    address = args.address
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    key_file = args.key_file or (address + '.key' if isinstance(address, str) else None)
+    if key_file is None:
+        parser.error("--key-file is required for a TCP address")
+    service = SimulationService(address, workers=args.workers, max_batch=args.max_batch,
+                                batch_window=args.batch_window)
+    write_authkey(key_file, service.authkey)
+    try:
+        service.serve_forever()
+    finally:
+        os.unlink(key_file)
@@ -1,7 +1,6 @@
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
-from deep_tissue_imaging.elementos.plotting import plot_field_intensity_history, plot_field_intensity
+from deep_tissue_imaging.elementos.precision import field_types
 
 
 ## Operador Dispersion
@@ -100,30 +99,32 @@ def compute_b_vector(dp, dp1, dp2, do, x0):
 
 
 def adi_x(phi, Ny, eps, k, dz, dx):
-    ung = np.complex64(1j * dz / (4 * k * dx**2))
-    phi_inter = np.zeros_like(phi, dtype=np.complex64)
+    # Constants in the precision of the field (see precision)
+    real, cplx = field_types(phi)
+    ung = cplx(1j * dz / (4 * k * dx**2))
+    phi_inter = np.zeros_like(phi, dtype=cplx)
     for j in range(Ny):
 
         if abs(phi[1, j]) < eps:
-            ratio_x0 = np.float32(1.0)
+            ratio_x0 = real(1.0)
         else:
             ratio_x0 = phi[0, j] / phi[1, j]
 
         if abs(phi[-2, j]) < eps:
-            ratio_xn = np.float32(1.0)
+            ratio_xn = real(1.0)
         else:
             ratio_xn = phi[-1, j] / phi[-2, j]
 
-        dp1_B = -2 * ung + np.float32(1.0) + ung * ratio_x0
-        dp2_B = -2 * ung + np.float32(1.0) + ung * ratio_xn
-        dp_B = -2 * ung + np.float32(1.0)
+        dp1_B = -2 * ung + real(1.0) + ung * ratio_x0
+        dp2_B = -2 * ung + real(1.0) + ung * ratio_xn
+        dp_B = -2 * ung + real(1.0)
         do_B = ung
 
         b = compute_b_vector(dp_B, dp1_B, dp2_B, do_B, phi[:, j])
 
-        dp1_A = 2 * ung + np.float32(1.0) - ung * ratio_x0
-        dp2_A = 2 * ung + np.float32(1.0) - ung * ratio_xn
-        dp_A = 2 * ung + np.float32(1.0)
+        dp1_A = 2 * ung + real(1.0) - ung * ratio_x0
+        dp2_A = 2 * ung + real(1.0) - ung * ratio_xn
+        dp_A = 2 * ung + real(1.0)
         do_A = -ung
 
         phi_inter[:, j] = custom_thomas_solver(dp_A, dp1_A, dp2_A, do_A, b)
@@ -132,30 +133,32 @@ def adi_x(phi, Ny, eps, k, dz, dx):
 
 
 def adi_y(phi, Nx, eps, k, dz, dy):
-    ung = np.complex64(1j * dz / (4 * k * dy**2))
-    phi_inter = np.zeros_like(phi, dtype=np.complex64)
+    # Constants in the precision of the field (see precision)
+    real, cplx = field_types(phi)
+    ung = cplx(1j * dz / (4 * k * dy**2))
+    phi_inter = np.zeros_like(phi, dtype=cplx)
     for i in range(Nx):
 
         if abs(phi[i, 1]) < eps:
-            ratio_y0 = np.float32(1.0)
+            ratio_y0 = real(1.0)
         else:
             ratio_y0 = phi[i, 0] / phi[i, 1]
 
         if abs(phi[i, -2]) < eps:
-            ratio_yn = np.float32(1.0)
+            ratio_yn = real(1.0)
         else:
             ratio_yn = phi[i, -1] / phi[i, -2]
 
-        dp1_B = -2 * ung + np.float32(1.0) + ung * ratio_y0
-        dp2_B = -2 * ung + np.float32(1.0) + ung * ratio_yn
-        dp_B = -2 * ung + np.float32(1.0)
+        dp1_B = -2 * ung + real(1.0) + ung * ratio_y0
+        dp2_B = -2 * ung + real(1.0) + ung * ratio_yn
+        dp_B = -2 * ung + real(1.0)
         do_B = ung
 
         b = compute_b_vector(dp_B, dp1_B, dp2_B, do_B, phi[i, :])
 
-        dp1_A = 2 * ung + np.float32(1.0) - ung * ratio_y0
-        dp2_A = 2 * ung + np.float32(1.0) - ung * ratio_yn
-        dp_A = 2 * ung + np.float32(1.0)
+        dp1_A = 2 * ung + real(1.0) - ung * ratio_y0
+        dp2_A = 2 * ung + real(1.0) - ung * ratio_yn
+        dp_A = 2 * ung + real(1.0)
         do_A = -ung
 
         phi_inter[i, :] = custom_thomas_solver(dp_A, dp1_A, dp2_A, do_A, b)
@@ -166,7 +169,7 @@ def adi_y(phi, Nx, eps, k, dz, dy):
 ## Operador N - Kerr
 
 def half_nonlinear(phi, k_sample, n2_sample, dz):
-   phase = np.exp(np.complex64(1j * k_sample * n2_sample * dz/2 * np.abs(phi)**2))
+   phase = np.exp(field_types(phi)[1](1j * k_sample * n2_sample * dz/2 * np.abs(phi)**2))
    return phase * phi
 
 
@@ -174,11 +177,11 @@ def half_nonlinear(phi, k_sample, n2_sample, dz):
 
 # absorcion lineal
 def half_linear_absorption(phi, alpha, dz):
-   return np.exp(np.float32(-alpha * dz/4)) * phi
+   return np.exp(field_types(phi)[0](-alpha * dz/4)) * phi
 
 # absorcion de 2 fotones
 def half_2photon_absorption(phi, beta, dz):
-   return np.exp(np.float32(-beta * dz/4 * np.abs(phi)**2)) * phi
+   return np.exp(field_types(phi)[0](-beta * dz/4 * np.abs(phi)**2)) * phi
 
 
 ## Mascara de fase aleatoria
@@ -202,20 +205,24 @@ def aplicar_mascara_fase_aleatoria(phi, X, Y, desviacion_fase=0.3, correlacion_m
 
     shape = X.shape
 
+    # Constants in the precision of the field (see precision)
+    real, cplx = field_types(phi)
+
     # Calcular dx y dy a partir de las mallas (en metros)
-    dx = np.float32(np.abs(X[0, 1] - X[0, 0]))  # metros
-    dy = np.float32(np.abs(Y[1, 0] - Y[0, 0]))  # metros
+    dx = real(np.abs(X[0, 1] - X[0, 0]))  # metros
+    dy = real(np.abs(Y[1, 0] - Y[0, 0]))  # metros
 
     # Longitud de correlación en número de píxeles
-    sigma_x = np.float32(correlacion_m / dx)
-    sigma_y = np.float32(correlacion_m / dy)
+    sigma_x = real(correlacion_m / dx)
+    sigma_y = real(correlacion_m / dy)
 
     # Ruido gaussiano con desviación deseada
-    ruido = np.random.normal(loc=0.0, scale=desviacion_fase, size=shape).astype(np.float32)
+    ruido = np.random.normal(loc=0.0, scale=desviacion_fase, size=shape).astype(real)
 
     # Suavizado para imitar fluctuación estructural
+    from scipy.ndimage import gaussian_filter
     theta = gaussian_filter(ruido, sigma=(sigma_y, sigma_x), mode='reflect')
-    mf = np.exp(np.complex64(1j * theta))
+    mf = np.exp(cplx(1j) * theta)
     # plot_field_intensity(np.real(mf), X, Y)
 
     # Aplicar la fase aleatoria como exponente complejo
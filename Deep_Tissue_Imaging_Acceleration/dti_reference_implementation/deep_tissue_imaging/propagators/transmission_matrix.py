@@ -0,0 +1,260 @@
+"""
+Transmission matrix of a tissue realization in the linear regime.
+
+Without the 2-photon and Kerr operators, propagation through a fixed set of
+phase masks is a linear map of the input field, up to the transparent
+boundary ratios, which depend on the field near the grid edge. A
+`TransmissionMatrix` is built by propagating an orthonormalized basis of
+input fields through the linear step operators once, in batches. After
+that, the output field of any input in the span of the basis costs a
+matrix-vector product. The matrix can be compressed by a truncated SVD.
+
+Two errors are reported: the part of an input outside the span of the basis
+(`TransmissionMatrix.project`), and the deviation of the prediction from a
+direct propagation (`TransmissionMatrix.validate`). The second includes the
+boundary nonlinearity and the SVD truncation.
+
+Bases: pixels of a support region, Hermite-Gauss modes, or plane waves up
+to a transverse wavenumber under an aperture.
+"""
+
+import numpy as np
+
+from deep_tissue_imaging.elementos.precision import field_types, precision_types
+from deep_tissue_imaging.propagators.propagation import _full_step_batch, _mask_step, linear_step_within_tissue
+
+
+def pixel_basis(support, dtype=np.complex64):
+    """
+    One input per pixel of a support region.
+
+    Parameters:
+        support (ndarray): Boolean mask of the input pixels, shape (Ny, Nx)
+        dtype: Complex type of the fields (see precision_types)
+
+    Returns:
+        ndarray: Basis fields, shape (M, Ny, Nx)
+    """
+    idx = np.flatnonzero(support)
+    basis = np.zeros((len(idx), support.size), dtype=dtype)
+    basis[np.arange(len(idx)), idx] = 1
+    return basis.reshape(len(idx), *support.shape)
+
+
+def hermite_gauss_basis(X, Y, w0, order, x0=0.0, y0=0.0):
+    """
+    Hermite-Gauss modes HG_mn with m, n <= order.
+
+    Parameters:
+        X, Y (ndarray): Spatial meshgrids (in meters)
+        w0 (float): Waist of the modes in meters
+        order (int): Highest mode index along each axis
+        x0, y0 (float): Centre of the modes in meters
+
+    Returns:
+        ndarray: Basis fields, shape ((order+1)^2, Ny, Nx), in the precision of the grids
+    """
+    real, cplx = field_types(X)
+    u = real(np.sqrt(2)) * (X - real(x0)) / real(w0)
+    v = real(np.sqrt(2)) * (Y - real(y0)) / real(w0)
+    gauss = np.exp(-(u**2 + v**2) / 2)
+    coefficients = np.eye(order + 1, dtype=real)
+    hx = [np.polynomial.hermite.hermval(u, coefficients[m]) for m in range(order + 1)]
+    hy = [np.polynomial.hermite.hermval(v, coefficients[n]) for n in range(order + 1)]
+    return np.stack([hx[m] * hy[n] * gauss for m in range(order + 1) for n in range(order + 1)]).astype(cplx)
+
+
+def kspace_basis(X, Y, k_max, aperture=None):
+    """
+    Plane waves of the grid's discrete transverse wavenumbers with |k| <= k_max.
+
+    Parameters:
+        X, Y (ndarray): Spatial meshgrids (in meters)
+        k_max (float): Largest transverse wavenumber in rad/m, e.g. NA * k0
+        aperture (ndarray, optional): Real envelope applied to every plane wave
+
+    Returns:
+        ndarray: Basis fields, shape (M, Ny, Nx), in the precision of the grids
+    """
+    ny, nx = X.shape
+    dx = X[0, 1] - X[0, 0]
+    dy = Y[1, 0] - Y[0, 0]
+    kx = 2 * np.pi * np.fft.fftfreq(nx, dx)
+    ky = 2 * np.pi * np.fft.fftfreq(ny, dy)
+    KX, KY = np.meshgrid(kx, ky)
+    inside = KX**2 + KY**2 <= k_max**2
+    envelope = 1 if aperture is None else aperture
+    return np.stack([envelope * np.exp(1j * (a * X + b * Y))
+                     for a, b in zip(KX[inside], KY[inside])]).astype(field_types(X)[1])
+
+
+def _propagate_batch(fields, tejido, d, mask_manager, block_size):
+    """Output plane of the linear propagation of a batch of fields (B, Ny, Nx)."""
+    spm = int(tejido.l_s/d.dz)
+    mask_counter = 0
+    phi = fields
+    for k in range(0, d.Nz):
+        phi = _full_step_batch(phi, tejido, d, block_size, linear=True)
+        phi, mask_counter = _mask_step(phi, k, spm, mask_counter, d, mask_manager)
+    return phi
+
+
+class TransmissionMatrix:
+    """
+    Linear map from input fields to output fields, T = U diag(s) V^H Q^H.
+
+    Q holds the orthonormalized input basis as columns. The product
+    U diag(s) V^H is the transmission matrix in that basis, and it is
+    truncated by `compress`.
+
+    Parameters:
+        Q (ndarray): Orthonormal input basis, shape (Ny*Nx, M)
+        U, s, Vh (ndarray): SVD factors of the matrix in that basis
+        shape (tuple): Field shape (Ny, Nx)
+    """
+
+    def __init__(self, Q, U, s, Vh, shape):
+        self.Q = Q
+        self.U = U
+        self.s = s
+        self.Vh = Vh
+        self.shape = tuple(shape)
+
+    @classmethod
+    def build(cls, basis, tejido, d, mask_manager=None, block_size=64, batch=32):
+        """
+        Propagate a basis through the linear operators and build the matrix.
+
+        Parameters:
+            basis (ndarray): Input fields, shape (M, Ny, Nx) (see pixel_basis,
+                hermite_gauss_basis, kspace_basis); orthonormalized here
+            tejido: Tissue properties (the 2-photon and Kerr terms are ignored)
+            d: Domain properties
+            mask_manager (PhaseMaskManager, optional): Masks of the realization;
+                required if a mask falls within the d.Nz steps
+            block_size (int): Block size of the partitioned tridiagonal solves
+            batch (int): Basis fields propagated together
+
+        Returns:
+            TransmissionMatrix: The full-rank matrix
+        """
+        shape = basis.shape[1:]
+        if d.Nz > int(tejido.l_s/d.dz):
+            if mask_manager is None:
+                raise ValueError("A transmission matrix needs a fixed realization; pass a PhaseMaskManager")
+            mask_manager.initialize_masks(shape, d.X, d.Y, d.sigma_phi, d.sigma_x)
+
+        # Orthonormalized in double whatever the precision, then cast to it
+        real, cplx = precision_types(d)
+        Q = np.linalg.qr(basis.reshape(len(basis), -1).T.astype(np.complex128))[0].astype(cplx)
+        # Unit-norm fields sit far below physical amplitudes: scale them so that the
+        # boundary threshold eps means the same as for a beam of the grid's scale
+        scale = real(np.sqrt(Q.shape[0]))
+        T = np.empty_like(Q)
+        for start in range(0, Q.shape[1], batch):
+            fields = (scale * Q[:, start:start + batch]).T.reshape(-1, *shape)
+            out = _propagate_batch(fields, tejido, d, mask_manager, block_size)
+            T[:, start:start + batch] = out.reshape(len(fields), -1).T / scale
+
+        U, s, Vh = np.linalg.svd(T, full_matrices=False)
+        return cls(Q, U, s, Vh, shape)
+
+    @property
+    def rank(self):
+        return len(self.s)
+
+    def compress(self, rank=None, tol=None):
+        """
+        Truncated SVD of the matrix.
+
+        Parameters:
+            rank (int, optional): Number of singular values kept
+            tol (float, optional): Keep the smallest rank whose discarded singular
+                values have a relative Frobenius norm below tol
+
+        Returns:
+            TransmissionMatrix: The truncated matrix
+        """
+        if rank is None:
+            tail = np.sqrt(np.cumsum(self.s[::-1]**2)[::-1]) / np.linalg.norm(self.s)
+            rank = int(np.searchsorted(-tail, -tol)) if tol is not None else self.rank
+        return TransmissionMatrix(self.Q, self.U[:, :rank], self.s[:rank], self.Vh[:rank], self.shape)
+
+    def truncation_error(self, full):
+        """Relative Frobenius norm of the singular values of `full` discarded by this matrix."""
+        return float(np.linalg.norm(full.s[self.rank:]) / np.linalg.norm(full.s))
+
+    def project(self, phi):
+        """
+        Coefficients of a field in the input basis.
+
+        Returns:
+            tuple: (coefficients, relative norm of the part of phi outside the basis)
+        """
+        phi = np.asarray(phi, dtype=self.Q.dtype)
+        flat = phi.reshape(-1)
+        c = self.Q.conj().T @ flat
+        residual = np.linalg.norm(flat - self.Q @ c) / np.linalg.norm(flat)
+        return c, float(residual)
+
+    def __call__(self, phi):
+        """Output field of an input field (its projection on the basis)."""
+        phi = np.asarray(phi, dtype=self.Q.dtype)
+        c, _ = self.project(phi)
+        return (self.U @ (self.s * (self.Vh @ c))).reshape(self.shape)
+
+    def validate(self, phi, tejido, d, mask_manager=None):
+        """
+        Compare the prediction for phi with a direct linear propagation.
+
+        Returns:
+            dict: 'projection' residual of phi outside the basis and 'relative_error'
+                of the predicted output field against the propagated one
+        """
+        phi = np.asarray(phi, dtype=precision_types(d)[1])
+        _, residual = self.project(phi)
+        spm = int(tejido.l_s/d.dz)
+        mask_counter = 0
+        direct = phi
+        for k in range(0, d.Nz):
+            direct = linear_step_within_tissue(direct, tejido, d)
+            direct, mask_counter = _mask_step(direct, k, spm, mask_counter, d, mask_manager)
+        error = np.linalg.norm(self(phi) - direct) / np.linalg.norm(direct)
+        return {'projection': residual, 'relative_error': float(error)}
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    from benchmark.phase_mask_manager import PhaseMaskManager
+    from deep_tissue_imaging.elementos.domain import build_domain
+    from deep_tissue_imaging.elementos.lasers import fuente_microscopia_1 as laser, campo_tem00, campo_gaussiano_enfocado
+    from deep_tissue_imaging.elementos.tejidos import cerebro_emb_pez_cebra as tejido
+
+    d = build_domain(45e-6, 45e-6, 130e-6, 64, 64, 130, laser, tejido, eps=1e-2)
+    basis = hermite_gauss_basis(d.X, d.Y, 4e-6, 11)
+    beams = [campo_tem00(d.X - 2e-6, d.Y, laser.w0, laser.I_peak),
+             campo_gaussiano_enfocado(d.X, d.Y, laser.w0, laser.I_peak, d.k, 60e-6, y0=-3e-6)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        masks = PhaseMaskManager(tmp)
+        t0 = time.perf_counter()
+        tm = TransmissionMatrix.build(basis, tejido, d, masks)
+        t_build = time.perf_counter() - t0
+        print(f"{len(basis)} Hermite-Gauss inputs, 64x64, {d.Nz} steps: built in {t_build:.1f} s "
+              f"({t_build / len(basis) * 1e3:.0f} ms per input)")
+
+        for rank in (tm.rank, 60, 30):
+            compressed = tm.compress(rank)
+            t0 = time.perf_counter()
+            compressed(beams[0])
+            t_apply = time.perf_counter() - t0
+            errors = [compressed.validate(beam, tejido, d, masks) for beam in beams]
+            print(f"rank {rank}: SVD truncation {compressed.truncation_error(tm):.1e}, apply {t_apply*1e3:.2f} ms, "
+                  + ", ".join(f"beam {i}: outside basis {e['projection']:.1e}, error {e['relative_error']:.1e}"
+                              for i, e in enumerate(errors)))
+
+        t0 = time.perf_counter()
+        tm.validate(beams[0], tejido, d, masks)
+        print(f"direct propagation of one beam: {time.perf_counter() - t0:.2f} s")
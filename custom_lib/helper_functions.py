@@ -8,6 +8,8 @@ al interactuar con registros de hardware a través de AXI en PYNQ.
 Funciones disponibles:
     - float_to_uint32: Convierte un float32 a su representación en entero sin signo de 32 bits.
     - uint32_to_float: Convierte un entero sin signo de 32 bits a su valor float32.
+    - floats_to_uint32: Versión vectorizada de float_to_uint32 para arreglos.
+    - uint32_to_floats: Versión vectorizada de uint32_to_float para arreglos.
 """
 
 import numpy as np
@@ -45,4 +47,48 @@ def uint32_to_float(u):
       >>> uint32_to_float(1073741824)
       2.0
     """
-    return np.frombuffer(np.uint32(u).tobytes(), dtype=np.float32)[0]
\ No newline at end of file
+    return np.frombuffer(np.uint32(u).tobytes(), dtype=np.float32)[0]
+
+
+def floats_to_uint32(valores):
+    """
+    Convierte un arreglo de números a sus patrones de bits float32 como uint32.
+
+    Usa una vista de dtype en lugar de pasar cada valor por tobytes/frombuffer,
+    por lo que el costo es el de una sola conversión a float32. Los complejos se
+    separan en pares (real, imaginario) consecutivos, el orden en que los
+    kernels HLS esperan los registros _r e _i.
+
+    Parámetros:
+      valores (array_like): Números reales o complejos.
+
+    Retorna:
+      ndarray: Arreglo uint32 con los patrones de bits IEEE 754.
+
+    Ejemplo:
+      >>> floats_to_uint32([2.0, 3.0])
+      array([1073741824, 1077936128], dtype=uint32)
+      >>> floats_to_uint32([1 + 2j])
+      array([1065353216, 1073741824], dtype=uint32)
+    """
+    valores = np.asarray(valores)
+    if np.iscomplexobj(valores):
+        return np.ascontiguousarray(valores, dtype=np.complex64).reshape(-1).view(np.uint32)
+    return np.ascontiguousarray(valores, dtype=np.float32).reshape(-1).view(np.uint32)
+
+
+def uint32_to_floats(palabras):
+    """
+    Convierte un arreglo de enteros uint32 a los float32 que representan.
+
+    Parámetros:
+      palabras (array_like): Patrones de bits IEEE 754 de 32 bits.
+
+    Retorna:
+      ndarray: Arreglo float32 que comparte memoria con la entrada cuando es posible.
+
+    Ejemplo:
+      >>> uint32_to_floats([1073741824])
+      array([2.], dtype=float32)
+    """
+    return np.ascontiguousarray(palabras, dtype=np.uint32).view(np.float32)